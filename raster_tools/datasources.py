@@ -7,9 +7,22 @@ from osgeo import gdal
 from osgeo import ogr
 
 
+# drivers for target data sources by extension, shapefile otherwise
+DRIVERS = {
+    '.fgb': 'FlatGeobuf',
+    '.geojson': 'GeoJSON',
+    '.gpkg': 'GPKG',
+    '.sqlite': 'SQLite',
+}
+
+# number of features to write per transaction
+TRANSACTION = 10000
+
+
 class PartialDataSource(object):  # pragma: no cover
     """ Wrap a shapefile. """
     def __init__(self, path):
+        self.path = path
         self.data_source = ogr.Open(path)
         self.layer = self.data_source[0]
 
@@ -32,31 +45,47 @@ class PartialDataSource(object):  # pragma: no cover
             yield self.layer[fid]
         self.layer.SetSpatialFilter(None)
 
-    def select(self, text):
-        """ Return generator of features for text, e.g. '2/5' """
+    def get_fids(self, text=None):
+        """ Return range of feature ids for text, e.g. '2/5', or all. """
+        if text is None:
+            return range(len(self))
         selected, parts = map(int, text.split('/'))
         size = len(self) / parts
         start = int((selected - 1) * size)
         stop = len(self) if selected == parts else int(selected * size)
-        total = stop - start
+        return range(start, stop)
+
+    def select(self, text):
+        """ Return generator of features for text, e.g. '2/5' """
+        fids = self.get_fids(text)
+        total = len(fids)
         gdal.TermProgress_nocb(0)
-        for count, fid in enumerate(range(start, stop), 1):
+        for count, fid in enumerate(fids, 1):
             yield self.layer[fid]
             gdal.TermProgress_nocb(count / total)
 
 
 class TargetDataSource(object):  # pragma: no cover
-    """ Wrap a shapefile, copied from raster-analysis. """
-    def __init__(self, path, template_path, attributes):
+    """
+    Wrap a shapefile or other vector file, copied from raster-analysis.
+
+    The driver is chosen by the extension of path. Features are written in
+    transactions of a number of features, if the driver supports them. Use
+    as context manager or call close() to write the last of them.
+    """
+    def __init__(self, path, template_path, attributes,
+                 transaction=TRANSACTION):
         # read template
         template_data_source = ogr.Open(template_path)
         template_layer = template_data_source[0]
         template_sr = template_layer.GetSpatialRef()
 
         # create or replace shape
-        driver = ogr.GetDriverByName('ESRI Shapefile')
+        root, extension = os.path.splitext(path)
+        driver_name = DRIVERS.get(extension.lower(), 'ESRI Shapefile')
+        driver = ogr.GetDriverByName(driver_name)
         self.dataset = driver.CreateDataSource(path)
-        layer_name = os.path.basename(path)
+        layer_name = os.path.basename(root)
         self.layer = self.dataset.CreateLayer(layer_name, template_sr)
 
         # copy field definitions, remember names
@@ -78,14 +107,58 @@ class TargetDataSource(object):  # pragma: no cover
             self.layer.CreateField(field_defn)
         self.layer_defn = self.layer.GetLayerDefn()
 
+        # field indices by name
+        self.indices = {}
+
+        # transactions
+        if self.dataset.TestCapability(ogr.ODsCTransactions):
+            self.transaction = transaction
+        else:
+            self.transaction = 0
+        self.pending = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _get_index(self, key):
+        """ Return field index for key. """
+        try:
+            return self.indices[key]
+        except KeyError:
+            index = self.layer_defn.GetFieldIndex(str(key))
+            self.indices[key] = index
+            return index
+
     def append(self, geometry, attributes):
         """ Append geometry and attributes as new feature. """
+        if self.transaction and not self.pending:
+            self.dataset.StartTransaction()
+
         feature = ogr.Feature(self.layer_defn)
         feature.SetGeometry(geometry)
         for key, value in attributes.items():
-            feature[str(key)] = value
+            feature.SetField2(self._get_index(key), value)
         self.layer.CreateFeature(feature)
 
+        if self.transaction:
+            self.pending += 1
+            if self.pending == self.transaction:
+                self.dataset.CommitTransaction()
+                self.pending = 0
+
+    def close(self):
+        """ Commit any pending features and close the file. """
+        if self.dataset is None:
+            return
+        if self.pending:
+            self.dataset.CommitTransaction()
+            self.pending = 0
+        self.layer = None
+        self.dataset = None
+
 
 class Layer(object):
     """
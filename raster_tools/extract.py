@@ -28,13 +28,15 @@ from osgeo import osr
 
 from raster_tools import datasources
 from raster_tools import datasets
+from raster_tools import utils
+from raster_tools import writers
 
 import numpy as np
 
 operations = {}
 
 # Version management for outdated warning
-VERSION = 30
+VERSION = 31
 
 GITHUB_URL = ('https://raw.github.com/nens/'
               'raster-tools/master/raster_tools/extract.py')
@@ -66,7 +68,8 @@ Tile = collections.namedtuple('Tile', ['width',
                                        'height',
                                        'origin',
                                        'serial',
-                                       'polygon'])
+                                       'polygon',
+                                       'geometry'])
 
 
 class CompleteError(Exception):
@@ -100,16 +103,17 @@ class Layers(Operation):
             no_data_value = np.array(fillvalue, dtype).tolist()
         self.no_data_value = {self.name: no_data_value}
 
-    def calculate(self, datasets):
+    def calculate(self, datasets, timings):
         dataset = datasets[self.name]
         band = dataset.GetRasterBand(1)
-        return {self.name: {
-            'active': band.GetMaskBand().ReadAsArray(),
-            'values': band.ReadAsArray().astype(self.dtype),
-            'no_data_value': self.no_data_value[self.name],
-            'geo_transform': dataset.GetGeoTransform(),
-            'projection': dataset.GetProjection(),
-        }}
+        with utils.Timer(timings, 'read'):
+            return {self.name: {
+                'active': band.GetMaskBand().ReadAsArray(),
+                'values': band.ReadAsArray().astype(self.dtype),
+                'no_data_value': self.no_data_value[self.name],
+                'geo_transform': dataset.GetGeoTransform(),
+                'projection': dataset.GetProjection(),
+            }}
 
 
 class ThreeDiBase:
@@ -160,6 +164,19 @@ class ThreeDiBase:
 
     required = set([y for x in outputs.values() for y in x])
 
+    # temporary replacements for no data in inputs
+    replacements = {I_LANDUSE: 22, I_SOIL: 14}
+
+    # conversion tables per input, with the output they take no data from
+    conversions = {
+        I_LANDUSE: ((O_CROP, 'crop_type'),
+                    (O_FRICTION, 'friction'),
+                    (O_INTERCEPTION, 'interception'),
+                    (O_INFILTRATION, 'permeability')),
+        I_SOIL: ((O_HYDRAULIC_CONDUCTIVITY, 'intr_perm'),
+                 (O_INFILTRATION, 'max_infil')),
+    }
+
     def __init__(self, floor, landuse, soil, time, **kwargs):
         """
         Initialize the operation. The subclasses have to set the layers
@@ -184,6 +201,7 @@ class ThreeDiBase:
 
         self.soil_tables = self._get_soil_tables(soil)
         self.landuse_tables = self._get_landuse_tables(landuse)
+        self.lookups = self._get_lookups()
 
     def _get_soil_tables(self, path):
         """
@@ -285,183 +303,141 @@ class ThreeDiBase:
                     interception=interception,
                     permeability=permeability)
 
-    def _calculate_soil(self, datasets):
-        # short keys
-        i = self.I_SOIL
-        o = self.O_SOIL
-
-        dataset = datasets[i]
-        band = dataset.GetRasterBand(1)
+    def _get_lookups(self):
+        """
+        Return conversion arrays per input, with a row for each table.
+        """
+        tables = {self.I_LANDUSE: self.landuse_tables,
+                  self.I_SOIL: self.soil_tables}
+        lookups = {}
+        for name, conversions in self.conversions.items():
+            lookups[name] = np.array([
+                [self.no_data_value[output] if x is None else x
+                 for x in tables[name][table]]
+                for output, table in conversions
+            ], dtype='f8')
+        return lookups
+
+    def _read(self, datasets):
+        """
+        Return dictionary of arrays per input, reading each band and mask
+        only once.
+        """
+        inputs = {}
+        for name in self.inputs:
+            dataset = datasets[name]
+            band = dataset.GetRasterBand(1)
+            values = band.ReadAsArray()
+            no_data_value = band.GetNoDataValue()
+            replacement = self.replacements.get(name)
+            if replacement is None or no_data_value is None:
+                active = band.GetMaskBand().ReadAsArray()
+            else:
+                # no data becomes a regular code, so it is active as well
+                values[values == no_data_value] = replacement
+                active = np.where(values == no_data_value, 0, 255)
+                active = active.astype('u1')
+            inputs[name] = {
+                'values': values,
+                'active': active,
+                'geo_transform': dataset.GetGeoTransform(),
+                'projection': dataset.GetProjection(),
+            }
 
+            # convert with all tables of this input at once
+            if name in self.lookups:
+                converted = self.lookups[name][:, values]
+                inputs[name]['converted'] = {
+                    table: array for (output, table), array
+                    in zip(self.conversions[name], converted)
+                }
+        return inputs
+
+    def _convert(self, data, table, output):
+        """ Return output from a converted input. """
         return {
-            'values': band.ReadAsArray().astype(DTYPE),
-            'active': band.GetMaskBand().ReadAsArray(),
-            'geo_transform': dataset.GetGeoTransform(),
-            'projection': dataset.GetProjection(),
-            'no_data_value': self.no_data_value[o],
+            'values': data['converted'][table].astype(DTYPE),
+            'active': data['active'],
+            'geo_transform': data['geo_transform'],
+            'projection': data['projection'],
+            'no_data_value': self.no_data_value[output],
         }
 
-    def _calculate_crop(self, datasets):
-        # short keys
-        i = self.I_LANDUSE
-        o = self.O_CROP
-
-        # read and convert
-        no_data_value = self.no_data_value[o]
-        dataset = datasets[i]
-        band = dataset.GetRasterBand(1)
-        conversion = np.array([no_data_value if x is None else x
-                               for x in self.landuse_tables['crop_type']])
-
+    def _calculate_soil(self, inputs):
+        data = inputs[self.I_SOIL]
         return {
-            'values': conversion[band.ReadAsArray()].astype(DTYPE),
-            'active': band.GetMaskBand().ReadAsArray(),
-            'geo_transform': dataset.GetGeoTransform(),
-            'projection': dataset.GetProjection(),
-            'no_data_value': no_data_value,
+            'values': data['values'].astype(DTYPE),
+            'active': data['active'],
+            'geo_transform': data['geo_transform'],
+            'projection': data['projection'],
+            'no_data_value': self.no_data_value[self.O_SOIL],
         }
 
-    def _calculate_friction(self, datasets):
-        # short keys
-        i = self.I_LANDUSE
-        o = self.O_FRICTION
+    def _calculate_crop(self, inputs):
+        return self._convert(data=inputs[self.I_LANDUSE],
+                             table='crop_type',
+                             output=self.O_CROP)
 
-        # read and convert
-        no_data_value = self.no_data_value[o]
-        dataset = datasets[i]
-        conversion = np.array([no_data_value if x is None else x
-                               for x in self.landuse_tables['friction']])
-        band = dataset.GetRasterBand(1)
+    def _calculate_friction(self, inputs):
+        return self._convert(data=inputs[self.I_LANDUSE],
+                             table='friction',
+                             output=self.O_FRICTION)
 
-        return {
-            'values': conversion[band.ReadAsArray()].astype(DTYPE),
-            'active': band.GetMaskBand().ReadAsArray(),
-            'geo_transform': dataset.GetGeoTransform(),
-            'projection': dataset.GetProjection(),
-            'no_data_value': no_data_value,
-        }
-
-    def _calculate_bathymetry(self, datasets):
-        # short keys
-        i = self.I_BATHYMETRY
-        o = self.O_BATHYMETRY
-
-        # read
-        dataset = datasets[i]
-        band = dataset.GetRasterBand(1)
-        values = band.ReadAsArray().astype(DTYPE)
-        active = band.GetMaskBand().ReadAsArray()
+    def _calculate_bathymetry(self, inputs):
+        data = inputs[self.I_BATHYMETRY]
+        values = data['values'].astype(DTYPE)
 
         # mask nan (for example when floor is nan)
-        active[np.isnan(values)] = False
+        active = np.where(np.isnan(values), 0, data['active'])
 
         return {
             'values': values,
-            'active': active,
-            'geo_transform': dataset.GetGeoTransform(),
-            'projection': dataset.GetProjection(),
-            'no_data_value': self.no_data_value[o],
+            'active': active.astype('u1'),
+            'geo_transform': data['geo_transform'],
+            'projection': data['projection'],
+            'no_data_value': self.no_data_value[self.O_BATHYMETRY],
         }
 
-    def _calculate_infiltration(self, datasets):
-        # short keys
-        s = self.I_SOIL
-        c = self.I_LANDUSE
-        o = self.O_INFILTRATION
-
-        # read and convert soil
-        no_data_value = self.no_data_value[o]
-        s_conv = np.array([no_data_value if x is None else x
-                           for x in self.soil_tables['max_infil']])
-        s_dataset = datasets[s]
-        s_band = s_dataset.GetRasterBand(1)
-        s_data = s_conv[s_band.ReadAsArray()]
-        s_mask = ~s_band.GetMaskBand().ReadAsArray().astype('b1')
-        s_data[s_mask] = no_data_value
-
-        # read and convert landuse
-        c_conv = np.array([no_data_value if x is None else x
-                           for x in self.landuse_tables['permeability']])
-        c_dataset = datasets[c]
-        c_band = c_dataset.GetRasterBand(1)
-        c_data = c_conv[c_band.ReadAsArray()]
-        c_mask = ~c_band.GetMaskBand().ReadAsArray().astype('b1')
-        c_data[c_mask] = no_data_value
-
-        # calculate
+    def _calculate_infiltration(self, inputs):
+        s_data = inputs[self.I_SOIL]
+        c_data = inputs[self.I_LANDUSE]
+        s_values = s_data['converted']['max_infil']
+        c_values = c_data['converted']['permeability']
+        no_data_value = self.no_data_value[self.O_INFILTRATION]
+
+        # calculate where both are active and defined
+        defined = np.logical_and(s_data['active'], c_data['active'])
+        defined &= s_values != no_data_value
+        defined &= c_values != no_data_value
         values = np.where(
-            np.logical_and(c_data != no_data_value, s_data != no_data_value),
-            c_data * s_data,
-            no_data_value,
+            defined, c_values * s_values, no_data_value,
         ).astype(DTYPE)
 
         return {
             'values': values,
             'active': np.where(values == no_data_value, 0, 255).astype('u1'),
-            'geo_transform': s_dataset.GetGeoTransform(),
-            'projection': s_dataset.GetProjection(),
+            'geo_transform': s_data['geo_transform'],
+            'projection': s_data['projection'],
             'no_data_value': no_data_value,
         }
 
-    def _calculate_interception(self, datasets):
-        # short keys
-        i = self.I_LANDUSE
-        o = self.O_INTERCEPTION
-
-        # read and convert
-        no_data_value = self.no_data_value[o]
-        conversion = np.array([no_data_value if x is None else x
-                               for x in self.landuse_tables['interception']])
-        dataset = datasets[i]
-        band = dataset.GetRasterBand(1)
+    def _calculate_interception(self, inputs):
+        return self._convert(data=inputs[self.I_LANDUSE],
+                             table='interception',
+                             output=self.O_INTERCEPTION)
 
-        return {
-            'values': conversion[band.ReadAsArray()].astype(DTYPE),
-            'active': band.GetMaskBand().ReadAsArray(),
-            'geo_transform': dataset.GetGeoTransform(),
-            'projection': dataset.GetProjection(),
-            'no_data_value': no_data_value,
-        }
+    def _calculate_hydr_cond(self, inputs):
+        return self._convert(data=inputs[self.I_SOIL],
+                             table='intr_perm',
+                             output=self.O_HYDRAULIC_CONDUCTIVITY)
 
-    def _calculate_hydr_cond(self, datasets):
-        # short keys
-        i = self.I_SOIL
-        o = self.O_HYDRAULIC_CONDUCTIVITY
-
-        # read and convert
-        no_data_value = self.no_data_value[o]
-        conversion = np.array([no_data_value if x is None else x
-                               for x in self.soil_tables['intr_perm']])
-        dataset = datasets[i]
-        band = dataset.GetRasterBand(1)
-
-        return {
-            'values': conversion[band.ReadAsArray()].astype(DTYPE),
-            'active': band.GetMaskBand().ReadAsArray(),
-            'geo_transform': dataset.GetGeoTransform(),
-            'projection': dataset.GetProjection(),
-            'no_data_value': no_data_value,
-        }
-
-    def calculate(self, datasets):
+    def calculate(self, datasets, timings):
         """ Return dictionary of output datasets. """
-        # Temporarily change no data into 22 in landuse
-        use_dataset = datasets[self.I_LANDUSE]
-        use_band = use_dataset.GetRasterBand(1)
-        use_array = use_band.ReadAsArray()
-        use_no_data_value = use_band.GetNoDataValue()
-        use_array[use_array == use_no_data_value] = 22
-        use_band.WriteArray(use_array)
-
-        # Temporarily change no data into 14 in soil
-        soil_dataset = datasets[self.I_SOIL]
-        soil_band = soil_dataset.GetRasterBand(1)
-        soil_array = soil_band.ReadAsArray()
-        soil_no_data_value = soil_band.GetNoDataValue()
-        soil_array[soil_array == soil_no_data_value] = 14
-        soil_band.WriteArray(soil_array)
-
-        return {key: self.calculators[key](datasets) for key in self.outputs}
+        with utils.Timer(timings, 'read'):
+            inputs = self._read(datasets)
+        with utils.Timer(timings, 'calculate'):
+            return {key: self.calculators[key](inputs)
+                    for key in self.outputs}
 
 
 class ThreeDiAHN2(Operation, ThreeDiBase):
@@ -600,7 +576,8 @@ class Preparation:
         # create
         dataset = DRIVER_GDAL_GTIFF.Create(
             path, width, height, 1, self.operation.data_type[name],
-            ['TILED=YES', 'BIGTIFF=YES', 'SPARSE_OK=TRUE', 'COMPRESS=DEFLATE'],
+            ['TILED=YES', 'BIGTIFF=YES', 'SPARSE_OK=TRUE', 'COMPRESS=DEFLATE',
+             writers.NUM_THREADS],
         )
         dataset.SetProjection(projection)
         dataset.SetGeoTransform(geo_transform)
@@ -622,7 +599,9 @@ class Preparation:
         datasets = {}
         for name, path in self.paths.items():
             if os.path.exists(path):
-                datasets[name] = gdal.Open(path, gdal.GA_Update)
+                datasets[name] = gdal.OpenEx(
+                    path, gdal.OF_UPDATE, open_options=[writers.NUM_THREADS],
+                )
             else:
                 datasets[name] = self._create_dataset(name, path)
         return datasets
@@ -699,8 +678,26 @@ class Index:
         self.block_size = w, h
         self.dataset_size = dataset.RasterXSize, dataset.RasterYSize
         self.geo_transform = dataset.GetGeoTransform()
+        self.geometry = geometry
         self.indices = index.ReadAsArray().nonzero()
 
+        # blocks not touching the boundary may be entirely inside
+        index.GetRasterBand(1).Fill(0)
+        with datasources.Layer(geometry.Boundary()) as boundary_layer:
+            gdal.RasterizeLayer(
+                index,
+                [1],
+                boundary_layer,
+                burn_values=[1],
+                options=['all_touched=true'],
+            )
+        boundary = index.ReadAsArray()
+        self.interior = np.zeros(len(self), dtype='b1')
+        for serial in (boundary[self.indices] == 0).nonzero()[0]:
+            polygon = self.get_polygon(self.get_indices(serial))
+            rectangle = ogr.CreateGeometryFromWkt(polygon)
+            self.interior[serial] = geometry.Contains(rectangle)
+
     def get_indices(self, serial):
         """ Return indices into dataset. """
         w, h = self.block_size
@@ -722,6 +719,17 @@ class Index:
         y2 = q + c * u2 + d * v2
         return POLYGON.format(x1=x1, y1=y1, x2=x2, y2=y2)
 
+    def get_geometry(self, serial):
+        """
+        Return the geometry clipped to a block with a margin of one pixel,
+        or None if the block is entirely inside the geometry.
+        """
+        if self.interior[serial]:
+            return None
+        x1, y1, x2, y2 = self.get_indices(serial)
+        polygon = self.get_polygon((x1 - 1, y1 - 1, x2 + 1, y2 + 1))
+        return self.geometry.Intersection(ogr.CreateGeometryFromWkt(polygon))
+
     def __len__(self):
         return len(self.indices[0])
 
@@ -737,7 +745,8 @@ class Index:
                        height=height,
                        origin=origin,
                        serial=serial,
-                       polygon=polygon)
+                       polygon=polygon,
+                       geometry=self.get_geometry(serial))
 
 
 class Source:
@@ -860,13 +869,19 @@ class Block:
         for chunk in self.chunks.values():
             yield chunk
 
-    def save(self, fill_zeros):
+    def save(self, fill_zeros, writer):
         """
-        Cut out and save block.
+        Cut out block and hand it to writer.
 
         param fill_zeros: Put zeros for no data within geometry.
+        param writer: writers.Writer object
+
+        Return dictionary with seconds spent per stage, where writing is
+        the time spent waiting for room in the queue of writer.
         """
-        outputs = self.operation.calculate(self.inputs)
+        timings = {}
+        outputs = self.operation.calculate(self.inputs, timings)
+        insides = {}
         for name in outputs:
 
             # assign to names
@@ -877,33 +892,47 @@ class Block:
             no_data_value = output['no_data_value']
             geo_transform = output['geo_transform']
 
-            # determine inside pixels
-            inside = np.zeros_like(active)
+            # determine inside pixels, once for outputs on the same grid
             kwargs = {
                 'projection': projection,
                 'geo_transform': geo_transform,
             }
-            with datasources.Layer(self.geometry) as layer:
-                with datasets.Dataset(inside, **kwargs) as dataset:
-                    gdal.RasterizeLayer(dataset, [1], layer, burn_values=[255])
-
-            if fill_zeros:
-                # set inactive pixels to zero, but outside pixels to no data
-                array[np.logical_not(active)] = 0
-                array[np.logical_not(inside)] = no_data_value
-            else:
-                # mask outside or inactive
-                array[~np.logical_and(active, inside)] = no_data_value
+            key = geo_transform, active.shape
+            with utils.Timer(timings, 'mask'):
+                if key not in insides and self.tile.geometry is None:
+                    # the block is entirely inside
+                    insides[key] = np.full_like(active, 255)
+                elif key not in insides:
+                    # rasterize the geometry clipped to the block
+                    inside = np.zeros_like(active)
+                    with datasources.Layer(self.tile.geometry) as layer:
+                        with datasets.Dataset(inside, **kwargs) as dataset:
+                            gdal.RasterizeLayer(
+                                dataset, [1], layer, burn_values=[255],
+                            )
+                    insides[key] = inside
+                inside = insides[key]
+
+                if fill_zeros:
+                    # set inactive pixels to zero, outside pixels to no data
+                    array[np.logical_not(active)] = 0
+                    array[np.logical_not(inside)] = no_data_value
+                else:
+                    # mask outside or inactive
+                    array[~np.logical_and(active, inside)] = no_data_value
 
             # write to target dataset
-            tile = self.tile
-            kwargs.update(no_data_value=no_data_value)
-            with datasets.Dataset(array, **kwargs) as dataset:
-                data = dataset.ReadRaster(0, 0, tile.width, tile.height)
-                args = tile.origin + (tile.width, tile.height, data)
-                self.datasets[name].WriteRaster(*args)
-
-        # uppdate resume file
+            with utils.Timer(timings, 'write'):
+                writer.write(dataset=self.datasets[name],
+                             array=array[0],
+                             origin=self.tile.origin)
+
+        # uppdate resume file after writing
+        writer.call(self._resume)
+        return timings
+
+    def _resume(self):
+        """ Record this block as the last completed one. """
         with open(self.rpath, 'w') as resume_file:
             resume_file.write(str(self.tile.serial + 1))
 
@@ -963,26 +992,37 @@ def extract_model(preparation, fill_zeros):
     thread1.daemon = True
     thread1.start()
 
-    while True:
-        # fetch loaded chunks
-        try:
-            chunk, thread2 = queue.get()
-            thread2.join()  # this makes sure the load method finished
-        except TypeError:
-            break
-
-        # check if loading was a success
-        if not chunk.loaded:
-            print('Oops, a chunk failed to fetch. Resuming is worth a try!')
-            return
-
-        # save complete blocks
-        if len(chunk.block.chunks) == len(chunk.block.inputs):
-            chunk.block.save(fill_zeros)
-            gdal.TermProgress_nocb((chunk.block.tile.serial + 1) / total)
+    totals = {}
+    with writers.Writer() as writer:
+        while True:
+            # fetch loaded chunks
+            try:
+                chunk, thread2 = queue.get()
+                thread2.join()  # this makes sure the load method finished
+            except TypeError:
+                break
+
+            # check if loading was a success
+            if not chunk.loaded:
+                print('Oops, a chunk failed to fetch. '
+                      'Resuming is worth a try!')
+                return
+
+            # save complete blocks
+            if len(chunk.block.chunks) == len(chunk.block.inputs):
+                timings = chunk.block.save(fill_zeros, writer)
+                for stage, seconds in timings.items():
+                    totals[stage] = totals.get(stage, 0) + seconds
+                serial = chunk.block.tile.serial
+                gdal.TermProgress_nocb((serial + 1) / total)
 
     thread1.join()
 
+    # report the time spent per stage, summed over the blocks
+    for stage, seconds in totals.items():
+        print('{:<13}{:10.1f} s'.format(stage, seconds))
+    print(writer.report())
+
 
 def check_version():
     """
@@ -4,9 +4,6 @@
 Edge class.
 """
 
-import collections
-import statistics
-
 import numpy as np
 
 # properties of working arrays
@@ -38,18 +35,35 @@ class Edge(object):
         The aggregated edge is a new edge object where the edge pixels are the
         median of up to four underlying pixels from self.
         """
-        # aggregate
-        work = collections.defaultdict(list)
-        for k, i, j in zip(self.values, *self.indices):
-            work[i // 2, j // 2].append(k)
-
-        # statistic
-        indices = tuple(np.array(ind) for ind in zip(*work))
-        values = [statistics.median(work[k]) for k in zip(*indices)]
+        shape = -(-self.shape[0] // 2), -(-self.shape[1] // 2)
+
+        # group the pixels by aggregated pixel
+        i, j = (ind // 2 for ind in self.indices)
+        key = np.ravel_multi_index((i, j), shape)
+        order = np.argsort(key, kind='stable')
+        key = key[order]
+        first = np.empty(len(key), dtype='b1')
+        first[:1] = True
+        np.not_equal(key[1:], key[:-1], out=first[1:])
+        start = first.nonzero()[0]
+        group = np.cumsum(first) - 1
+        count = np.diff(np.append(start, len(key)))
+
+        # sort the up to four values per group, padding with a value that is
+        # not smaller than any of the values
+        values = np.asarray(self.values)
+        work = np.full((len(start), 4), values.max(initial=0))
+        work[group, np.arange(len(key)) - start[group]] = values[order]
+        work.sort(axis=1)
+
+        # statistic, taking the mean of the middle two for even counts
+        rows = np.arange(len(start))
+        lo = work[rows, (count - 1) // 2]
+        hi = work[rows, count // 2]
         return self.__class__(
-            indices=indices,
-            values=values,
-            shape=(-(-self.shape[0] // 2), -(-self.shape[1] // 2)),
+            indices=np.unravel_index(key[start], shape),
+            values=np.where(count % 2, lo, (lo + hi) / 2),
+            shape=shape,
         )
 
     def pasteon(self, array):
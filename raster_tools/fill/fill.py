@@ -17,12 +17,15 @@ larger voids. Furthermore, instead of a pixel-for-pixel approach a correlation
 with a smoothing kernel is applied.
 """
 
+from multiprocessing import shared_memory
 from os.path import dirname, exists
 
 import argparse
+import multiprocessing
 import os
 
 from osgeo import gdal
+from osgeo import gdal_array
 from osgeo import ogr
 from scipy import ndimage
 
@@ -36,6 +39,9 @@ from raster_tools.fill import imagers
 DRIVER = gdal.GetDriverByName('gtiff')
 OPTIONS = ['compress=deflate', 'tiled=yes']
 
+# streaming tiles are a multiple of this size
+BLOCK_SIZE = 256
+
 # smoothing kernel designed to have the effect of restoring features after
 # aggregation and zooming
 KERNEL = np.array([[0.0625, 0.1250, 0.0625],
@@ -45,6 +51,9 @@ KERNEL = np.array([[0.0625, 0.1250, 0.0625],
 imager = imagers.Imager()
 progress = True
 
+# shared arrays of a worker process, set by the pool initializer
+worker = {}
+
 
 def smooth(array):
     """ Two-step uniform for symmetric smoothing. """
@@ -56,18 +65,43 @@ def zoom(array):
     return array.repeat(2, axis=0).repeat(2, axis=1)
 
 
+def initialize(specs):
+    """ Attach to the shared arrays in a worker process. """
+    for name, (memory_name, shape, dtype) in specs.items():
+        memory = shared_memory.SharedMemory(name=memory_name)
+        worker[name] = np.ndarray(shape, dtype=dtype, buffer=memory.buf)
+        worker.setdefault('memories', []).append(memory)
+
+
+def process(task):
+    """ Fill a single void in the shared arrays in a worker process. """
+    label, index = task
+    fill_void(
+        source=worker['source'][index],
+        target=worker['target'][index],
+        void=worker['labels'][index] == label,
+    )
+
+
 class Exchange(object):
-    def __init__(self, source_path, target_path):
+    def __init__(self, source_path, target_path, shared=False):
         """
         Read source, create target array.
+
+        :param shared: put the arrays in shared memory, for processing by
+            a pool of worker processes.
         """
         dataset = gdal.Open(source_path)
         band = dataset.GetRasterBand(1)
 
-        self.source = band.ReadAsArray()
-        self.no_data_value = band.GetNoDataValue()
+        self.memories = {}
+        self.shared = shared
+        self.shape = dataset.RasterYSize, dataset.RasterXSize
 
-        self.shape = self.source.shape
+        dtype = gdal_array.GDALTypeCodeToNumericTypeCode(band.DataType)
+        self.source = self._allocate('source', dtype)
+        band.ReadAsArray(buf_obj=self.source)
+        self.no_data_value = band.GetNoDataValue()
 
         self.kwargs = {
             'no_data_value': self.no_data_value,
@@ -76,7 +110,25 @@ class Exchange(object):
         }
 
         self.target_path = target_path
-        self.target = np.full_like(self.source, self.no_data_value)
+        self.target = self._allocate('target', dtype)
+        self.target[:] = self.no_data_value
+
+    def _allocate(self, name, dtype):
+        """ Return an array of our shape, in shared memory if requested. """
+        if not self.shared:
+            return np.empty(self.shape, dtype=dtype)
+        size = max(1, self.shape[0] * self.shape[1] * np.dtype(dtype).itemsize)
+        memory = shared_memory.SharedMemory(create=True, size=size)
+        self.memories[name] = memory
+        return np.ndarray(self.shape, dtype=dtype, buffer=memory.buf)
+
+    def close(self):
+        """ Release any shared memory. """
+        self.source = self.target = self.labels = None
+        for memory in self.memories.values():
+            memory.unlink()
+            memory.close()
+        self.memories.clear()
 
     def _grow(self, obj):
         """
@@ -106,22 +158,44 @@ class Exchange(object):
         if progress:  # pragma: no cover
             gdal.TermProgress_nocb(0)
 
-        # analyze
-        mask = (self.source == self.no_data_value)
-        labels, total = ndimage.label(mask)
-        items = ndimage.find_objects(labels)
+        items = self._label()
+        total = len(items)
 
         # iterate the objects
         for label, item in enumerate(items, 1):
-            index = self._grow(item)       # to include the edge
-            source = self.source[index]    # view into source array
-            target = self.target[index]    # view into target array
-            void = labels[index] == label  # the footprint of this void
+            index = self._grow(item)            # to include the edge
+            source = self.source[index]         # view into source array
+            target = self.target[index]         # view into target array
+            void = self.labels[index] == label  # the footprint of this void
             yield source, target, void
 
             if progress:  # pragma: no cover
                 gdal.TermProgress_nocb(label / total)
 
+    def _label(self):
+        """ Label the voids and return their slices. """
+        mask = (self.source == self.no_data_value)
+        self.labels = self._allocate('labels', 'i4')
+        ndimage.label(mask, output=self.labels)
+        return ndimage.find_objects(self.labels)
+
+    def get_specs(self):
+        """ Return what worker processes need to attach to the arrays. """
+        return {
+            name: (memory.name, self.shape, getattr(self, name).dtype)
+            for name, memory in self.memories.items()
+        }
+
+    def get_tasks(self):
+        """
+        Return list of (label, index) tuples, largest voids first, so that
+        the largest voids do not end up delaying the completion.
+        """
+        indices = [self._grow(item) for item in self._label()]
+        sizes = [(i.stop - i.start) * (j.stop - j.start) for i, j in indices]
+        order = np.argsort(sizes, kind='stable')[::-1]
+        return [(label + 1, indices[label]) for label in order.tolist()]
+
     def clip(self, path):
         """
         Clip using OGR source at path.
@@ -160,6 +234,245 @@ class Exchange(object):
             DRIVER.CreateCopy(self.target_path, dataset, options=OPTIONS)
 
 
+def find(parent, label):
+    """ Return root of label, compressing the path on the way. """
+    while parent[label] != label:
+        parent[label] = parent[parent[label]]
+        label = parent[label]
+    return label
+
+
+class StreamingExchange(object):
+    def __init__(self, source_path, target_path, memory):
+        """
+        Prepare to fill a source that does not need to fit in memory.
+
+        :param memory: memory budget in bytes, used to size the tiles.
+
+        Voids are labeled per tile and merged across the tile seams. Each
+        void is then filled from a window around its bounding box, written
+        to an uncompressed working file, which is finally copied
+        block-by-block into the target.
+        """
+        self.dataset = gdal.Open(source_path)
+        self.band = self.dataset.GetRasterBand(1)
+        self.no_data_value = self.band.GetNoDataValue()
+        self.shape = self.dataset.RasterYSize, self.dataset.RasterXSize
+
+        self.kwargs = {
+            'no_data_value': self.no_data_value,
+            'projection': self.dataset.GetProjection(),
+            'geo_transform': self.dataset.GetGeoTransform(),
+        }
+
+        # rough number of bytes per pixel for source, target, mask and labels
+        dtype = gdal_array.GDALTypeCodeToNumericTypeCode(self.band.DataType)
+        self.memory = memory
+        self.itemsize = 2 * np.dtype(dtype).itemsize + 16
+        size = int((memory / self.itemsize) ** 0.5) // BLOCK_SIZE * BLOCK_SIZE
+        self.tile_size = max(BLOCK_SIZE, size)
+
+        self.clip_source = None
+        self.decimals = None
+
+        # working file that is updated void by void
+        subdir = dirname(target_path)
+        if subdir:
+            os.makedirs(subdir, exist_ok=True)
+        self.target_path = target_path
+        self.work_path = target_path + '.work.tif'
+        options = [
+            'tiled=yes',
+            'sparse_ok=true',
+            'blockxsize=%s' % BLOCK_SIZE,
+            'blockysize=%s' % BLOCK_SIZE,
+        ]
+        self.work = DRIVER.Create(
+            self.work_path,
+            self.shape[1],
+            self.shape[0],
+            1,
+            self.band.DataType,
+            options=options,
+        )
+        self.work.SetProjection(self.kwargs['projection'])
+        self.work.SetGeoTransform(self.kwargs['geo_transform'])
+        self.work.GetRasterBand(1).SetNoDataValue(self.no_data_value)
+
+    def _get_tiles(self):
+        """ Return list of x1, y1, x2, y2 tuples, row by row. """
+        h, w = self.shape
+        size = self.tile_size
+        return [(x1, y1, min(w, x1 + size), min(h, y1 + size))
+                for y1 in range(0, h, size)
+                for x1 in range(0, w, size)]
+
+    def _read(self, x1, y1, x2, y2):
+        """ Return source window, with zeros outside the clip source. """
+        array = self.band.ReadAsArray(x1, y1, x2 - x1, y2 - y1)
+        if self.clip_source is None:
+            return array
+
+        # rasterize clip features in the window as zeros into a mask with ones
+        mask = np.ones(array.shape, dtype='b1')
+        p, a, b, q, c, d = self.kwargs['geo_transform']
+        kwargs = {
+            'projection': self.kwargs['projection'],
+            'geo_transform': (
+                p + a * x1 + b * y1, a, b, q + c * x1 + d * y1, c, d,
+            ),
+        }
+        xs = p + a * x1 + b * y1, p + a * x2 + b * y2
+        ys = q + c * x1 + d * y1, q + c * x2 + d * y2
+        with datasets.Dataset(mask[np.newaxis].view('u1'), **kwargs) as ds:
+            for layer in self.clip_source:
+                layer.SetSpatialFilterRect(min(xs), min(ys), max(xs), max(ys))
+                gdal.RasterizeLayer(ds, [1], layer, burn_values=[0])
+                layer.SetSpatialFilter(None)
+
+        array[mask] = 0
+        return array
+
+    def _scan(self):
+        """
+        Return bounding boxes and seed pixels of the voids.
+
+        Bounding boxes are y1, x1, y2, x2 rows and seeds are y, x rows in
+        numpy arrays.
+        """
+        parent = [0]
+        boxes, seeds = [], []
+        bottom = np.zeros(self.shape[1], dtype='i8')  # labels above tile
+
+        tiles = self._get_tiles()
+        for count, (x1, y1, x2, y2) in enumerate(tiles, 1):
+            mask = self._read(x1, y1, x2, y2) == self.no_data_value
+            local, total = ndimage.label(mask)
+
+            # global labels, with the stats of the new labels
+            offset = len(parent)
+            labels = np.where(mask, local + offset - 1, 0)
+            parent.extend(range(offset, offset + total))
+            for item in ndimage.find_objects(local):
+                boxes.append((
+                    y1 + item[0].start, x1 + item[1].start,
+                    y1 + item[0].stop, x1 + item[1].stop,
+                ))
+            values, first = np.unique(local.ravel(), return_index=True)
+            i, j = np.unravel_index(first[values > 0], local.shape)
+            seeds.append(np.stack([i + y1, j + x1], axis=1))
+
+            # merge with the voids in the tiles above and to the left
+            if x1 == 0:
+                right = np.zeros(y2 - y1, dtype='i8')  # labels left of tile
+            pairs = (bottom[x1:x2], labels[0]), (right, labels[:, 0])
+            for this, other in pairs:
+                active = (this > 0) & (other > 0)
+                for a, b in set(zip(this[active].tolist(),
+                                    other[active].tolist())):
+                    a, b = find(parent, a), find(parent, b)
+                    parent[max(a, b)] = min(a, b)
+
+            bottom[x1:x2] = labels[-1]
+            right = labels[:, -1]
+
+            if progress:  # pragma: no cover
+                gdal.TermProgress_nocb(count / len(tiles))
+
+        # resolve roots, and merge the bounding boxes per root
+        parent = np.array(parent)
+        while True:
+            grandparent = parent[parent]
+            if np.array_equal(grandparent, parent):
+                break
+            parent = grandparent
+        boxes = np.array(boxes, dtype='i8').reshape(-1, 4)
+        seeds = np.concatenate(seeds)
+        roots = parent[1:]
+        unique = np.unique(roots)
+        merged = np.empty((len(parent), 4), dtype='i8')
+        merged[unique] = boxes[unique - 1]
+        np.minimum.at(merged[:, 0], roots, boxes[:, 0])
+        np.minimum.at(merged[:, 1], roots, boxes[:, 1])
+        np.maximum.at(merged[:, 2], roots, boxes[:, 2])
+        np.maximum.at(merged[:, 3], roots, boxes[:, 3])
+        return merged[unique], seeds[unique - 1]
+
+    def __iter__(self):
+        """
+        Return generator of (source, target, void) tuples.
+
+        Source and target are windows around the void. The target is written
+        back after the next item is requested.
+        """
+        if progress:  # pragma: no cover
+            gdal.TermProgress_nocb(0)
+
+        boxes, seeds = self._scan()
+        order = np.lexsort((boxes[:, 1], boxes[:, 0]))  # localize writes
+        band = self.work.GetRasterBand(1)
+        h, w = self.shape
+
+        for count, number in enumerate(order.tolist(), 1):
+            # grow to include the edge
+            y1, x1, y2, x2 = boxes[number].tolist()
+            y1, x1, y2, x2 = max(0, y1 - 1), max(0, x1 - 1), \
+                min(h, y2 + 1), min(w, x2 + 1)
+            if (y2 - y1) * (x2 - x1) * self.itemsize > self.memory:
+                print('Void at row %s, column %s exceeds memory.' % (y1, x1))
+
+            # the footprint of this void is the component at the seed
+            source = self._read(x1, y1, x2, y2)
+            labels, total = ndimage.label(source == self.no_data_value)
+            i, j = seeds[number].tolist()
+            void = labels == labels[i - y1, j - x1]
+
+            target = band.ReadAsArray(x1, y1, x2 - x1, y2 - y1)
+            yield source, target, void
+            band.WriteArray(target, x1, y1)
+
+            if progress:  # pragma: no cover
+                gdal.TermProgress_nocb(count / len(order))
+
+    def clip(self, path):
+        """
+        Clip using OGR source at path.
+
+        Clip is applied when reading, by putting zeros in the source outside
+        the clip layer, so that they are excluded from the fill process. The
+        source is opened once and filtered to the window on each read.
+        """
+        self.clip_source = ogr.Open(path)
+
+    def round(self, decimals):
+        """ Round target when saving. """
+        self.decimals = decimals
+
+    def save(self):
+        """ Save. """
+        h, w = self.shape
+        target = DRIVER.Create(
+            self.target_path, w, h, 1, self.band.DataType, options=OPTIONS,
+        )
+        target.SetProjection(self.kwargs['projection'])
+        target.SetGeoTransform(self.kwargs['geo_transform'])
+        target_band = target.GetRasterBand(1)
+        target_band.SetNoDataValue(self.no_data_value)
+
+        work_band = self.work.GetRasterBand(1)
+        for x1, y1, x2, y2 in self._get_tiles():
+            array = work_band.ReadAsArray(x1, y1, x2 - x1, y2 - y1)
+            if self.decimals:
+                active = array != self.no_data_value
+                array[active] = array[active].round(self.decimals)
+            target_band.WriteArray(array, x1, y1)
+
+    def close(self):
+        """ Remove the working file. """
+        self.work = None
+        DRIVER.Delete(self.work_path)
+
+
 def fill(edge, level=0):
     """
     Return a filled array.
@@ -195,7 +508,50 @@ def fill(edge, level=0):
     return array
 
 
-def fillnodata(source_path, target_path, clip_path, decimals):
+def fill_void(source, target, void):
+    """
+    Fill a single void.
+
+    :param source: source array around the void, including its edge
+    :param target: target array of the same shape as source
+    :param void: boolean array with the footprint of the void
+    """
+    # analyze
+    edge = void ^ ndimage.binary_dilation(void)
+    indices = edge.nonzero()
+
+    # create edge object
+    edge = edges.Edge(
+        indices=indices,
+        values=source[indices],
+        shape=source.shape,
+    )
+
+    # fill it
+    filled = fill(edge)
+
+    # apply
+    target[void] = filled[void]
+
+
+def fill_parallel(exchange, workers):
+    """ Fill the voids using a pool of worker processes. """
+    tasks = exchange.get_tasks()
+    total = len(tasks)
+
+    if progress:  # pragma: no cover
+        gdal.TermProgress_nocb(0)
+
+    with multiprocessing.Pool(processes=workers,
+                              initializer=initialize,
+                              initargs=(exchange.get_specs(),)) as pool:
+        for count, _ in enumerate(pool.imap_unordered(process, tasks), 1):
+            if progress:  # pragma: no cover
+                gdal.TermProgress_nocb(count / total)
+
+
+def fillnodata(source_path, target_path, clip_path, decimals, workers=1,
+               memory=None):
     """ Fill the voids in a single file. """
     # skip existing
     if exists(target_path):
@@ -210,37 +566,35 @@ def fillnodata(source_path, target_path, clip_path, decimals):
         print('Clip source "{}" not found.'.format(clip_path))
         return
 
-    # read
-    exchange = Exchange(source_path, target_path)
-
-    if clip_path:
-        exchange.clip(clip_path)
-
-    # process
-    for count, (source, target, void) in enumerate(exchange, 1):
+    workers = workers or multiprocessing.cpu_count()
 
-        # analyze
-        edge = void ^ ndimage.binary_dilation(void)
-        indices = edge.nonzero()
-
-        # create edge object
-        edge = edges.Edge(
-            indices=indices,
-            values=source[indices],
-            shape=source.shape,
+    # read, or prepare to read in tiles
+    if memory:
+        workers = 1
+        exchange = StreamingExchange(
+            source_path, target_path, memory=memory * 1024 ** 2,
         )
+    else:
+        exchange = Exchange(source_path, target_path, shared=workers > 1)
 
-        # fill it
-        filled = fill(edge)
+    try:
+        if clip_path:
+            exchange.clip(clip_path)
 
-        # apply
-        target[void] = filled[void]
+        # process
+        if workers == 1:
+            for source, target, void in exchange:
+                fill_void(source=source, target=target, void=void)
+        else:
+            fill_parallel(exchange=exchange, workers=workers)
 
-    if decimals:
-        exchange.round(decimals)
+        if decimals:
+            exchange.round(decimals)
 
-    # save
-    exchange.save()
+        # save
+        exchange.save()
+    finally:
+        exchange.close()
 
 
 def get_parser():
@@ -269,6 +623,18 @@ def get_parser():
         dest='clip_path',
         help='Clip the result using this OGR data source.',
     )
+    parser.add_argument(
+        '-w', '--workers',
+        type=int,
+        default=1,
+        help='Number of worker processes, 0 for one per cpu.',
+    )
+    parser.add_argument(
+        '-m', '--memory',
+        type=int,
+        help=('Process in tiles using about this many megabytes, for '
+              'sources that do not fit in memory. Ignores workers.'),
+    )
 
     return parser
 
@@ -1,9 +1,13 @@
 # (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.rst.
 # -*- coding: utf-8 -*-
 
+import collections
 import os
+import statistics
 import sys
+import time
 import unittest
+from unittest import mock
 
 from osgeo import gdal
 from osgeo import ogr
@@ -17,6 +21,39 @@ from raster_tools import datasets
 from raster_tools import datasources
 
 POLYGON = 'POLYGON (({x1} {y1},{x2} {y1},{x2} {y2},{x1} {y2},{x1} {y1}))'
+BENCHMARK = os.environ.get('RASTER_TOOLS_BENCHMARK')
+
+
+def aggregated(edge):
+    """ Reference implementation of Edge.aggregated(). """
+    work = collections.defaultdict(list)
+    for k, i, j in zip(edge.values, *edge.indices):
+        work[i // 2, j // 2].append(k)
+
+    indices = tuple(np.array(ind) for ind in zip(*work))
+    values = [statistics.median(work[k]) for k in zip(*indices)]
+    return edges.Edge(
+        indices=indices,
+        values=values,
+        shape=(-(-edge.shape[0] // 2), -(-edge.shape[1] // 2)),
+    )
+
+
+def get_edge(size):
+    """ Return edge around a grid of square voids with random values. """
+    # each void of 6 x 6 pixels in a cell of 8 x 8 pixels has 28 edge pixels
+    side = max(1, int((size / 28) ** 0.5))
+    cell = np.zeros((8, 8), dtype='b1')
+    cell[1:-1, 1:-1] = True
+    void = np.tile(cell, (side, side))
+    edge = void ^ ndimage.binary_dilation(void)
+    indices = edge.nonzero()
+    values = np.random.RandomState(0).random_sample(void.shape).astype('f4')
+    return edges.Edge(
+        indices=indices,
+        values=values[indices],
+        shape=void.shape,
+    )
 
 
 class TestFillNoData(unittest.TestCase):
@@ -112,3 +149,137 @@ class TestFillNoData(unittest.TestCase):
         sys.argv = argv
         fill.exists = exists
         os.makedirs = makedirs
+
+
+class TestFillModes(unittest.TestCase):
+    def setUp(self):
+        # smooth source with voids of various sizes
+        random_state = np.random.RandomState(0)
+        shape = 64, 96
+        fillvalue = np.finfo('f4').max.item()
+        sample = random_state.random_sample(shape)
+        source = ndimage.uniform_filter(sample, 5).astype('f4')
+        void = ndimage.binary_opening(random_state.random_sample(shape) < 0.4)
+        source[void] = fillvalue
+
+        self.source_path = '/vsimem/workers/source.tif'
+        kwargs = {
+            'geo_transform': (200000, 1, 0, 400064, 0, -1),
+            'no_data_value': fillvalue,
+            'projection': osr.GetUserInputAsWKT('EPSG:28992'),
+        }
+        with datasets.Dataset(source[np.newaxis], **kwargs) as dataset:
+            gdal.GetDriverByName('GTiff').CreateCopy(self.source_path, dataset)
+
+    def test_workers(self):
+        arrays = []
+        with mock.patch.object(fill, 'exists', gdal.VSIStatL), \
+                mock.patch.object(fill, 'progress', False), \
+                mock.patch.object(os, 'makedirs'):
+            for workers in 1, 3:
+                target_path = '/vsimem/workers/target%s.tif' % workers
+                fill.fillnodata(
+                    source_path=self.source_path,
+                    target_path=target_path,
+                    clip_path=None,
+                    decimals=None,
+                    workers=workers,
+                )
+                arrays.append(gdal.Open(target_path).ReadAsArray())
+        self.assertTrue(np.equal(*arrays).all())
+
+    def stream(self, clip_path):
+        """ Return in memory and streamed results. """
+        arrays = []
+        with mock.patch.object(fill, 'progress', False), \
+                mock.patch.object(fill, 'BLOCK_SIZE', 16), \
+                mock.patch.object(os, 'makedirs'):
+            # in memory
+            exchange = fill.Exchange(
+                self.source_path, '/vsimem/streaming/memory.tif',
+            )
+            if clip_path:
+                exchange.clip(clip_path)
+            for source, target, void in exchange:
+                fill.fill_void(source=source, target=target, void=void)
+            arrays.append(exchange.target)
+
+            # in tiles of 16 x 16 pixels
+            target_path = '/vsimem/streaming/tiles.tif'
+            exchange = fill.StreamingExchange(
+                self.source_path, target_path, memory=24000,
+            )
+            self.assertEqual(exchange.tile_size, 16)
+            if clip_path:
+                exchange.clip(clip_path)
+            try:
+                for source, target, void in exchange:
+                    fill.fill_void(source=source, target=target, void=void)
+                exchange.save()
+            finally:
+                exchange.close()
+            arrays.append(gdal.Open(target_path).ReadAsArray())
+            gdal.Unlink(target_path)
+        return arrays
+
+    def test_streaming(self):
+        self.assertTrue(np.equal(*self.stream(clip_path=None)).all())
+
+    def test_streaming_clip(self):
+        # two clip polygons, each within a few tiles
+        clip_path = '/vsimem/streaming/clip.geojson'
+        driver = ogr.GetDriverByName('GeoJSON')
+        data_source = driver.CreateDataSource(clip_path)
+        layer = data_source.CreateLayer('clip')
+        for wkt in ('POLYGON ((200005 400005, 200040 400005, 200040 400050,'
+                    ' 200005 400050, 200005 400005))',
+                    'POLYGON ((200050 400010, 200090 400010, 200070 400060,'
+                    ' 200050 400010))'):
+            feature = ogr.Feature(layer.GetLayerDefn())
+            feature.SetGeometry(ogr.CreateGeometryFromWkt(wkt))
+            layer.CreateFeature(feature)
+        data_source = None
+
+        memory, streamed = self.stream(clip_path=clip_path)
+        gdal.Unlink(clip_path)
+        self.assertTrue(np.equal(memory, streamed).all())
+
+        # the clip is in effect
+        unclipped, _ = self.stream(clip_path=None)
+        self.assertFalse(np.equal(memory, unclipped).all())
+
+
+class TestAggregated(unittest.TestCase):
+    def test_reference(self):
+        random_state = np.random.RandomState(0)
+        for shape in (1, 1), (1, 8), (7, 5), (32, 33):
+            # few distinct values to have many even count ties
+            mask = random_state.random_sample(shape) < 0.6
+            indices = mask.nonzero()
+            values = random_state.randint(0, 4, len(indices[0])) / 3
+            edge = edges.Edge(
+                indices=indices,
+                values=values.astype('f4'),
+                shape=shape,
+            )
+            expected = edge
+            for level in range(6):
+                edge = edge.aggregated()
+                expected = aggregated(expected)
+                self.assertTrue(np.array_equal(
+                    edge.toarray(), expected.toarray(),
+                ))
+
+    @unittest.skipUnless(BENCHMARK, 'set RASTER_TOOLS_BENCHMARK to run')
+    def test_benchmark(self):
+        for exponent in range(4, 8):
+            edge = get_edge(10 ** exponent)
+            results, timings = [], []
+            for function in aggregated, edges.Edge.aggregated:
+                start = time.perf_counter()
+                results.append(function(edge).toarray())
+                timings.append(time.perf_counter() - start)
+            self.assertTrue(np.array_equal(*results))
+            print('%s edge pixels: %.3fs (reference), %.3fs' % (
+                len(edge.values), *timings,
+            ))
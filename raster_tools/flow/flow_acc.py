@@ -8,11 +8,12 @@ import argparse
 import os
 
 from osgeo import gdal
+from scipy import ndimage
 import numpy as np
 
 from raster_tools import datasets
-from raster_tools import datasources
 from raster_tools import groups
+from raster_tools import scheduler
 
 
 GTIF = gdal.GetDriverByName(str('gtiff'))
@@ -25,6 +26,9 @@ INDICES = COURSES.nonzero()
 NUMBERS = COURSES[INDICES][np.newaxis, ...]
 OFFSETS = np.array(INDICES).transpose() - 1
 
+# below this number of cells a step is not worth vectorizing
+SERIAL = 64
+
 
 def get_traveled(courses):
     """ Return indices when travelling along courses. """
@@ -42,19 +46,16 @@ def get_traveled(courses):
     return tuple(target.transpose())             # return tuple
 
 
-def accumulate(direction):
+def get_flow(direction):
     """
-    Accumulate flow.
+    Return flow array.
 
-    The direction array values is used to derive a flow array. The flow
-    array relates the indices A of sources cells to the indices B of
-    target cells as B = flow[A].
-
-    The state array represents a a quantity of fluid. The size of the
-    array corresponds to the quantity of fluid, whereas the values
-    correspond to the locations of the fluid units.
+    The flow array relates the indices A of sources cells to the indices B
+    of target cells as B = flow[A]. Cells that flow nowhere, because their
+    direction is undefined, because they flow off the array or because they
+    flow towards a cell flowing back, have the size of the direction array
+    as target, which is also the last element of the flow array.
     """
-    # construct a mapping array for the flow
     size = direction.size
     height, width = direction.shape
     traveled = get_traveled(direction)
@@ -70,37 +71,132 @@ def accumulate(direction):
         traveled[1] >= width,      # ... right
     ]), size, traveled[0] * width + traveled[1])
 
-    # initial condition
-    state = np.arange(size)                       # each cell has a quantity
-    flow[:-1][flow[flow[state]] == state] = size  # eliminate opposing dirs
-    accumulation = np.zeros(size, 'u8')           # this contains the result
-
-    # run the flow until nothing changes anymore
-    while True:
-        state = flow[state]                           # flow the water
-        state.sort()                                  # sort
-        state = state[:np.searchsorted(state, size)]  # trim
-        left = state.size
-        if not left:
+    # eliminate opposing directions
+    cells = np.arange(size)
+    flow[:-1][flow[flow[cells]] == cells] = size
+    return flow
+
+
+def accumulate_serial(current, flow, total, sources):
+    """
+    Return remaining cells to process after processing cells one by one,
+    until there is enough work to be worth vectorizing again.
+    """
+    size = flow.size - 1
+    current = current.tolist()
+    while current and len(current) < SERIAL:
+        cell = current.pop()
+        target = flow[cell]
+        if target == size:
+            continue
+        total[target] += total[cell]
+        sources[target] -= 1
+        if not sources[target]:
+            current.append(target)
+    return np.array(current, dtype='i8')
+
+
+def accumulate_flow(flow, weight):
+    """
+    Return total per cell, including the cell's own weight.
+
+    :param flow: flow array, as returned by get_flow()
+    :param weight: quantity per cell
+
+    Cells are processed in topological order, starting with cells that
+    nothing flows into. In each step the totals of the current cells are
+    added to their targets, and the targets that received from all their
+    sources form the next step. Cells in flow cycles are never completed.
+    Steps with few cells are taken one cell at a time.
+    """
+    size = flow.size - 1
+    total = weight.copy()
+
+    # number of sources per cell
+    sources = np.bincount(flow[:size], minlength=size + 1)[:size]
+    current = (sources == 0).nonzero()[0]
+
+    while current.size:
+        # long single paths would take a vectorized step per cell
+        if current.size < SERIAL:
+            current = accumulate_serial(
+                current=current, flow=flow, total=total, sources=sources,
+            )
+            continue
+
+        # pass totals to targets within the array
+        target = flow[current]
+        inside = target < size
+        current, target = current[inside], target[inside]
+        if not target.size:
             break
-        current_quantity = np.bincount(state, minlength=size)
-        accumulation += current_quantity.astype('u8')
 
-    return accumulation.reshape(height, width)
+        # sum per target
+        order = np.argsort(target, kind='stable')
+        target = target[order]
+        start = np.flatnonzero(np.diff(target, prepend=-1))
+        received = target[start]
+        total[received] += np.add.reduceat(total[current[order]], start)
+
+        # targets with all sources completed are next
+        sources[received] -= np.diff(np.append(start, target.size))
+        current = received[sources[received] == 0]
+
+    return total
+
+
+def accumulate(direction, weights=None):
+    """
+    Accumulate flow.
+
+    :param direction: course encoded directions
+    :param weights: optional quantities per cell, for example rainfall,
+        otherwise each cell contributes one.
+    """
+    if weights is None:
+        weight = np.ones(direction.size, dtype='u8')
+    else:
+        weight = weights.astype('f8').ravel()
+    total = accumulate_flow(flow=get_flow(direction), weight=weight)
+    return (total - weight).reshape(direction.shape)
+
+
+def get_outlets(flow):
+    """
+    Return for each cell the last cell on its path, or -1 for cells that
+    end up in a cycle.
+    """
+    size = flow.size - 1
+    cells = np.arange(size)
+    up = np.where(flow[:size] == size, cells, flow[:size])
+
+    # pointer jumping, doubling the length of the jumps every time
+    for _ in range(size.bit_length() + 1):
+        upup = up[up]
+        if np.array_equal(upup, up):
+            break
+        up = upup
+    return np.where(flow[up] == size, up, -1)
 
 
 class Accumulator(object):
-    def __init__(self, raster_path, output_path):
+    def __init__(self, raster_path, output_path, weights_path=None):
         # paths and source data
         self.output_path = output_path
-        self.raster_group = groups.Group(gdal.Open(raster_path))
+        self.raster_group = groups.Group(gdal.Open(raster_path),
+                                         cache_size=groups.CACHE_SIZE)
+        if weights_path is None:
+            self.weights_group = None
+        else:
+            self.weights_group = groups.Group(gdal.Open(weights_path),
+                                              cache_size=groups.CACHE_SIZE)
 
         # geospatial reference
         self.geo_transform = self.raster_group.geo_transform
         self.projection = self.raster_group.projection
 
-    def accumulate(self, feature):
-        # target path
+    def _get_path(self, feature):
+        """ Return target path, or None if it already exists. """
         name = feature[str('name')]
         path = os.path.join(self.output_path,
                             name[:3],
@@ -114,6 +210,33 @@ class Accumulator(object):
         except OSError:
             pass  # no problem
 
+        return path
+
+    def _read_weights(self, bounds):
+        """ Return weights or None. """
+        if self.weights_group is None:
+            return
+        weights = self.weights_group.read(bounds)
+        weights[weights == self.weights_group.no_data_value] = 0
+        return weights
+
+    def _save(self, path, accu, geo_transform):
+        """ Save accumulation on a logarithmic scale. """
+        acculog = np.log10(accu[np.newaxis] + 1).astype('f4')
+
+        options = ['compress=deflate', 'tiled=yes']
+        kwargs = {'projection': self.projection,
+                  'geo_transform': geo_transform,
+                  'no_data_value': np.finfo(acculog.dtype).min.item()}
+
+        with datasets.Dataset(acculog, **kwargs) as dataset:
+            GTIF.CreateCopy(path, dataset, options=options)
+
+    def accumulate(self, feature):
+        path = self._get_path(feature)
+        if path is None:
+            return
+
         # geometries
         inner_geometry = feature.geometry()
         outer_geometry = inner_geometry.Buffer(50)
@@ -124,36 +247,241 @@ class Accumulator(object):
 
         # data
         direction = self.raster_group.read(outer_geometry)
+        weights = self._read_weights(outer_geometry)
 
         # processing
-        accu = accumulate(direction)
+        accu = accumulate(direction=direction, weights=weights)
 
-        # cut out and convert
+        # cut out and save
         slices = outer_geo_transform.get_slices(inner_geometry)
-        acculog = np.log10(accu[slices][np.newaxis] + 1).astype('f4')
+        self._save(path=path,
+                   accu=accu[slices],
+                   geo_transform=inner_geo_transform)
 
-        # save
-        options = ['compress=deflate', 'tiled=yes']
-        kwargs = {'projection': self.projection,
-                  'geo_transform': inner_geo_transform,
-                  'no_data_value': np.finfo(acculog.dtype).min.item()}
 
-        with datasets.Dataset(acculog, **kwargs) as dataset:
-            GTIF.CreateCopy(path, dataset, options=options)
+class SeamlessAccumulator(Accumulator):
+    """
+    Accumulate across tile boundaries, without buffers.
 
+    Each tile is read with a halo of one cell, to know where flow leaves the
+    tile and where it enters from neighbouring tiles. In a first pass, scan()
+    returns for each tile the totals leaving via its exits, and for its
+    border cells the exit they flow to. The exits of all tiles form a graph
+    that is accumulated in the main process. In a second pass, inject()
+    adds the resulting inflows to the tile and saves it.
 
-def flow_acc(index_path, part, **kwargs):
+    The tiles in the index must not overlap.
     """
+    def __init__(self, inflow_path=None, **kwargs):
+        """
+        :param inflow_path: npz file with cells and inflows, for inject()
+        """
+        super().__init__(**kwargs)
+        if inflow_path is None:
+            self.inflow = None
+        else:
+            with np.load(inflow_path) as inflow:
+                self.inflow = inflow['cells'], inflow['values']
+
+    def _prepare(self, feature):
+        """
+        Return dictionary with the flow within the tile and its neighbours.
+        """
+        x1, y1, x2, y2 = self.geo_transform.get_indices(feature.geometry())
+        bounds = x1 - 1, y1 - 1, x2 + 1, y2 + 1
+        direction = self.raster_group.read(bounds)
+        weights = self._read_weights(bounds)
+
+        # global cell numbers, -1 outside the raster
+        width, height = self.raster_group.width, self.raster_group.height
+        rows = np.arange(y1 - 1, y2 + 1)[:, np.newaxis]
+        cols = np.arange(x1 - 1, x2 + 1)[np.newaxis, :]
+        cells = np.where(
+            (rows >= 0) & (rows < height) & (cols >= 0) & (cols < width),
+            rows * width + cols,
+            -1,
+        ).ravel()
+
+        # the halo includes neighbours for eliminating opposing directions
+        flow = get_flow(direction)
+        size = direction.size
+        inner = np.zeros(direction.shape, dtype='b1')
+        inner[1:-1, 1:-1] = True
+        border = inner ^ ndimage.binary_erosion(inner)
+        inner, border = inner.ravel(), border.ravel()
+
+        # flow leaving the tile ends in exits, halo cells do not flow
+        target = flow[:size]
+        exits = (inner & (target < size)).nonzero()[0]
+        exits = exits[~inner[target[exits]]]
+        targets = cells[target[exits]]
+        exits, targets = exits[targets >= 0], targets[targets >= 0]
+        flow[:size][~inner] = size
+        flow[exits] = size
+
+        # weight, zero for the halo
+        if weights is None:
+            weight = inner.astype('u8')
+        else:
+            weight = np.where(inner, weights.astype('f8').ravel(), 0)
+
+        return {
+            'flow': flow,
+            'cells': cells,
+            'exits': exits,
+            'border': border.nonzero()[0],
+            'weight': weight,
+            'targets': targets,
+            'slices': (slice(1, -1), slice(1, -1)),
+            'shape': direction.shape,
+        }
+
+    def scan(self, feature):
+        """
+        Return totals leaving the tile and the exits of the border cells.
+        """
+        prepared = self._prepare(feature)
+        flow, cells = prepared['flow'], prepared['cells']
+        exits, border = prepared['exits'], prepared['border']
+
+        total = accumulate_flow(flow=flow, weight=prepared['weight'])
+
+        # the exit where the flow from each border cell leaves the tile
+        outlets = get_outlets(flow)[border]
+        is_exit = np.zeros(flow.size, dtype='b1')
+        is_exit[exits] = True
+        outlets = np.where(
+            (outlets >= 0) & is_exit[outlets], cells[outlets], -1,
+        )
+
+        return {
+            'exits': cells[exits],
+            'targets': prepared['targets'],
+            'totals': total[exits],
+            'border': cells[border],
+            'outlets': outlets,
+        }
+
+    def inject(self, feature):
+        """ Accumulate with the inflows from the neighbouring tiles. """
+        path = self._get_path(feature)
+        if path is None:
+            return
+
+        prepared = self._prepare(feature)
+        weight = prepared['weight']
+
+        # inflows at the border cells
+        inflow = np.zeros_like(weight)
+        cells, values = self.inflow
+        border = prepared['border']
+        if cells.size:
+            index = np.minimum(
+                np.searchsorted(cells, prepared['cells'][border]),
+                cells.size - 1,
+            )
+            found = cells[index] == prepared['cells'][border]
+            inflow[border[found]] = values[index[found]]
+
+        total = accumulate_flow(flow=prepared['flow'], weight=weight + inflow)
+        accu = (total - weight).reshape(prepared['shape'])
+        self._save(
+            path=path,
+            accu=accu[prepared['slices']],
+            geo_transform=self.geo_transform.shifted(feature.geometry()),
+        )
+
+
+def accumulate_exits(scans):
+    """
+    Return cells and inflows into those cells from neighbouring tiles.
+
+    :param scans: results of SeamlessAccumulator.scan()
     """
-    # select some or all polygons
-    index = datasources.PartialDataSource(index_path)
-    if part is not None:
-        index = index.select(part)
+    def concatenate(key):
+        return np.concatenate([scan[key] for scan in scans])
+
+    exits, targets, totals = map(concatenate, ('exits', 'targets', 'totals'))
+    border, outlets = concatenate('border'), concatenate('outlets')
+    if not exits.size:
+        return targets, totals
+
+    # the exit that the flow from each exit reaches next
+    order = np.argsort(border)
+    border, outlets = border[order], outlets[order]
+    index = np.minimum(np.searchsorted(border, targets), border.size - 1)
+    outlet = np.where(border[index] == targets, outlets[index], -1)
+
+    order = np.argsort(exits)
+    exits, targets, totals = exits[order], targets[order], totals[order]
+    outlet = outlet[order]
+    size = exits.size
+    index = np.minimum(np.searchsorted(exits, outlet), size - 1)
+    flow = np.append(np.where(exits[index] == outlet, index, size), size)
+
+    # the totals per exit include all the inflows, sum them per target
+    total = accumulate_flow(flow=flow, weight=totals)
+    cells, inverse = np.unique(targets, return_inverse=True)
+    values = np.zeros(cells.size, dtype=total.dtype)
+    np.add.at(values, inverse, total)
+    return cells, values
+
+
+def flow_acc(index_path, part, workers, seamless, **kwargs):
+    """
+    """
+    if seamless:
+        return flow_acc_seamless(
+            index_path=index_path, part=part, workers=workers, **kwargs
+        )
+
+    # select some or all polygons and accumulate them using workers
+    scheduler.Scheduler(
+        index_path=index_path,
+        factory=Accumulator,
+        method='accumulate',
+        part=part,
+        workers=workers,
+        ordered=False,
+        **kwargs,
+    ).run()
+    return 0
 
-    accumulator = Accumulator(**kwargs)
 
-    for feature in index:
-        accumulator.accumulate(feature)
+def flow_acc_seamless(index_path, part, workers, output_path, **kwargs):
+    """
+    Accumulate across tiles. All tiles are scanned, but only the selected
+    part is saved.
+    """
+    kwargs.update(output_path=output_path)
+    scans = [scan for feature, scan in scheduler.Scheduler(
+        index_path=index_path,
+        factory=SeamlessAccumulator,
+        method='scan',
+        workers=workers,
+        ordered=False,
+        **kwargs,
+    )]
+
+    # exchange the flow between the tiles
+    cells, values = accumulate_exits(scans)
+    os.makedirs(output_path, exist_ok=True)
+    inflow_path = os.path.join(output_path, 'inflow.npz')
+    np.savez(inflow_path, cells=cells, values=values)
+
+    try:
+        scheduler.Scheduler(
+            index_path=index_path,
+            factory=SeamlessAccumulator,
+            method='inject',
+            part=part,
+            workers=workers,
+            ordered=False,
+            inflow_path=inflow_path,
+            **kwargs,
+        ).run()
+    finally:
+        os.remove(inflow_path)
     return 0
 
 
@@ -186,6 +514,23 @@ def get_parser():
         '-p', '--part',
         help='partial processing source, for example "2/3"',
     )
+    parser.add_argument(
+        '-w', '--workers',
+        type=int,
+        default=1,
+        help='number of worker processes, 0 for one per cpu',
+    )
+    parser.add_argument(
+        '-W', '--weights',
+        dest='weights_path',
+        help='raster with quantities to accumulate instead of cell counts',
+    )
+    parser.add_argument(
+        '-s', '--seamless',
+        action='store_true',
+        help=('exchange flow between tiles instead of reading buffers, '
+              'the tiles must not overlap'),
+    )
     return parser
 
 
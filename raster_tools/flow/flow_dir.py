@@ -12,8 +12,8 @@ from scipy import ndimage
 import numpy as np
 
 from raster_tools import datasets
-from raster_tools import datasources
 from raster_tools import groups
+from raster_tools import scheduler
 
 GTIF = gdal.GetDriverByName('gtiff')
 DTYPE = np.dtype('i8, i8')
@@ -74,37 +74,90 @@ def get_traveled(indices, courses, unique):
     return tuple(target.transpose())                           # return tuple
 
 
+def get_drops(values):
+    """
+    Return generator of (index, drop) tuples per neighbour.
+
+    The drops are calculated in double precision and then cast to the
+    datatype of values, with reflection at the edges, as correlating with a
+    two element kernel would do.
+    """
+    height, width = values.shape
+    padded = np.pad(values.astype('f8'), 1, mode='symmetric')
+    center = padded[1:-1, 1:-1]
+    for index, ((i, j), weight) in enumerate(zip(OFFSETS[0], WEIGHTS[0])):
+        other = padded[1 + i:1 + i + height, 1 + j:1 + j + width]
+        drop = weight * center - weight * other
+        yield index, drop.astype(values.dtype)
+
+
+def resolve_flats(direction):
+    """
+    Resolve multiple directions of zero drop cells in-place.
+
+    Starting from the defined cells, undefined cells are resolved in rings,
+    each towards a defined neighbour in one of its directions that does not
+    point back. Each ring only visits the neighbours of the previous ring.
+    Directions that can not be resolved are set to zero.
+    """
+    height, width = direction.shape
+    defined = np.zeros(256, dtype='b1')
+    defined[NUMBERS] = True
+
+    # start with the defined cells that neighbour undefined cells
+    undefined = ~defined[direction]
+    dilated = ndimage.binary_dilation(undefined, structure=np.ones((3, 3)))
+    ring = (dilated & ~undefined).nonzero()
+
+    pending = np.zeros_like(direction)
+    while ring[0].size:
+        # candidates that have a ring cell in the neighbour direction, where
+        # the lowest direction index is preferred, so it is written last
+        candidates = []
+        for (i, j), number, inverse in reversed(list(zip(
+                OFFSETS[0], NUMBERS[0], INVERSE[0]))):
+            ci, cj = ring[0] - i, ring[1] - j
+            inside = (ci >= 0) & (ci < height) & (cj >= 0) & (cj < width)
+            ci, cj = ci[inside], cj[inside]
+            valid = (undefined[ci, cj]
+                     & (direction[ci, cj] & number).astype('b1')
+                     & (direction[ring[0][inside], ring[1][inside]]
+                        != inverse))
+            ci, cj = ci[valid], cj[valid]
+            pending[ci, cj] = number
+            candidates.append(ci * width + cj)
+
+        # the resolved candidates form the next ring
+        resolved = np.unique(np.concatenate(candidates))
+        ring = np.unravel_index(resolved, direction.shape)
+        direction[ring] = pending[ring]
+        undefined[ring] = False
+
+    direction[undefined] = 0
+
+
 def calculate_flow_direction(values):
     """
     Single neighbour: Encode directly
     Multiple neighbours:
-    - Zero drop: Resolve later, iteratively
+    - Zero drop: Resolve later, ring by ring
     - Nonzero drop: Resolve immediately using look-up table
     """
     # output
     direction = np.zeros_like(values, dtype='u1')
-
-    # calculation of drop per neighbour cell
-    factor = np.zeros((3, 3))
-    factor[INDICES] = WEIGHTS[0]
-
     best_drop = np.zeros_like(values)
 
     # assign directions based on zero or positive drops
-    for i, j in zip(*factor.nonzero()):
-        kernel = np.zeros((3, 3))
-        kernel[i, j] = -factor[i, j]
-        kernel[1, 1] = +factor[i, j]
-
-        this_drop = ndimage.correlate(values, kernel)
+    for index, this_drop in get_drops(values):
+        number = NUMBERS[0, index]
 
         # same drops add to the direction
         same_drop = (this_drop == best_drop)
-        direction[same_drop] += COURSES[i, j]
+        direction[same_drop] += number
 
         # better drops replace the direction
         more_drop = this_drop > best_drop
-        direction[more_drop] = COURSES[i, j]
+        direction[more_drop] = number
         best_drop[more_drop] = this_drop[more_drop]
 
     # use look-up-table to eliminate multi-directions for positive drops:
@@ -122,39 +175,31 @@ def calculate_flow_direction(values):
     direction[0, 0] = 64
     direction[0, 1:-1] = 128
 
-    # iterate to solve undefined directions where possible
-    kwargs = {'structure': np.ones((3, 3))}
-
-    while True:
-        undefined = ~np.in1d(direction, NUMBERS).reshape(direction.shape)
-        edges = undefined ^ ndimage.binary_erosion(undefined, **kwargs)
-
-        t_index1 = edges.nonzero()
-        direction1 = direction[t_index1][:, np.newaxis]
+    # solve undefined directions where possible
+    resolve_flats(direction)
+    return direction
 
-        # find neighbour values
-        t_index8 = get_neighbours(t_index1)
-        direction8 = direction[t_index8].reshape(-1, 8)
 
-        # neighbour must be in encoded direction
-        b_index8a = np.bool8(direction1 & NUMBERS)
-        # neighbour must have a defined flow direction
-        b_index8b = np.in1d(direction8, NUMBERS).reshape(b_index8a.shape)
-        # that direction must not point towards the cell to be defined
-        b_index8c = direction8 != INVERSE
-        # combined index
-        b_index8 = np.logical_and.reduce([b_index8a, b_index8b, b_index8c])
+def calculate_tile(values, cover):
+    """
+    Return flow direction, using the landcover to make water and buildings
+    undefined. Beware that buildings are raised in values.
+    """
+    # set buildings to maximum dem before calculating directions
+    maximum = np.finfo(values.dtype).max
+    building = np.logical_and(cover > 1, cover < 15)
+    values[building] = maximum
 
-        if not b_index8.any():
-            break
+    # processing
+    direction = calculate_flow_direction(values)
 
-        argmax = np.argmax(b_index8, axis=1)
-        nonzero = b_index8.any(axis=1)
-        superindex = tuple([t_index1[0][nonzero], t_index1[1][nonzero]])
-        direction[superindex] = NUMBERS[0, argmax[nonzero]]
+    # make water undefined
+    water = np.zeros_like(cover, dtype='b1')
+    water.ravel()[:] = np.in1d(cover, (50, 51, 52, 156, 254))
+    direction[water] = 0
 
-    # set still undefined directions (complex depressions) to zero
-    direction[~np.in1d(direction, NUMBERS).reshape(direction.shape)] = 0
+    # make buildings undefined
+    direction[building] = 0
     return direction
 
 
@@ -162,8 +207,10 @@ class DirectionCalculator(object):
     def __init__(self, output_path, raster_path, cover_path):
         # paths and source data
         self.output_path = output_path
-        self.raster_group = groups.Group(gdal.Open(raster_path))
-        self.cover_group = groups.Group(gdal.Open(cover_path))
+        self.raster_group = groups.Group(gdal.Open(raster_path),
+                                         cache_size=groups.CACHE_SIZE)
+        self.cover_group = groups.Group(gdal.Open(cover_path),
+                                        cache_size=groups.CACHE_SIZE)
 
         # geospatial reference
         self.geo_transform = self.raster_group.geo_transform
@@ -195,21 +242,8 @@ class DirectionCalculator(object):
         values = self.raster_group.read(outer_geometry)
         cover = self.cover_group.read(outer_geometry)
 
-        # set buildings to maximum dem before calculating directions
-        maximum = np.finfo(values.dtype).max
-        building = np.logical_and(cover > 1, cover < 15)
-        values[building] = maximum
-
         # processing
-        direction = calculate_flow_direction(values)
-
-        # make water undefined
-        water = np.zeros_like(cover, dtype='b1')
-        water.ravel()[:] = np.in1d(cover, (50, 51, 52, 156, 254))
-        direction[water] = 0
-
-        # make buildings undefined
-        direction[building] = 0
+        direction = calculate_tile(values=values, cover=cover)
 
         # cut out
         slices = outer_geo_transform.get_slices(inner_geometry)
@@ -225,18 +259,19 @@ class DirectionCalculator(object):
             GTIF.CreateCopy(path, dataset, options=options)
 
 
-def flow_dir(index_path, part, **kwargs):
+def flow_dir(index_path, part, workers, **kwargs):
     """
     """
-    # select some or all polygons
-    index = datasources.PartialDataSource(index_path)
-    if part is not None:
-        index = index.select(part)
-
-    calculator = DirectionCalculator(**kwargs)
-
-    for feature in index:
-        calculator.calculate(feature)
+    # select some or all polygons and calculate them using workers
+    scheduler.Scheduler(
+        index_path=index_path,
+        factory=DirectionCalculator,
+        method='calculate',
+        part=part,
+        workers=workers,
+        ordered=False,
+        **kwargs,
+    ).run()
     return 0
 
 
@@ -274,6 +309,12 @@ def get_parser():
         '-p', '--part',
         help='partial processing source, for example "2/3"',
     )
+    parser.add_argument(
+        '-w', '--workers',
+        type=int,
+        default=1,
+        help='number of worker processes, 0 for one per cpu',
+    )
     return parser
 
 
@@ -13,11 +13,13 @@ import os
 
 from osgeo import gdal
 from scipy import ndimage
+from scipy import sparse
+from scipy.sparse import csgraph
 import numpy as np
 
 from raster_tools import datasets
-from raster_tools import datasources
 from raster_tools import groups
+from raster_tools import scheduler
 
 GTIF = gdal.GetDriverByName('gtiff')
 DTYPE = np.dtype('i8, i8')
@@ -30,6 +32,17 @@ INDICES = COURSES.nonzero()
 NUMBERS = COURSES[INDICES][np.newaxis, ...]
 OFFSETS = np.array(INDICES).transpose()[np.newaxis] - 1
 
+# slices to pair each cell with its east, south, south-east and south-west
+# neighbours, covering each of the eight neighbour relations once
+NEIGHBOURS = (
+    ((slice(None), slice(None, -1)), (slice(None), slice(1, None))),
+    ((slice(None, -1), slice(None)), (slice(1, None), slice(None))),
+    ((slice(None, -1), slice(None, -1)), (slice(1, None), slice(1, None))),
+    ((slice(None, -1), slice(1, None)), (slice(1, None), slice(None, -1))),
+)
+
+ENGINES = 'contour', 'flood'
+
 
 def fill_simple_depressions(values):
     """ Fill simple depressions in-place. """
@@ -185,19 +198,115 @@ def fill_complex_depressions(values, mask=None):
     # _fill_complex_depressions(values=values, mask=mask, unique=True)
 
 
+def fill_depressions(values, mask=None):
+    """
+    Fill all depressions in-place, with the same result as a priority-flood
+    from the edges and the masked cells.
+
+    :param values: DEM values
+    :param mask: cells defined as not-in-a-depression
+
+    Each cell is raised to the lowest level at which water can leave via
+    8-connected cells, which is the largest edge on the path to the outside
+    in a minimum spanning tree with edges weighted by the higher of the
+    values of the cells they connect. Cells at the maximum value of the
+    datatype (the buildings) are walls, and depressions surrounded by walls
+    are not filled.
+    """
+    maximum = np.finfo(values.dtype).max
+    wall = values == maximum
+
+    # ranks are used as weights, because zero weights mean no edge
+    levels, ranks = np.unique(values, return_inverse=True)
+    ranks = ranks.reshape(values.shape) + 1
+
+    # graph of the cells, with an extra node for the outside
+    size = values.size
+    number = np.arange(size).reshape(values.shape)
+    rows, cols, data = [], [], []
+    for slices1, slices2 in NEIGHBOURS:
+        active = ~(wall[slices1] | wall[slices2])
+        rows.append(number[slices1][active])
+        cols.append(number[slices2][active])
+        data.append(np.maximum(ranks[slices1], ranks[slices2])[active])
+
+    outside = np.zeros(values.shape, dtype='b1')
+    outside[0] = outside[-1] = outside[:, 0] = outside[:, -1] = True
+    if mask is not None:
+        outside |= mask
+    outside &= ~wall
+    rows.append(number[outside])
+    cols.append(np.full(np.count_nonzero(outside), size))
+    data.append(ranks[outside])
+
+    graph = sparse.coo_matrix(
+        (np.concatenate(data), (np.concatenate(rows), np.concatenate(cols))),
+        shape=(size + 1, size + 1),
+    ).tocsr()
+
+    # the predecessors in the tree lead to the outside
+    tree = csgraph.minimum_spanning_tree(graph)
+    _, up = csgraph.breadth_first_order(
+        tree, size, directed=False, return_predecessors=True,
+    )
+    ranks = np.append(ranks.ravel(), 0)
+    unreached = up < 0
+    up[unreached] = np.arange(size + 1)[unreached]
+    up[size] = size
+
+    # pointer jumping, keeping the largest edge between a cell and up
+    level = np.maximum(ranks, ranks[up])
+    while True:
+        upup = up[up]
+        if np.array_equal(upup, up):
+            break
+        level = np.maximum(level, level[up])
+        up = upup
+
+    values[...] = levels[level[:size] - 1].reshape(values.shape)
+
+
+def fill_tile(values, cover, engine='contour'):
+    """
+    Fill depressions in-place, using the landcover to treat water as
+    not-in-a-depression and buildings as walls.
+    """
+    # create mask where cover refers to water
+    mask = np.zeros_like(cover, dtype='b1')
+    mask.ravel()[:] = np.in1d(cover, (50, 51, 52, 156, 254))
+
+    # set buildings to maximum dem before directions
+    building = np.logical_and(cover > 1, cover < 15)
+    maximum = np.finfo(values.dtype).max
+    original = values[building]
+    values[building] = maximum
+
+    # processing
+    if engine == 'flood':
+        fill_depressions(values=values, mask=mask)
+    else:
+        fill_simple_depressions(values)
+        fill_complex_depressions(values=values, mask=mask)
+
+    # put buildings back in place
+    values[building] = original
+
+
 class PitFiller(object):
-    def __init__(self, output_path, raster_path, cover_path):
+    def __init__(self, output_path, raster_path, cover_path,
+                 engine='contour'):
         # paths and source data
         self.output_path = output_path
+        self.engine = engine
 
-        # rasters
+        # rasters, only the intersecting ones are read from a directory
         if os.path.isdir(raster_path):
-            raster_datasets = [gdal.Open(os.path.join(raster_path, path))
-                               for path in sorted(os.listdir(raster_path))]
+            self.raster_group = groups.IndexedGroup.from_path(raster_path)
         else:
-            raster_datasets = [gdal.Open(raster_path)]
-        self.raster_group = groups.Group(*raster_datasets)
-        self.cover_group = groups.Group(gdal.Open(cover_path))
+            self.raster_group = groups.Group(gdal.Open(raster_path),
+                                             cache_size=groups.CACHE_SIZE)
+        self.cover_group = groups.Group(gdal.Open(cover_path),
+                                        cache_size=groups.CACHE_SIZE)
 
         # properties
         self.projection = self.raster_group.projection
@@ -231,22 +340,8 @@ class PitFiller(object):
         values = self.raster_group.read(outer_geometry)
         cover = self.cover_group.read(outer_geometry)
 
-        # create mask where cover refers to water
-        mask = np.zeros_like(cover, dtype='b1')
-        mask.ravel()[:] = np.in1d(cover, (50, 51, 52, 156, 254))
-
-        # set buildings to maximum dem before directions
-        building = np.logical_and(cover > 1, cover < 15)
-        maximum = np.finfo(values.dtype).max
-        original = values[building]
-        values[building] = maximum
-
         # processing
-        fill_simple_depressions(values)
-        fill_complex_depressions(values=values, mask=mask)
-
-        # put buildings back in place
-        values[building] = original
+        fill_tile(values=values, cover=cover, engine=self.engine)
 
         # cut out
         slices = outer_geo_transform.get_slices(inner_geometry)
@@ -262,18 +357,19 @@ class PitFiller(object):
             GTIF.CreateCopy(path, dataset, options=options)
 
 
-def fillpits(index_path, part, **kwargs):
+def fillpits(index_path, part, workers, **kwargs):
     """
     """
-    # select some or all polygons
-    index = datasources.PartialDataSource(index_path)
-    if part is not None:
-        index = index.select(part)
-
-    pit_filler = PitFiller(**kwargs)
-
-    for feature in index:
-        pit_filler.fill(feature)
+    # select some or all polygons and fill them using workers
+    scheduler.Scheduler(
+        index_path=index_path,
+        factory=PitFiller,
+        method='fill',
+        part=part,
+        workers=workers,
+        ordered=False,
+        **kwargs,
+    ).run()
     return 0
 
 
@@ -311,6 +407,19 @@ def get_parser():
         '-p', '--part',
         help='partial processing source, for example "2/3"',
     )
+    parser.add_argument(
+        '-w', '--workers',
+        type=int,
+        default=1,
+        help='number of worker processes, 0 for one per cpu',
+    )
+    parser.add_argument(
+        '-e', '--engine',
+        choices=ENGINES,
+        default=ENGINES[0],
+        help=('"contour" fills in overlapping blocks of 100 x 100 cells, '
+              '"flood" fills all depressions in the buffered tile at once'),
+    )
     return parser
 
 
@@ -2,7 +2,7 @@
 
 # (c) Nelen & Schuurmans, see LICENSE.rst.
 """
-Vectorize flow.
+Rasterize vectorized flow.
 """
 
 import argparse
@@ -14,23 +14,86 @@ from osgeo import osr
 import numpy as np
 
 from raster_tools import datasets
-from raster_tools import datasources
+from raster_tools import scheduler
+from raster_tools import vectors
+
+from raster_tools.flow import flow_vec
 
 
 GTIF = gdal.GetDriverByName('gtiff')
+MEMORY = ogr.GetDriverByName('Memory')
 OPTIONS = ['compress=deflate', 'tiled=yes']
+PROJECTION = osr.GetUserInputAsWKT('epsg:28992')
+CELLSIZE = 0.5 / 3
+
+# raster values for the classes of vectorized flow
+VALUES = {lower: value
+          for value, (lower, upper) in enumerate(flow_vec.CLASSES, 2)}
 
 
 def get_geo_transform(geometry):
     """ Return geotransform. """
-    a, b, c, d = 0.5 / 3, 0.0, 0.0, -0.5 / 3
+    a, b, c, d = CELLSIZE, 0.0, 0.0, -CELLSIZE
     x1, x2, y1, y2 = geometry.GetEnvelope()
     return x1, a, b, y2, c, d
 
 
+def get_shape(geometry):
+    """ Return array shape to cover the envelope of geometry. """
+    x1, x2, y1, y2 = geometry.GetEnvelope()
+    return 1, round((y2 - y1) / CELLSIZE), round((x2 - x1) / CELLSIZE)
+
+
+def burn(shapes, geometry):
+    """
+    Return array with shapes burned in, covering the envelope of geometry.
+
+    :param shapes: iterable of (value, geometry) tuples
+    """
+    # a memory layer in order of value, so that higher values end on top
+    data_source = MEMORY.CreateDataSource('')
+    layer = data_source.CreateLayer('', osr.SpatialReference(PROJECTION))
+    layer.CreateField(ogr.FieldDefn('value', ogr.OFTInteger))
+    layer_defn = layer.GetLayerDefn()
+    for value, shape in sorted(shapes, key=lambda s: s[0]):
+        feature = ogr.Feature(layer_defn)
+        feature['value'] = value
+        feature.SetGeometry(shape)
+        layer.CreateFeature(feature)
+
+    # burn all values in a single pass
+    array = np.zeros(get_shape(geometry), 'u1')
+    kwargs = {'geo_transform': get_geo_transform(geometry),
+              'projection': PROJECTION}
+    with datasets.Dataset(array, **kwargs) as dataset:
+        gdal.RasterizeLayer(dataset, [1], layer, options=['ATTRIBUTE=value'])
+    return array
+
+
+def burn_lines(lines, geo_transform, geometry):
+    """
+    Return array with lines burned in, straight from vectorize.
+
+    :param lines: (class, indices) tuples, as generated by vectorize()
+    :param geo_transform: geo transform of the vectorized indices
+    """
+    shapes = ((VALUES[klass], vectors.array2linestring(
+        np.column_stack(geo_transform.get_coordinates(indices)),
+    )) for klass, indices in lines)
+    return burn(shapes=shapes, geometry=geometry)
+
+
+def save(path, array, geometry):
+    """ Save array covering the envelope of geometry as geotiff. """
+    kwargs = {'no_data_value': 0,
+              'geo_transform': get_geo_transform(geometry),
+              'projection': PROJECTION}
+    with datasets.Dataset(array, **kwargs) as dataset:
+        GTIF.CreateCopy(path, dataset, options=OPTIONS)
+
+
 def rasterize(feature, source_dir, target_dir):
     """ Rasterize streamline shape for a single tile into raster. """
-    geo_transform = get_geo_transform(feature.geometry())
     name = feature['name']
     partial_path = os.path.join(name[:3], name)
 
@@ -50,30 +113,38 @@ def rasterize(feature, source_dir, target_dir):
     data_source = ogr.Open(source_path)
     layer = data_source[0]
 
-    # create target array
-    kwargs = {'no_data_value': 0,
-              'geo_transform': geo_transform,
-              'array': np.zeros((1, 12500, 10000), 'u1'),
-              'projection': osr.GetUserInputAsWKT('epsg:28992')}
+    # rasterize and save
+    geometry = feature.geometry()
+    shapes = ((VALUES[f['class']], f.geometry().Clone()) for f in layer)
+    save(path=target_path,
+         array=burn(shapes=shapes, geometry=geometry),
+         geometry=geometry)
+
 
-    with datasets.Dataset(**kwargs) as dataset:
-        for value, attribute in enumerate([2, 3, 4, 4.7], 2):
-            layer.SetAttributeFilter('class={}'.format(attribute))
-            gdal.RasterizeLayer(dataset, [1], layer, burn_values=[value])
+class Rasterizer(object):
+    def __init__(self, source_dir, target_dir):
+        self.source_dir = source_dir
+        self.target_dir = target_dir
 
-        GTIF.CreateCopy(target_path, dataset, options=OPTIONS)
+    def rasterize(self, feature):
+        rasterize(feature,
+                  source_dir=self.source_dir,
+                  target_dir=self.target_dir)
 
 
-def flow_rst(index_path, part, **kwargs):
+def flow_rst(index_path, part, workers, **kwargs):
     """
     """
-    # select some or all polygons
-    index = datasources.PartialDataSource(index_path)
-    if part is not None:
-        index = index.select(part)
-
-    for feature in index:
-        rasterize(feature, **kwargs)
+    # select some or all polygons and rasterize them using workers
+    scheduler.Scheduler(
+        index_path=index_path,
+        factory=Rasterizer,
+        method='rasterize',
+        part=part,
+        workers=workers,
+        ordered=False,
+        **kwargs,
+    ).run()
     return 0
 
 
@@ -101,6 +172,12 @@ def get_parser():
         '-p', '--part',
         help='partial processing source, for example "2/3"',
     )
+    parser.add_argument(
+        '-w', '--workers',
+        type=int,
+        default=1,
+        help='number of worker processes, 0 for one per cpu',
+    )
     return parser
 
 
@@ -14,7 +14,8 @@ from osgeo import osr
 import numpy as np
 
 from raster_tools import groups
-from raster_tools import datasources
+from raster_tools import scheduler
+from raster_tools import vectors
 
 
 SHAPE = ogr.GetDriverByName('esri shapefile')
@@ -32,20 +33,17 @@ CLASSES = ((2.0, 3.0),
            (4.7, 9.9))
 
 
+# offsets of the first matching course for any direction byte
+LOOKUP = OFFSETS[(np.arange(256)[:, np.newaxis] & NUMBERS != 0).argmax(1)]
+
+
 def get_traveled(courses):
     """ Return indices when travelling along courses. """
-    # turn indices into points array
     height, width = courses.shape
-    indices = (np.arange(height).repeat(width),
-               np.tile(np.arange(width), height))
-    points = np.array(indices).transpose()
-
-    # determine direction and apply offset
-    encode = courses[indices][:, np.newaxis]     # which codes
-    select = np.bool8(encode & NUMBERS)          # which courses
-    target = points + OFFSETS[select.argmax(1)]  # apply offsets
-
-    return tuple(target.transpose())             # return tuple
+    offsets = LOOKUP[courses]
+    rows = np.arange(height)[:, np.newaxis] + offsets[..., 0]
+    cols = np.arange(width)[np.newaxis, :] + offsets[..., 1]
+    return rows.ravel(), cols.ravel()
 
 
 def vectorize(direction, accumulation):
@@ -82,38 +80,84 @@ def vectorize(direction, accumulation):
         points = (np.logical_and(accumulation.ravel() < upper,
                                  accumulation.ravel() >= lower)).nonzero()[0]
 
-        # determine sources, merges and sinks
+        # determine sources, merges and sinks as masks, last one is outside
+        member = np.zeros(size + 1, dtype='b1')
+        member[points] = True
         flowed = flow[points]
         leaving = (flowed == size)
-        promoting = np.logical_and(~leaving,
-                                   np.in1d(flowed, points, invert=True))
-        bincount = np.bincount(flowed, minlength=size)[:-1]
+        promoting = np.logical_and(~leaving, ~member[flowed])
+        bincount = np.bincount(flowed, minlength=size + 1)
+        inflow = bincount[points]
 
-        sources = points[np.logical_and(
-            flowed != size,
-            np.in1d(points, flowed, invert=True),
-        )]
-        merges = np.intersect1d(points, np.where(bincount > 1)[0])
-        sinks = np.union1d(points[leaving], flowed[promoting])
+        merge = np.zeros_like(member)
+        merge[points[inflow > 1]] = True
+        sink = np.zeros_like(member)
+        sink[points[leaving]] = True
+        sink[flowed[promoting]] = True
 
         # determine starts and stops
-        starts = np.union1d(sources, merges)
-        stops = set(np.union1d(merges, sinks).tolist())  # native set
-
-        # travel them and yield per section
-        for x in starts:
-            if x in sinks:
-                continue
-            line = [x]
-            while True:
-                x = flow[x]
-                line.append(x)
-                if x in stops:
-                    break
-            a = np.array(line)
+        start = np.zeros_like(member)
+        start[points[np.logical_and(~leaving, inflow == 0)]] = True
+        start |= merge
+        start &= ~sink
+        stop = merge | sink
+
+        # cells passed between starts and stops have a single upstream point
+        passed = member & ~stop & ~start
+        links = passed[flowed]
+        tails, heads = points[links], flowed[links]
+
+        # link the segment members to their upstream member
+        members = points[(start | passed)[points]]
+        count = len(members)
+        if not count:
+            continue
+        root = np.arange(count)
+        root[np.searchsorted(members, heads)] = np.searchsorted(members,
+                                                                tails)
+        first = root == np.arange(count)
+        depth = (~first).astype('i8')
+
+        # pointer jumping to the start of the segment, counting the steps
+        for _ in range(count.bit_length()):
+            if first[root].all():
+                break
+            depth += depth[root]
+            root = root[root]
+
+        # sort by start and depth, members on closed loops are not traveled
+        keep = first[root]
+        order = np.lexsort((depth[keep], root[keep]))
+        cells, roots = members[keep][order], root[keep][order]
+
+        # yield per section, including the stop its last member flows to
+        bounds = np.flatnonzero(np.diff(roots)) + 1
+        ends = flow[cells[np.append(bounds, len(cells)) - 1]]
+        for section, end in zip(np.split(cells, bounds), ends):
+            a = np.append(section, end)
             yield lower, (a // width - 0.5, a % width - 0.5)  # pixel center
 
 
+def save(path, lines, geo_transform, projection):
+    """
+    Save lines as shapefile.
+
+    :param lines: (class, indices) tuples, as generated by vectorize()
+    """
+    data_source = SHAPE.CreateDataSource(path)
+    layer_sr = osr.SpatialReference(projection)
+    layer_name = os.path.basename(path)
+    layer = data_source.CreateLayer(layer_name, layer_sr)
+    layer.CreateField(ogr.FieldDefn('class', ogr.OFTReal))
+    layer_defn = layer.GetLayerDefn()
+    for klass, indices in lines:
+        feature = ogr.Feature(layer_defn)
+        points = np.column_stack(geo_transform.get_coordinates(indices))
+        feature['class'] = klass
+        feature.SetGeometry(vectors.array2linestring(points))
+        layer.CreateFeature(feature)
+
+
 class Vectorizer(object):
     def __init__(self, direction_path, accumulation_path, target_path):
         # paths and source data
@@ -151,36 +195,25 @@ class Vectorizer(object):
         accumulation = self.accumulation_group.read(indices)
 
         # processing
-        data_source = SHAPE.CreateDataSource(path)
-        layer_sr = osr.SpatialReference(self.projection)
-        layer_name = os.path.basename(path)
-        layer = data_source.CreateLayer(layer_name, layer_sr)
-        layer.CreateField(ogr.FieldDefn('class', ogr.OFTReal))
-        layer_defn = layer.GetLayerDefn()
-        generator = vectorize(direction=direction, accumulation=accumulation)
-        for klass, indices in generator:
-            feature = ogr.Feature(layer_defn)
-            points = geo_transform.get_coordinates(indices)
-            feature['class'] = klass
-            geometry = ogr.Geometry(ogr.wkbLineString)
-            for p in zip(*points):
-                geometry.AddPoint_2D(*p)
-            feature.SetGeometry(geometry)
-            layer.CreateFeature(feature)
-
-
-def flow_vec(index_path, part, **kwargs):
-    """
-    """
-    # select some or all polygons
-    index = datasources.PartialDataSource(index_path)
-    if part is not None:
-        index = index.select(part)
+        save(path=path,
+             lines=vectorize(direction=direction, accumulation=accumulation),
+             geo_transform=geo_transform,
+             projection=self.projection)
 
-    vectorizer = Vectorizer(**kwargs)
 
-    for feature in index:
-        vectorizer.vectorize(feature)
+def flow_vec(index_path, part, workers, **kwargs):
+    """
+    """
+    # select some or all polygons and vectorize them using workers
+    scheduler.Scheduler(
+        index_path=index_path,
+        factory=Vectorizer,
+        method='vectorize',
+        part=part,
+        workers=workers,
+        ordered=False,
+        **kwargs,
+    ).run()
     return 0
 
 
@@ -213,6 +246,12 @@ def get_parser():
         '-p', '--part',
         help='partial processing source, for example "2/3"',
     )
+    parser.add_argument(
+        '-w', '--workers',
+        type=int,
+        default=1,
+        help='number of worker processes, 0 for one per cpu',
+    )
     return parser
 
 
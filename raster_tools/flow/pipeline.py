@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+# (c) Nelen & Schuurmans, see LICENSE.rst.
+"""
+Fill, direct, accumulate, vectorize and rasterize flow in a single pass
+per tile.
+
+The stages of flow-fil, flow-dir, flow-acc, flow-vec and flow-rst are
+chained in memory on the buffered tile, so that intermediate outputs only
+have to be written when they are requested. The time spent in each stage
+is reported at the end.
+
+Because every stage works on the buffer of the tile itself, results may
+differ slightly from the separate commands near the edge of the buffer,
+where those read the buffer from the outputs of neighbouring tiles.
+"""
+
+import argparse
+import collections
+import os
+
+from osgeo import gdal
+import numpy as np
+
+from raster_tools import datasets
+from raster_tools import groups
+from raster_tools import scheduler
+from raster_tools import utils
+
+from raster_tools.flow import flow_acc
+from raster_tools.flow import flow_dir
+from raster_tools.flow import flow_fil
+from raster_tools.flow import flow_rst
+from raster_tools.flow import flow_vec
+
+GTIF = gdal.GetDriverByName('gtiff')
+
+# outputs in order of the stages that produce them
+OUTPUTS = 'filled', 'direction', 'accumulation', 'vectors', 'streams'
+
+
+class Pipeline(object):
+    def __init__(self, raster_path, cover_path, output_path, outputs,
+                 engine='contour'):
+        # paths and source data
+        self.output_path = output_path
+        self.outputs = outputs
+        self.engine = engine
+
+        # rasters, only the intersecting ones are read from a directory
+        if os.path.isdir(raster_path):
+            self.raster_group = groups.IndexedGroup.from_path(raster_path)
+        else:
+            self.raster_group = groups.Group(gdal.Open(raster_path),
+                                             cache_size=groups.CACHE_SIZE)
+        self.cover_group = groups.Group(gdal.Open(cover_path),
+                                        cache_size=groups.CACHE_SIZE)
+
+        # properties
+        self.projection = self.raster_group.projection
+        self.geo_transform = self.raster_group.geo_transform
+        self.no_data_value = self.raster_group.no_data_value
+
+    def _get_paths(self, feature):
+        """ Return dictionary of target paths that do not exist yet. """
+        name = feature['name']
+        paths = {}
+        for output in self.outputs:
+            path = os.path.join(self.output_path, output, name[:3], name)
+            if output != 'vectors':
+                path += '.tif'
+            if os.path.exists(path):
+                continue
+
+            # create directory
+            try:
+                os.makedirs(os.path.dirname(path))
+            except OSError:
+                pass  # no problem
+
+            paths[output] = path
+        return paths
+
+    def _save(self, path, values, geo_transform, no_data_value):
+        """ Save two-dimensional values as geotiff. """
+        options = ['compress=deflate', 'tiled=yes']
+        kwargs = {'projection': self.projection,
+                  'geo_transform': geo_transform,
+                  'no_data_value': no_data_value}
+
+        with datasets.Dataset(values[np.newaxis], **kwargs) as dataset:
+            GTIF.CreateCopy(path, dataset, options=options)
+
+    def run(self, feature):
+        """ Return dictionary with seconds spent per stage. """
+        paths = self._get_paths(feature)
+        timings = {}
+        if not paths:
+            return timings
+
+        # only run the stages up to the last requested output
+        last = max(OUTPUTS.index(output) for output in paths)
+        stages = OUTPUTS[:last + 1]
+
+        # geometries
+        inner_geometry = feature.geometry()
+        outer_geometry = inner_geometry.Buffer(50)
+
+        # geo transforms
+        inner_geo_transform = self.geo_transform.shifted(inner_geometry)
+        outer_geo_transform = self.geo_transform.shifted(outer_geometry)
+        slices = outer_geo_transform.get_slices(inner_geometry)
+
+        # data
+        with utils.Timer(timings, 'read'):
+            values = self.raster_group.read(outer_geometry)
+            cover = self.cover_group.read(outer_geometry)
+
+        with utils.Timer(timings, 'filled'):
+            flow_fil.fill_tile(values=values, cover=cover, engine=self.engine)
+        if 'filled' in paths:
+            with utils.Timer(timings, 'write'):
+                self._save(path=paths['filled'],
+                           values=values[slices],
+                           geo_transform=inner_geo_transform,
+                           no_data_value=self.no_data_value.item())
+        if 'direction' not in stages:
+            return timings
+
+        with utils.Timer(timings, 'direction'):
+            direction = flow_dir.calculate_tile(values=values, cover=cover)
+        if 'direction' in paths:
+            with utils.Timer(timings, 'write'):
+                self._save(path=paths['direction'],
+                           values=direction[slices],
+                           geo_transform=inner_geo_transform,
+                           no_data_value=0)
+        if 'accumulation' not in stages:
+            return timings
+
+        with utils.Timer(timings, 'accumulation'):
+            accu = flow_acc.accumulate(direction=direction)
+            acculog = np.log10(accu + 1).astype('f4')
+        if 'accumulation' in paths:
+            with utils.Timer(timings, 'write'):
+                self._save(path=paths['accumulation'],
+                           values=acculog[slices],
+                           geo_transform=inner_geo_transform,
+                           no_data_value=np.finfo('f4').min.item())
+        if 'vectors' not in stages:
+            return timings
+
+        # vectorize with one pixel margin on all sides
+        margin = tuple(slice(s.start - 1, s.stop + 1) for s in slices)
+        with utils.Timer(timings, 'vectors'):
+            lines = list(flow_vec.vectorize(direction=direction[margin],
+                                            accumulation=acculog[margin]))
+        if 'vectors' in paths:
+            with utils.Timer(timings, 'write'):
+                flow_vec.save(path=paths['vectors'],
+                              lines=lines,
+                              geo_transform=inner_geo_transform,
+                              projection=self.projection)
+        if 'streams' not in stages:
+            return timings
+
+        # rasterize without the intermediate shapefile
+        with utils.Timer(timings, 'streams'):
+            streams = flow_rst.burn_lines(lines=lines,
+                                          geo_transform=inner_geo_transform,
+                                          geometry=inner_geometry)
+        with utils.Timer(timings, 'write'):
+            flow_rst.save(path=paths['streams'],
+                          array=streams,
+                          geometry=inner_geometry)
+        return timings
+
+
+def flow(index_path, part, workers, **kwargs):
+    """
+    """
+    # select some or all polygons and process them using workers
+    totals = collections.OrderedDict()
+    for feature, timings in scheduler.Scheduler(
+            index_path=index_path,
+            factory=Pipeline,
+            method='run',
+            part=part,
+            workers=workers,
+            ordered=False,
+            **kwargs):
+        for stage, seconds in timings.items():
+            totals[stage] = totals.get(stage, 0) + seconds
+
+    # report the time spent per stage, summed over the workers
+    for stage, seconds in totals.items():
+        print('{:<13}{:10.1f} s'.format(stage, seconds))
+    return 0
+
+
+def get_parser():
+    """ Return argument parser. """
+    parser = argparse.ArgumentParser(
+        description=__doc__
+    )
+    parser.add_argument(
+        'index_path',
+        metavar='INDEX',
+        help='shapefile with geometries and names of output tiles',
+    )
+    parser.add_argument(
+        'raster_path',
+        metavar='RASTER',
+        help='directory of complementary GDAL rasters.'
+    )
+    parser.add_argument(
+        'cover_path',
+        metavar='COVER',
+        help='functional landuse raster.'
+    )
+    parser.add_argument(
+        'output_path',
+        metavar='OUTPUT',
+        help='target folder, with a subfolder per output',
+    )
+    parser.add_argument(
+        '-o', '--outputs',
+        nargs='+',
+        choices=OUTPUTS,
+        default=['vectors'],
+        help='outputs to write, the stages up to the last one are run',
+    )
+    parser.add_argument(
+        '-p', '--part',
+        help='partial processing source, for example "2/3"',
+    )
+    parser.add_argument(
+        '-w', '--workers',
+        type=int,
+        default=1,
+        help='number of worker processes, 0 for one per cpu',
+    )
+    parser.add_argument(
+        '-e', '--engine',
+        choices=flow_fil.ENGINES,
+        default=flow_fil.ENGINES[0],
+        help='depression filling engine, see flow-fil',
+    )
+    return parser
+
+
+def main():
+    """ Call flow with args from parser. """
+    kwargs = vars(get_parser().parse_args())
+    flow(**kwargs)
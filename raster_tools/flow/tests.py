@@ -0,0 +1,528 @@
+# (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.rst.
+# -*- coding: utf-8 -*-
+
+import heapq
+import os
+import tempfile
+import time
+import unittest
+
+from osgeo import gdal
+from osgeo import ogr
+from scipy import ndimage
+import numpy as np
+
+from raster_tools import datasets
+from raster_tools import utils
+from raster_tools.flow import flow_acc
+from raster_tools.flow import flow_dir
+from raster_tools.flow import flow_fil
+from raster_tools.flow import flow_rst
+from raster_tools.flow import flow_vec
+from raster_tools.flow import pipeline
+
+BENCHMARK = os.environ.get('RASTER_TOOLS_BENCHMARK')
+DIRECTION = os.environ.get('RASTER_TOOLS_DIRECTION')  # path to a real tile
+
+
+def fill_depressions(values, mask=None):
+    """ Reference priority-flood implementation. """
+    height, width = values.shape
+    wall = values == np.finfo(values.dtype).max
+    done = wall.copy()
+
+    # start from the edges and the masked cells
+    start = np.zeros(values.shape, dtype='b1')
+    start[0] = start[-1] = start[:, 0] = start[:, -1] = True
+    if mask is not None:
+        start |= mask
+    start &= ~wall
+    heap = [(values[i, j], i, j) for i, j in zip(*start.nonzero())]
+    heapq.heapify(heap)
+    done[start] = True
+
+    while heap:
+        level, i, j = heapq.heappop(heap)
+        for k in range(max(0, i - 1), min(height, i + 2)):
+            for m in range(max(0, j - 1), min(width, j + 2)):
+                if done[k, m]:
+                    continue
+                done[k, m] = True
+                values[k, m] = max(values[k, m], level)
+                heapq.heappush(heap, (values[k, m], k, m))
+
+
+def accumulate(direction):
+    """ Reference implementation moving all fluid one step at a time. """
+    size = direction.size
+    flow = flow_acc.get_flow(direction)
+
+    state = np.arange(size)
+    accumulation = np.zeros(size, 'u8')
+    while True:
+        state = flow[state]
+        state.sort()
+        state = state[:np.searchsorted(state, size)]
+        if not state.size:
+            break
+        accumulation += np.bincount(state, minlength=size).astype('u8')
+
+    return accumulation.reshape(direction.shape)
+
+
+def calculate_flow_direction(values):
+    """ Reference implementation resolving flats with full array passes. """
+    NUMBERS = flow_dir.NUMBERS
+    COURSES = flow_dir.COURSES
+
+    # output
+    direction = np.zeros_like(values, dtype='u1')
+
+    # calculation of drop per neighbour cell
+    factor = np.zeros((3, 3))
+    factor[flow_dir.INDICES] = flow_dir.WEIGHTS[0]
+
+    best_drop = np.zeros_like(values)
+
+    # assign directions based on zero or positive drops
+    for i, j in zip(*factor.nonzero()):
+        kernel = np.zeros((3, 3))
+        kernel[i, j] = -factor[i, j]
+        kernel[1, 1] = +factor[i, j]
+
+        this_drop = ndimage.correlate(values, kernel)
+
+        # same drops add to the direction
+        same_drop = (this_drop == best_drop)
+        direction[same_drop] += COURSES[i, j]
+
+        # better drops replace the direction
+        more_drop = this_drop > best_drop
+        direction[more_drop] = COURSES[i, j]
+        best_drop[more_drop] = this_drop[more_drop]
+
+    # use look-up-table to eliminate multi-directions for positive drops:
+    lut = flow_dir.get_look_up_table()
+    some_drop = (best_drop > 0)
+    direction[some_drop] = lut[direction[some_drop]]
+
+    # assign outward to edges
+    direction[0, -1] = 1
+    direction[1:-1, -1] = 2
+    direction[-1, -1] = 4
+    direction[-1, 1:-1] = 8
+    direction[-1, 0] = 16
+    direction[1:-1, 0] = 32
+    direction[0, 0] = 64
+    direction[0, 1:-1] = 128
+
+    # iterate to solve undefined directions where possible
+    kwargs = {'structure': np.ones((3, 3))}
+
+    while True:
+        undefined = ~np.isin(direction, NUMBERS)
+        edges = undefined ^ ndimage.binary_erosion(undefined, **kwargs)
+
+        t_index1 = edges.nonzero()
+        direction1 = direction[t_index1][:, np.newaxis]
+
+        # find neighbour values
+        t_index8 = flow_dir.get_neighbours(t_index1)
+        direction8 = direction[t_index8].reshape(-1, 8)
+
+        # neighbour must be in encoded direction
+        b_index8a = (direction1 & NUMBERS).astype('b1')
+        # neighbour must have a defined flow direction
+        b_index8b = np.isin(direction8, NUMBERS)
+        # that direction must not point towards the cell to be defined
+        b_index8c = direction8 != flow_dir.INVERSE
+        # combined index
+        b_index8 = np.logical_and.reduce([b_index8a, b_index8b, b_index8c])
+
+        if not b_index8.any():
+            break
+
+        argmax = np.argmax(b_index8, axis=1)
+        nonzero = b_index8.any(axis=1)
+        superindex = tuple([t_index1[0][nonzero], t_index1[1][nonzero]])
+        direction[superindex] = NUMBERS[0, argmax[nonzero]]
+
+    # set still undefined directions (complex depressions) to zero
+    direction[~np.isin(direction, NUMBERS)] = 0
+    return direction
+
+
+def vectorize(direction, accumulation):
+    """ Reference implementation, travelling each section cell by cell. """
+    size = direction.size
+    height, width = direction.shape
+    traveled = flow_vec.get_traveled(direction)
+
+    flow = np.empty(size + 1, dtype='i8')
+    flow[-1] = size
+    flow[:size] = np.where(np.logical_or.reduce([
+        direction.ravel() == 0,
+        traveled[0] < 0,
+        traveled[0] >= height,
+        traveled[1] < 0,
+        traveled[1] >= width,
+    ]), size, traveled[0] * width + traveled[1])
+
+    state = np.arange(size)
+    flow[:-1][flow[flow[state]] == state] = size
+
+    for lower, upper in flow_vec.CLASSES:
+        points = (np.logical_and(accumulation.ravel() < upper,
+                                 accumulation.ravel() >= lower)).nonzero()[0]
+
+        flowed = flow[points]
+        leaving = (flowed == size)
+        promoting = np.logical_and(~leaving,
+                                   np.isin(flowed, points, invert=True))
+        bincount = np.bincount(flowed, minlength=size)[:-1]
+
+        sources = points[np.logical_and(
+            flowed != size,
+            np.isin(points, flowed, invert=True),
+        )]
+        merges = np.intersect1d(points, np.where(bincount > 1)[0])
+        sinks = np.union1d(points[leaving], flowed[promoting])
+
+        starts = np.union1d(sources, merges)
+        stops = set(np.union1d(merges, sinks).tolist())
+
+        for x in starts:
+            if x in sinks:
+                continue
+            line = [x]
+            while True:
+                x = flow[x]
+                line.append(x)
+                if x in stops:
+                    break
+            a = np.array(line)
+            yield lower, (a // width - 0.5, a % width - 0.5)
+
+
+def get_flats(shape, seed=0):
+    """ Return terraced surface with flats, pits and plateaus. """
+    random_state = np.random.RandomState(seed)
+    values = get_values(shape, seed=seed)
+    values = np.round(values / 4) * 4
+    values[random_state.random_sample(shape) < 0.01] -= 1  # pits
+    return values.astype('f4')
+
+
+def get_direction(values):
+    """ Return course encoded direction towards the lowest neighbour. """
+    height, width = values.shape
+    padded = np.pad(values.astype('f8'), 1, constant_values=np.inf)
+    lowest = values.astype('f8')
+    direction = np.zeros(values.shape, dtype='u1')
+    for (i, j), number in zip(flow_acc.OFFSETS, flow_acc.NUMBERS[0]):
+        other = padded[1 + i:1 + i + height, 1 + j:1 + j + width]
+        lower = other < lowest
+        lowest[lower] = other[lower]
+        direction[lower] = number
+    return direction
+
+
+def get_serpentine(shape):
+    """ Return direction of one path along all rows, east and west. """
+    direction = np.where(np.arange(shape[0])[:, np.newaxis] % 2, 32, 2)
+    direction = np.repeat(direction, shape[1], axis=1).astype('u1')
+    direction[0::2, -1] = 8
+    direction[1::2, 0] = 8
+    return direction
+
+
+class Feature(object):
+    """ Stand-in for an index feature. """
+    def __init__(self, name, x1, y1, x2, y2):
+        self.name = name
+        self.bounds = x1, y1, x2, y2
+        wkt = 'POLYGON (({x1} {y1},{x2} {y1},{x2} {y2},{x1} {y2},{x1} {y1}))'
+        self.wkt = wkt.format(x1=x1, y1=y1, x2=x2, y2=y2)
+
+    def __getitem__(self, key):
+        return getattr(self, key)
+
+    def geometry(self):
+        return ogr.CreateGeometryFromWkt(self.wkt)
+
+
+def get_values(shape, seed=0):
+    """ Return smooth random surface with depressions. """
+    random_state = np.random.RandomState(seed)
+    values = random_state.random_sample(shape).astype('f4')
+    for axis in 0, 1:
+        values = np.cumsum(values - 0.5, axis=axis)
+    return values.astype('f4')
+
+
+class TestFillDepressions(unittest.TestCase):
+    def test_reference(self):
+        maximum = np.finfo('f4').max
+        for seed, shape in enumerate([(1, 1), (2, 7), (13, 8), (40, 50)]):
+            random_state = np.random.RandomState(seed)
+            values = get_values(shape, seed=seed)
+            values[random_state.random_sample(shape) < 0.1] = maximum
+            mask = random_state.random_sample(shape) < 0.02
+
+            expected = values.copy()
+            fill_depressions(expected, mask=mask)
+            flow_fil.fill_depressions(values, mask=mask)
+            self.assertTrue(np.array_equal(values, expected))
+
+    def test_walls(self):
+        maximum = np.finfo('f4').max
+        values = np.ones((5, 5), dtype='f4')
+        values[1:4, 1:4] = maximum
+        values[2, 2] = 0
+        flow_fil.fill_depressions(values)
+        self.assertEqual(values[2, 2], 0)
+
+    @unittest.skipUnless(BENCHMARK, 'set RASTER_TOOLS_BENCHMARK to run')
+    def test_benchmark(self):
+        for size in 200, 500, 1000:
+            values = get_values((size, size))
+            timings = []
+            for function in (flow_fil.fill_complex_depressions,
+                             flow_fil.fill_depressions):
+                work = values.copy()
+                start = time.perf_counter()
+                function(work)
+                timings.append(time.perf_counter() - start)
+            print('%s x %s cells: %.3fs (contour), %.3fs (flood)' % (
+                size, size, *timings,
+            ))
+
+
+class TestAccumulate(unittest.TestCase):
+    def test_reference(self):
+        directions = [get_serpentine((7, 9))]
+        for seed, shape in enumerate([(1, 1), (3, 1), (13, 8), (40, 50)]):
+            directions.append(get_direction(get_values(shape, seed=seed)))
+
+        # cells flowing towards each other
+        directions[-1][20, 20:22] = 2, 32
+
+        for direction in directions:
+            self.assertTrue(np.array_equal(
+                flow_acc.accumulate(direction), accumulate(direction),
+            ))
+
+    def test_weights(self):
+        direction = get_direction(get_values((30, 40)))
+        weights = np.full(direction.shape, 0.5, dtype='f4')
+        result = flow_acc.accumulate(direction, weights=weights)
+        expected = flow_acc.accumulate(direction) / 2
+        self.assertTrue(np.array_equal(result, expected))
+
+    def test_seamless(self):
+        direction = get_direction(get_values((45, 60)))
+        expected = np.log10(flow_acc.accumulate(direction) + 1)
+
+        # direction raster of which the 15 x 15 tiles are accumulated
+        raster_path = '/vsimem/seamless/direction.tif'
+        kwargs = {'projection': 'EPSG:28992',
+                  'geo_transform': (0, 1, 0, 45, 0, -1),
+                  'no_data_value': 0}
+        with datasets.Dataset(direction[np.newaxis], **kwargs) as dataset:
+            gdal.GetDriverByName('GTiff').CreateCopy(raster_path, dataset)
+        features = [Feature('t%02d%02d' % (x, y), x, y, x + 15, y + 15)
+                    for x in range(0, 60, 15) for y in range(0, 45, 15)]
+
+        with tempfile.TemporaryDirectory() as output_path:
+            kwargs = {'raster_path': raster_path, 'output_path': output_path}
+            accumulator = flow_acc.SeamlessAccumulator(**kwargs)
+            scans = [accumulator.scan(feature) for feature in features]
+            inflow_path = os.path.join(output_path, 'inflow.npz')
+            cells, values = flow_acc.accumulate_exits(scans)
+            np.savez(inflow_path, cells=cells, values=values)
+
+            accumulator = flow_acc.SeamlessAccumulator(
+                inflow_path=inflow_path, **kwargs
+            )
+            result = np.empty_like(expected)
+            for feature in features:
+                accumulator.inject(feature)
+                path = os.path.join(output_path, feature.name[:3],
+                                    feature.name + '.tif')
+                x1, y1, x2, y2 = feature.bounds
+                result[45 - y2:45 - y1, x1:x2] = gdal.Open(
+                    path
+                ).ReadAsArray()
+
+        self.assertTrue(np.allclose(result, expected))
+
+    @unittest.skipUnless(BENCHMARK, 'set RASTER_TOOLS_BENCHMARK to run')
+    def test_benchmark(self):
+        directions = [
+            ('serpentine', get_serpentine((100, 100))),
+            ('serpentine', get_serpentine((200, 200))),
+            ('random surface', get_direction(get_values((500, 500)))),
+            ('random surface', get_direction(get_values((1000, 1000)))),
+        ]
+        if DIRECTION:
+            directions.append(
+                ('real', gdal.Open(DIRECTION).ReadAsArray()),
+            )
+        for name, direction in directions:
+            timings = []
+            for function in accumulate, flow_acc.accumulate:
+                start = time.perf_counter()
+                function(direction)
+                timings.append(time.perf_counter() - start)
+            print('%s %s x %s: %.3fs (stepwise), %.3fs (topological)' % (
+                name, *direction.shape, *timings,
+            ))
+
+
+class TestPipeline(unittest.TestCase):
+    def test_outputs(self):
+        # elevation and landcover of which a buffered 20 x 20 tile is used
+        values = get_values((120, 120))
+        cover = np.zeros((120, 120), dtype='u1')
+        cover[10:20, 60:70] = 51  # water
+        cover[55:58, 40:80] = 2  # building
+        kwargs = {'projection': 'EPSG:28992',
+                  'geo_transform': (0, 1, 0, 120, 0, -1),
+                  'no_data_value': 255}
+        raster_path = '/vsimem/pipeline/raster.tif'
+        cover_path = '/vsimem/pipeline/cover.tif'
+        for path, array in (raster_path, values), (cover_path, cover):
+            with datasets.Dataset(array[np.newaxis], **kwargs) as dataset:
+                gdal.GetDriverByName('GTiff').CreateCopy(path, dataset)
+
+        # the stages chained by hand
+        flow_fil.fill_tile(values=values, cover=cover)
+        filled = values.copy()
+        direction = flow_dir.calculate_tile(values=values, cover=cover)
+        acculog = np.log10(flow_acc.accumulate(direction) + 1)
+        expected = {'filled': filled,
+                    'direction': direction,
+                    'accumulation': acculog}
+
+        feature = Feature('t0000', 50, 50, 70, 70)
+        with tempfile.TemporaryDirectory() as output_path:
+            timings = pipeline.Pipeline(
+                raster_path=raster_path,
+                cover_path=cover_path,
+                output_path=output_path,
+                outputs=['direction', 'filled', 'accumulation'],
+            ).run(feature)
+            self.assertNotIn('vectors', timings)
+            for output, array in expected.items():
+                path = os.path.join(output_path, output, 't00', 't0000.tif')
+                result = gdal.Open(path).ReadAsArray()
+                self.assertTrue(np.allclose(result, array[50:70, 50:70]))
+
+
+class TestRasterize(unittest.TestCase):
+    def test_burn_lines(self):
+        # a small river crossing a large one, on a grid of 1 m cells
+        geo_transform = utils.GeoTransform((0, 1, 0, 5, 0, -1))
+        lines = [
+            (4.7, (np.array([2.25, 2.25]), np.array([0.5, 9.5]))),
+            (2.0, (np.array([0.5, 4.5]), np.array([4.25, 4.25]))),
+        ]
+        feature = Feature('t0000', 0, 0, 10, 5)
+        array = flow_rst.burn_lines(lines=lines,
+                                    geo_transform=geo_transform,
+                                    geometry=feature.geometry())
+        self.assertEqual(array.shape, (1, 30, 60))
+        self.assertEqual(np.unique(array).tolist(), [0, 2, 5])
+
+        # the large river ends on top
+        self.assertEqual(array[0, 13, 25], 5)
+        self.assertEqual(array[0, 5, 25], 2)
+
+
+class TestFlowDirection(unittest.TestCase):
+    def test_reference(self):
+        arrays = [
+            np.zeros((1, 1), dtype='f4'),
+            np.zeros((9, 7), dtype='f4'),
+            get_values((30, 20)),
+        ]
+        for seed, shape in enumerate([(3, 4), (20, 30), (64, 64)]):
+            arrays.append(get_flats(shape, seed=seed))
+
+        for values in arrays:
+            self.assertTrue(np.array_equal(
+                flow_dir.calculate_flow_direction(values),
+                calculate_flow_direction(values),
+            ))
+
+    @unittest.skipUnless(BENCHMARK, 'set RASTER_TOOLS_BENCHMARK to run')
+    def test_benchmark(self):
+        arrays = []
+        for size in 100, 300, 1000:
+            # a single flat draining via the edges
+            arrays.append(('flat', np.zeros((size, size), dtype='f4')))
+            arrays.append(('terraced', get_flats((size, size))))
+        for name, values in arrays:
+            timings = []
+            for function in (calculate_flow_direction,
+                             flow_dir.calculate_flow_direction):
+                start = time.perf_counter()
+                function(values)
+                timings.append(time.perf_counter() - start)
+            print('%s %s x %s: %.3fs (iterative), %.3fs (rings)' % (
+                name, *values.shape, *timings,
+            ))
+
+
+class TestVectorize(unittest.TestCase):
+    def get_arrays(self, direction):
+        """ Return direction and logarithmic accumulation. """
+        accumulation = np.log10(flow_acc.accumulate(direction) + 1)
+        return direction, accumulation.astype('f4')
+
+    def get_tilted(self, shape, seed=0):
+        """ Return direction of a sloping surface, with long streams. """
+        values = get_values(shape, seed=seed)
+        values += 3 * np.arange(shape[0], dtype='f4')[:, np.newaxis]
+        return get_direction(values)
+
+    def assertSections(self, direction, accumulation):
+        expected = list(vectorize(direction, accumulation))
+        result = list(flow_vec.vectorize(direction, accumulation))
+        self.assertEqual(len(result), len(expected))
+        for (klass1, indices1), (klass2, indices2) in zip(result, expected):
+            self.assertEqual(klass1, klass2)
+            self.assertTrue(np.array_equal(indices1, indices2))
+
+    def test_reference(self):
+        for seed, shape in enumerate([(1, 1), (5, 9), (60, 40), (200, 200)]):
+            direction = get_direction(get_values(shape, seed=seed))
+            self.assertSections(*self.get_arrays(direction))
+            self.assertSections(*self.get_arrays(self.get_tilted(shape)))
+
+    def test_serpentine(self):
+        # one long section per class
+        self.assertSections(*self.get_arrays(get_serpentine((60, 60))))
+
+    @unittest.skipUnless(BENCHMARK, 'set RASTER_TOOLS_BENCHMARK to run')
+    def test_benchmark(self):
+        directions = [
+            ('serpentine', get_serpentine((300, 300))),
+            ('serpentine', get_serpentine((1000, 1000))),
+            ('tilted surface', self.get_tilted((1000, 1000))),
+            ('tilted surface', self.get_tilted((3000, 3000))),
+        ]
+        if DIRECTION:
+            directions.append(
+                ('real', gdal.Open(DIRECTION).ReadAsArray()),
+            )
+        for name, direction in directions:
+            direction, accumulation = self.get_arrays(direction)
+            timings = []
+            for function in vectorize, flow_vec.vectorize:
+                start = time.perf_counter()
+                list(function(direction, accumulation))
+                timings.append(time.perf_counter() - start)
+            print('%s %s x %s: %.3fs (cell by cell), %.3fs (jumping)' % (
+                name, *direction.shape, *timings,
+            ))
@@ -1,7 +1,9 @@
 # (c) Nelen & Schuurmans, see LICENSE.rst.
 # -*- coding: utf-8 -*-
 
+import collections
 import logging
+import os
 
 from osgeo import gdal
 from osgeo import gdal_array
@@ -14,6 +16,9 @@ from raster_tools import utils
 
 logger = logging.getLogger(__name__)
 
+# decoded blocks to keep for the buffered reads of neighbouring tiles
+CACHE_SIZE = 256 * 1024 ** 2  # bytes
+
 
 class Meta(object):
     def __init__(self, dataset):
@@ -41,12 +46,50 @@ class Meta(object):
                 and self.geo_transform == other.geo_transform)
 
 
+class BlockCache(object):
+    """
+    Least recently used cache of decoded raster blocks, bounded by the
+    total amount of bytes of the blocks it holds.
+    """
+    def __init__(self, size):
+        self.size = size
+        self.nbytes = 0
+        self.blocks = collections.OrderedDict()
+
+        # counters for tuning
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, load):
+        """
+        Return block for key, calling load() to obtain it when missing.
+        """
+        try:
+            block = self.blocks.pop(key)
+        except KeyError:
+            self.misses += 1
+            block = load()
+            self.nbytes += block.nbytes
+        else:
+            self.hits += 1
+        self.blocks[key] = block  # most recently used goes last
+
+        # evict least recently used blocks
+        while self.nbytes > self.size and len(self.blocks) > 1:
+            self.nbytes -= self.blocks.popitem(last=False)[1].nbytes
+
+        return block
+
+
 class Group(object):
     """
     A group of gdal rasters, automatically merges, and has a more pythonic
     interface.
+
+    :param cache_size: when nonzero, keep up to this amount of bytes of
+        decoded blocks around for subsequent reads.
     """
-    def __init__(self, *datasets):
+    def __init__(self, *datasets, cache_size=0):
         metas = [Meta(dataset) for dataset in datasets]
         meta = metas[0]
         if not all([meta == m for m in metas]):
@@ -62,6 +105,39 @@ class Group(object):
         self.no_data_values = [m.no_data_value for m in metas]
         self.datasets = datasets
 
+        self.cache = BlockCache(cache_size) if cache_size else None
+
+    def _read_blocks(self, number, p1, q1, p2, q2):
+        """
+        Return array for a window of a dataset, assembled from cached
+        blocks.
+
+        :param number: position of the dataset in this group
+        """
+        dataset = self.datasets[number]
+        w, h = dataset.GetRasterBand(1).GetBlockSize()
+        data = np.empty((q2 - q1, p2 - p1), self.dtype)
+
+        for j in range(q1 // h, (q2 - 1) // h + 1):
+            for i in range(p1 // w, (p2 - 1) // w + 1):
+                # the block, possibly truncated at the dataset edge
+                u1, v1 = i * w, j * h
+                u2, v2 = min(self.width, u1 + w), min(self.height, v1 + h)
+                kwargs = {'xoff': u1, 'yoff': v1,
+                          'xsize': u2 - u1, 'ysize': v2 - v1}
+                block = self.cache.get(
+                    key=(number, i, j),
+                    load=lambda: dataset.ReadAsArray(**kwargs),
+                )
+
+                # the part of the block inside the window
+                s1, t1 = max(p1, u1), max(q1, v1)
+                s2, t2 = min(p2, u2), min(q2, v2)
+                data[t1 - q1:t2 - q1, s1 - p1:s2 - p1] = \
+                    block[t1 - v1:t2 - v1, s1 - u1:s2 - u1]
+
+        return data
+
     def read(self, bounds, inflate=False):
         """
         Return numpy array.
@@ -92,9 +168,156 @@ class Group(object):
         view = array[q1 - y1: q2 - y1, p1 - x1: p2 - x1]
 
         kwargs = {'xoff': p1, 'yoff': q1, 'xsize': p2 - p1, 'ysize': q2 - q1}
-        for dataset, no_data_value in zip(self.datasets, self.no_data_values):
-            data = dataset.ReadAsArray(**kwargs)
-            index = data != no_data_value
+        for number, dataset in enumerate(self.datasets):
+            if self.cache is None:
+                data = dataset.ReadAsArray(**kwargs)
+            else:
+                data = self._read_blocks(number, p1, q1, p2, q2)
+            index = data != self.no_data_values[number]
+            view[index] = data[index]
+
+        return array
+
+
+class IndexedGroup(object):
+    """
+    A group of gdal rasters that may differ in extent, for example a
+    directory of tiles. The rasters must share datatype, projection and
+    cellsize and be aligned to the same grid.
+
+    The footprints of the rasters are indexed once, so that a read only
+    opens and reads the rasters that intersect the request. At most
+    max_open rasters are kept open at the same time.
+    """
+    def __init__(self, paths, max_open=64):
+        metas = [Meta(gdal.Open(path)) for path in paths]
+        meta = metas[0]
+
+        # all rasters must fit the grid of the first one
+        p, a, b, q, c, d = meta.geo_transform
+        if b or c:
+            raise ValueError('Rotated rasters are not supported.')
+        offsets = []
+        for m in metas:
+            if (m.data_type != meta.data_type
+                    or m.projection != meta.projection
+                    or m.geo_transform[1:3] != meta.geo_transform[1:3]
+                    or m.geo_transform[4:6] != meta.geo_transform[4:6]):
+                raise ValueError('Incompatible rasters.')
+            x = (m.geo_transform[0] - p) / a
+            y = (m.geo_transform[3] - q) / d
+            if abs(x - round(x)) > 1e-6 or abs(y - round(y)) > 1e-6:
+                raise ValueError('Unaligned rasters.')
+            offsets.append((round(x), round(y)))
+
+        # footprints in pixels of the combined grid
+        x1, y1 = np.array(offsets).transpose()
+        x2 = x1 + [m.width for m in metas]
+        y2 = y1 + [m.height for m in metas]
+        u, v = x1.min().item(), y1.min().item()
+        self.footprints = np.array([x1 - u, y1 - v, x2 - u, y2 - v]).T
+
+        self.dtype = meta.dtype
+        self.width = x2.max().item() - u
+        self.height = y2.max().item() - v
+        self.projection = meta.projection
+        self.no_data_value = meta.no_data_value
+        self.geo_transform = utils.GeoTransform(
+            (p + a * u, a, b, q + d * v, c, d),
+        )
+
+        self.no_data_values = [m.no_data_value for m in metas]
+        self.paths = list(paths)
+
+        # grid index with cells the size of the largest footprint
+        self.cell = max(int((x2 - x1).max()), int((y2 - y1).max()))
+        self.index = collections.defaultdict(list)
+        for number, (i1, j1, i2, j2) in enumerate(self.footprints):
+            for j in range(j1 // self.cell, (j2 - 1) // self.cell + 1):
+                for i in range(i1 // self.cell, (i2 - 1) // self.cell + 1):
+                    self.index[i, j].append(number)
+
+        # pool of open datasets
+        self.max_open = max_open
+        self.datasets = collections.OrderedDict()
+
+    @classmethod
+    def from_path(cls, path, **kwargs):
+        """
+        Return group for a directory of rasters, the sources of a vrt or
+        a single raster.
+        """
+        if os.path.isdir(path):
+            paths = [os.path.join(path, name)
+                     for name in sorted(os.listdir(path))]
+        elif path.lower().endswith('.vrt'):
+            paths = gdal.Open(path).GetFileList()[1:]
+        else:
+            paths = [path]
+        return cls(paths, **kwargs)
+
+    def _open(self, number):
+        """ Return dataset from the pool, opening it if necessary. """
+        try:
+            dataset = self.datasets.pop(number)
+        except KeyError:
+            dataset = gdal.Open(self.paths[number])
+            if len(self.datasets) >= self.max_open:
+                self.datasets.popitem(last=False)
+        self.datasets[number] = dataset  # most recently used goes last
+        return dataset
+
+    def query(self, x1, y1, x2, y2):
+        """ Return sorted numbers of the rasters intersecting a window. """
+        # candidates from the grid index
+        cell = self.cell
+        i1, i2 = max(0, x1) // cell, (min(self.width, x2) - 1) // cell + 1
+        j1, j2 = max(0, y1) // cell, (min(self.height, y2) - 1) // cell + 1
+        numbers = set()
+        for j in range(j1, j2):
+            for i in range(i1, i2):
+                numbers.update(self.index.get((i, j), ()))
+        numbers = np.array(sorted(numbers), dtype='i8')
+        if not numbers.size:
+            return numbers
+
+        # exact test against the footprints
+        u1, v1, u2, v2 = self.footprints[numbers].T
+        select = (u1 < x2) & (x1 < u2) & (v1 < y2) & (y1 < v2)
+        return numbers[select]
+
+    def read(self, bounds, inflate=False):
+        """
+        Return numpy array.
+
+        :param bounds: x1, y1, x2, y2 window in pixels, or an ogr geometry
+        :param inflate: inflate envelope to grid, to make sure that
+            the entire geometry is contained in resulting indices.
+
+        If the bounds fall outside the datasets, the result is padded
+        with no data values.
+        """
+        # find indices
+        if isinstance(bounds, ogr.Geometry):
+            x1, y1, x2, y2 = self.geo_transform.get_indices(bounds,
+                                                            inflate=inflate)
+        else:
+            x1, y1, x2, y2 = bounds
+
+        array = np.full((y2 - y1, x2 - x1), self.no_data_value, self.dtype)
+
+        for number in self.query(x1, y1, x2, y2):
+            # overlap of the window and the footprint
+            u1, v1, u2, v2 = self.footprints[number].tolist()
+            p1, q1 = max(x1, u1), max(y1, v1)
+            p2, q2 = min(x2, u2), min(y2, v2)
+
+            # read and merge
+            view = array[q1 - y1: q2 - y1, p1 - x1: p2 - x1]
+            kwargs = {'xoff': p1 - u1, 'yoff': q1 - v1,
+                      'xsize': p2 - p1, 'ysize': q2 - q1}
+            data = self._open(number).ReadAsArray(**kwargs)
+            index = data != self.no_data_values[number]
             view[index] = data[index]
 
         return array
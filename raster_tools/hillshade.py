@@ -13,8 +13,8 @@ from osgeo import gdal
 import numpy as np
 
 from raster_tools import datasets
-from raster_tools import datasources
 from raster_tools import groups
+from raster_tools import scheduler
 
 logger = logging.getLogger(__name__)
 driver = gdal.GetDriverByName('gtiff')
@@ -132,16 +132,18 @@ class Calculator(object):
             driver.CreateCopy(path, dataset, options=options)
 
 
-def hillshade(index_path, raster_path, output_path, part):
+def hillshade(index_path, raster_path, output_path, part, workers):
     """ Convert all features. """
-    index = datasources.PartialDataSource(index_path)
-    if part is not None:
-        index = index.select(part)
-
-    calculator = Calculator(raster_path=raster_path, output_path=output_path)
-
-    for feature in index:
-        calculator.calculate(feature)
+    scheduler.Scheduler(
+        index_path=index_path,
+        factory=Calculator,
+        method='calculate',
+        part=part,
+        workers=workers,
+        ordered=False,
+        raster_path=raster_path,
+        output_path=output_path,
+    ).run()
     return 0
 
 
@@ -167,6 +169,12 @@ def get_parser():
         '-p', '--part',
         help='partial processing source, for example "2/3"',
     )
+    parser.add_argument(
+        '-w', '--workers',
+        type=int,
+        default=1,
+        help='number of worker processes, 0 for one per cpu',
+    )
     parser.add_argument('-v', '--verbose', action='store_true')
     return parser
 
@@ -5,6 +5,10 @@ Rasterize according to some index file from data in an ogr source to
 raster files in AHN2 layout. Because of performance problems with the
 ogr postgis driver, this module features its own datasource for postgis
 connection strings, implemented using psycopg2.
+
+The postgis datasource keeps a single read-only connection for all tiles
+and streams the rows of a tile from a server-side cursor, so that the
+memory use does not depend on the number of rows.
 """
 
 import argparse
@@ -15,6 +19,7 @@ import sys
 from osgeo import gdal
 from osgeo import ogr
 from osgeo import osr
+from psycopg2 import sql
 import psycopg2
 
 from raster_tools import datasets
@@ -33,7 +38,8 @@ DATA_TYPE = {
     'Integer': gdal.GDT_Byte,
 }
 
-POLYGON = 'POLYGON (({x1} {y1},{x2} {y1},{x2} {y2},{x1} {y2},{x1} {y1}))'
+# rows per round trip of the server-side cursor
+ITERSIZE = 10000
 
 logger = logging.getLogger(__name__)
 
@@ -168,15 +174,15 @@ def command(index_path, source_path, target_dir, attribute):
         for i, source_layer in enumerate(ordered_source_data_source):
             source_field_name = source_field_names[i]
             source_layer.SetSpatialFilter(index_geometry)
-            if not source_layer.GetFeatureCount():
-                continue
 
-            # create ogr layer if necessary
+            # create ogr layer if necessary, counting after the fetch
             if hasattr(source_layer, 'as_ogr_layer'):
                 temp_data_source, source_layer = source_layer.as_ogr_layer(
                     name=source_field_name,
                     sr=index_layer.GetSpatialRef(),
                 )
+            if not source_layer.GetFeatureCount():
+                continue
 
             # rasterize
             gdal.RasterizeLayer(
@@ -282,6 +288,7 @@ class PGLayer(object):
         self.schema = schema
         self.table = table
         self.geom_column = geom_column
+        self.envelope = None
 
     def GetName(self):
         return self.table
@@ -292,69 +299,65 @@ class PGLayer(object):
             'real': 'Real',
             'bigint': 'Integer',
         }
-        sql = """
+        query = """
             select
                 column_name,
                 data_type
             from
                 information_schema.columns
             where
-                table_schema='{schema}'
-                and table_name='{table}'
+                table_schema=%s
+                and table_name=%s
             order by
                 ordinal_position
-        """.format(schema=self.schema, table=self.table)
-        cursor = self.connection.cursor()
-        cursor.execute(sql)
-        fields = [(r[0], typenames.get(r[1])) for r in cursor.fetchall()]
+        """
+        with self.connection.cursor() as cursor:
+            cursor.execute(query, (self.schema, self.table))
+            fields = [(r[0], typenames.get(r[1])) for r in cursor.fetchall()]
         return PGLayerDefn(fields=fields)
 
     def SetSpatialFilter(self, geometry):
         x1, x2, y1, y2 = geometry.GetEnvelope()
-        self.box = POLYGON.format(x1=x1, y1=y1, x2=x2, y2=y2)
-
-    def GetFeatureCount(self):
-        sql = """
-            select
-                count(*)
-            from
-                {schema}.{table}
-            where
-                {geom_column} && ST_GeometryFromText('{box}')
-        """.format(schema=self.schema, table=self.table,
-                   box=self.box, geom_column=self.geom_column)
-        cursor = self.connection.cursor()
-        cursor.execute(sql)
-        return cursor.fetchall()[0][0]
+        self.envelope = x1, y1, x2, y2
 
     def as_ogr_layer(self, name, sr):
-        sql = """
+        """
+        Return ogr memory data source and layer with the rows within the
+        spatial filter.
+
+        The rows are streamed from a server-side cursor, ITERSIZE rows per
+        round trip, and copied into the layer using a single feature.
+        """
+        query = sql.SQL("""
             select
                 ST_AsBinary(ST_Force2D({geom_column})),
                 {name}
             from
-                {schema}.{table}
+                {table}
             where
-                {geom_column} && ST_GeometryFromText('{box}')
-            """.format(name=name, schema=self.schema,
-                       table=self.table, box=self.box,
-                       geom_column=self.geom_column)
-
-        cursor = self.connection.cursor()
-        cursor.execute(sql)
+                {geom_column} && ST_MakeEnvelope(%s, %s, %s, %s)
+        """).format(
+            name=sql.Identifier(name),
+            table=sql.Identifier(self.schema, self.table),
+            geom_column=sql.Identifier(self.geom_column),
+        )
 
         data_source = DRIVER_OGR_MEMORY.CreateDataSource('')
         layer = data_source.CreateLayer('', sr)
         layer.CreateField(ogr.FieldDefn(name, ogr.OFTInteger))
-        layer_defn = layer.GetLayerDefn()
-        for wkb, value in cursor:
-            feature = ogr.Feature(layer_defn)
-            feature[name] = value
-            try:
-                feature.SetGeometry(ogr.CreateGeometryFromWkb(wkb))
-            except RuntimeError:
-                pass
-            layer.CreateFeature(feature)
+        feature = ogr.Feature(layer.GetLayerDefn())
+
+        with self.connection.cursor(name='rasterize') as cursor:
+            cursor.itersize = ITERSIZE
+            cursor.execute(query, self.envelope)
+            for wkb, value in cursor:
+                feature.SetField(0, value)
+                try:
+                    geometry = ogr.CreateGeometryFromWkb(bytes(wkb))
+                except RuntimeError:
+                    geometry = None
+                feature.SetGeometryDirectly(geometry)
+                layer.CreateFeature(feature)  # creates a copy
         return data_source, layer
 
 
@@ -370,9 +373,16 @@ class PGDataSource(object):
             user=info.get('user'),
             password=info.get('password'),
         )
-        self.schema = info.get('schemas')
-        self.tables = info.get('tables').split(',')
-        self.geom_column = info.get('geom_column', 'geom')
+        # one transaction for all tiles, as server-side cursors need one
+        self.connection.set_session(readonly=True)
+
+        schema = info.get('schemas')
+        geom_column = info.get('geom_column', 'geom')
+        self.layers = [PGLayer(connection=self.connection,
+                               schema=schema,
+                               table=table,
+                               geom_column=geom_column)
+                       for table in info.get('tables').split(',')]
 
     """ Dummy driver """
     def GetDriver(self):
@@ -382,11 +392,4 @@ class PGDataSource(object):
         return Driver()
 
     def __iter__(self):
-        for t in self.tables:
-            lr = PGLayer(
-                connection=self.connection,
-                schema=self.schema,
-                table=t,
-                geom_column=self.geom_column
-            )
-            yield lr
+        return iter(self.layers)
@@ -5,6 +5,9 @@ Rextract, the king of extractors.
 
 Extract parts of lizard rasters using geometries from a shapefile.
 
+Multiple rasters can be extracted at once, as a tif per raster or as a single
+multiband tif, on the same grid.
+
 Please note that any information about the spatial reference system in the
 shapefile is ignored.
 
@@ -12,6 +15,11 @@ If something goes wrong due to a problem on one of the lizard servers, it may
 be possible to resume the process by keeping the output folder intact and
 retrying exactly the same command.
 
+Features are extracted back to back through a single pool of requests, so
+that the requests for the next feature start while the last chunks of the
+previous one are still in flight. The number of requests in flight and,
+optionally, the number of requests per second are limited for the run.
+
 The password file (~/.rextract) should have appropriate permissions (chmod 600)
 and contain one username / password combination per line separated by a colon
 (:), for example:
@@ -20,7 +28,9 @@ and contain one username / password combination per line separated by a colon
     alice:6mVfBFx5YzDacMF52fkS
 """
 
+from concurrent import futures
 from http.client import responses
+from time import monotonic
 from time import sleep
 
 import argparse
@@ -29,10 +39,8 @@ import getpass
 import http
 import os
 import pathlib
-import queue as queues
 import requests
 import stat
-import tempfile
 import threading
 
 import numpy as np
@@ -44,8 +52,7 @@ from osgeo import osr
 from raster_tools import datasets
 from raster_tools import datasources
 from raster_tools import utils
-
-MAX_THREADS = 4  # if set to 0 there will be no limit on the amount of threads
+from raster_tools import writers
 
 # password file
 PWD_PATH = pathlib.Path.home() / '.rextract'
@@ -64,6 +71,7 @@ TIF_OPTIONS = [
     'BIGTIFF=YES',
     'SPARSE_OK=TRUE',
     'COMPRESS=DEFLATE',
+    writers.NUM_THREADS,
 ]
 
 # dtype argument lookups
@@ -81,28 +89,107 @@ SRS = 'EPSG:28992'
 CELLSIZE = 0.5
 DTYPE = 'f4'
 SUBDOMAIN = 'demo'
+REQUESTS = 16
+RATE = None  # requests per second, no limit
 
-# sleep and retry
+# sleep and retry, with the sleep increasing on subsequent attempts
 STATUS_RETRY_SECONDS = {
     http.HTTPStatus.SERVICE_UNAVAILABLE: 10,
     http.HTTPStatus.GATEWAY_TIMEOUT: 0,
 }
+RETRY_ATTEMPTS = 5
+RETRY_MAXIMUM = 300  # seconds
+
+# flush target and save progress after this many chunks
+SAVE_INTERVAL = 32
 
 
 class Indicator:
-    def __init__(self, path):
-        self.path = str(path)
+    """
+    Keeps track of completed chunks, using one bit per chunk.
+
+    The bitmap file starts with a header describing the layout of the
+    target and the number of chunks. A bitmap made for another layout or
+    size is discarded, since its bits would refer to other chunks.
+
+    If legacy is True, files from previous versions are used as well. A
+    bitmap without header is then accepted if its size matches, and a
+    progress file containing the number of completed chunks is read as the
+    leading chunks being completed.
+    """
+    MAGIC = b'rextract'
+
+    def __init__(self, path, size, layout='', legacy=True):
+        self.path = path.with_suffix('.bits')
+        self.legacy_path = path.with_suffix('.pro')
+        self.layout = layout
+        self.header = b'%s %s %d\n' % (self.MAGIC, layout.encode(), size)
+        self.discarded = False
+        self.completed = self._load(size, legacy)
 
-    def get(self):
+    def __len__(self):
+        return np.count_nonzero(self.completed)
+
+    def _unpack(self, size, legacy):
+        """ Return boolean array of completed chunks, or None. """
+        try:
+            content = self.path.read_bytes()
+        except FileNotFoundError:
+            return
+
+        if content.startswith(self.header):
+            packed = content[len(self.header):]
+        elif legacy and not content.startswith(self.MAGIC):
+            packed = content
+        else:
+            packed = b''
+        if len(packed) == (size + 7) // 8:
+            packed = np.frombuffer(packed, dtype='u1')
+            return np.unpackbits(packed, count=size).astype('b1')
+
+        print('Discarding %s, it was made for another layout.' % self.path)
+        self.discarded = True
+
+    def _load(self, size, legacy):
+        """ Return boolean array of completed chunks. """
+        completed = self._unpack(size, legacy)
+        if completed is not None:
+            return completed
+
+        completed = np.zeros(size, dtype='b1')
+        if not legacy:
+            return completed
         try:
-            with open(self.path) as f:
-                return int(f.read())
-        except IOError:
-            return 0
+            with self.legacy_path.open() as f:
+                completed[:int(f.read())] = True
+        except (IOError, ValueError):
+            pass
+        return completed
 
-    def set(self, value):
-        with open(self.path, 'w') as f:
-            f.write('%s\n' % value)
+    def reset(self, size):
+        """ Mark all chunks of a recreated target as not completed. """
+        self.header = b'%s %s %d\n' % (
+            self.MAGIC, self.layout.encode(), size,
+        )
+        self.completed = np.zeros(size, dtype='b1')
+
+    def get_serials(self):
+        """ Return serial numbers of the chunks that are not completed. """
+        return (~self.completed).nonzero()[0] + 1
+
+    def set(self, serial):
+        """ Mark a chunk as completed. """
+        self.completed[serial - 1] = True
+
+    def save(self):
+        """ Replace the bitmap file, so that it is never partially written. """
+        temp_path = self.path.with_name(self.path.name + '.tmp')
+        with temp_path.open('wb') as f:
+            f.write(self.header)
+            np.packbits(self.completed).tofile(f)
+        os.replace(temp_path, self.path)
+        if self.legacy_path.exists():
+            self.legacy_path.unlink()
 
 
 class Index:
@@ -138,8 +225,21 @@ class Index:
         self.block_size = w, h
         self.dataset_size = dataset.RasterXSize, dataset.RasterYSize
         self.geo_transform = geo_transform
+        self.geometry = geometry
         self.indices = index.nonzero()
 
+        # blocks not touching the boundary may be entirely inside
+        boundary = np.zeros(shape, dtype='u1')
+        with datasources.Layer(geometry.Boundary()) as layer:
+            with datasets.Dataset(boundary[np.newaxis], **kwargs) as ds_bnd:
+                gdal.RasterizeLayer(
+                    ds_bnd, [1], layer, burn_values=[1], options=options,
+                )
+        self.interior = np.zeros(len(self), dtype='b1')
+        for serial in (boundary[self.indices] == 0).nonzero()[0]:
+            rectangle = self._get_rectangle(self._get_indices(serial))
+            self.interior[serial] = geometry.Contains(rectangle)
+
     def _get_indices(self, serial):
         """ Return indices into dataset. """
         w, h = self.block_size
@@ -151,26 +251,52 @@ class Index:
         y2 = min(H, (y + 1) * h)
         return x1, y1, x2, y2
 
-    def _get_bbox(self, indices):
-        """ Return bbox tuple for a rectangle. """
+    def _get_extent(self, indices):
+        """ Return x1, y1, x2, y2 tuple for a rectangle. """
         u1, v1, u2, v2 = indices
         p, a, b, q, c, d = self.geo_transform
         x1 = p + a * u1 + b * v1
         y2 = q + c * u1 + d * v1
         x2 = p + a * u2 + b * v2
         y1 = q + c * u2 + d * v2
-        return '%s,%s,%s,%s' % (x1, y1, x2, y2)
+        return x1, y1, x2, y2
+
+    def _get_bbox(self, indices):
+        """ Return bbox tuple for a rectangle. """
+        return '%s,%s,%s,%s' % self._get_extent(indices)
+
+    def _get_rectangle(self, indices):
+        """ Return ogr geometry for a rectangle. """
+        x1, y1, x2, y2 = self._get_extent(indices)
+        ring = ogr.Geometry(ogr.wkbLinearRing)
+        for x, y in (x1, y1), (x2, y1), (x2, y2), (x1, y2), (x1, y1):
+            ring.AddPoint_2D(x, y)
+        rectangle = ogr.Geometry(ogr.wkbPolygon)
+        rectangle.AddGeometry(ring)
+        return rectangle
+
+    def _get_geometry(self, serial):
+        """
+        Return the geometry clipped to a block with a margin of one pixel,
+        or None if the block is entirely inside the geometry.
+        """
+        if self.interior[serial]:
+            return None
+        x1, y1, x2, y2 = self._get_indices(serial)
+        rectangle = self._get_rectangle((x1 - 1, y1 - 1, x2 + 1, y2 + 1))
+        return self.geometry.Intersection(rectangle)
 
     def __len__(self):
         return len(self.indices[0])
 
-    def get_chunks(self, start=1):
+    def get_chunks(self, serials):
         """
         Return chunk generator.
 
         Note that the serial number starts counting at 1.
         """
-        for serial in range(start, len(self) + 1):
+        for serial in serials:
+            serial = int(serial)
             x1, y1, x2, y2 = indices = self._get_indices(serial - 1)
             width, height, origin = x2 - x1, y2 - y1, (x1, y1)
             bbox = self._get_bbox(indices)
@@ -180,15 +306,25 @@ class Index:
                 height=height,
                 origin=origin,
                 serial=serial,
+                geometry=self._get_geometry(serial - 1),
             )
 
 
 class Target:
     """
-    Wraps the resulting gdal dataset.
+    Wraps the resulting gdal datasets, with a band for each uuid.
     """
-    def __init__(self, path, geometry, dtype, fillvalue, **kwargs):
-        """ Kwargs contain cellsize and uuid. """
+    def __init__(self, path, geometry, dtype, fillvalue, uuids,
+                 multiband=False, recreate=False, **kwargs):
+        """
+        :param path: path without extension
+        :param uuids: uuids of the rasters to extract
+        :param multiband: write a single multiband tif, instead of a tif
+            per uuid if there is more than one
+        :param recreate: overwrite existing tifs instead of appending
+
+        Kwargs contain cellsize, subdomain and time.
+        """
         # coordinates
         self.geometry = geometry
 
@@ -202,19 +338,41 @@ class Target:
             # cast the string dtype to the correct python type
             self.fillvalue = np.dtype(self.dtype).type(fillvalue).item()
 
-        # dataset
-        if path.exists():
-            print('Appending to %s... ' % path, end='')
-            self.dataset = gdal.Open(str(path), gdal.GA_Update)
+        # whether existing tifs were appended to or overwritten
+        self.appended = False
+        self.recreated = False
+
+        # datasets and band numbers per uuid, described by layout
+        multiband = multiband and len(uuids) > 1
+        self.layout = '%s:%s' % (
+            'multiband' if multiband else 'separate', ','.join(uuids),
+        )
+        if multiband or len(uuids) == 1:
+            dataset = self._get_dataset(
+                path=path.with_suffix('.tif'),
+                uuids=uuids,
+                recreate=recreate,
+                **kwargs
+            )
+            self.bands = [(dataset, number)
+                          for number in range(1, len(uuids) + 1)]
         else:
-            print('Creating %s' % path)
-            self.dataset = self._create_dataset(path=str(path), **kwargs)
+            self.bands = [(self._get_dataset(
+                path=path.parent / ('%s_%s.tif' % (path.name, uuid)),
+                uuids=[uuid],
+                recreate=recreate,
+                **kwargs
+            ), 1) for uuid in uuids]
 
-        # chunks
-        self.index = Index(dataset=self.dataset, geometry=self.geometry)
+        # chunks, aligned for all bands
+        self.index = Index(dataset=self.bands[0][0], geometry=self.geometry)
+
+        # inside masks shared by the chunks of a block
+        self.masks = {}
 
     def __len__(self):
-        return len(self.index)
+        """ Return the number of chunks, one per block and band. """
+        return len(self.index) * len(self.bands)
 
     @property
     def data_type(self):
@@ -228,7 +386,30 @@ class Target:
     def projection(self):
         return self.geometry.GetSpatialReference().ExportToWkt()
 
-    def _create_dataset(self, path, cellsize, subdomain, time, uuid):
+    def _get_dataset(self, path, uuids, recreate, **kwargs):
+        """
+        Return existing or newly created dataset.
+
+        An existing dataset is recreated if requested or if its number of
+        bands does not match the uuids.
+        """
+        if path.exists():
+            if not recreate:
+                dataset = gdal.OpenEx(str(path),
+                                      gdal.OF_UPDATE,
+                                      open_options=[writers.NUM_THREADS])
+                if dataset.RasterCount == len(uuids):
+                    print('Appending to %s... ' % path, end='')
+                    self.appended = True
+                    return dataset
+                dataset = None
+            print('Recreating %s' % path)
+            self.recreated = True
+        else:
+            print('Creating %s' % path)
+        return self._create_dataset(path=str(path), uuids=uuids, **kwargs)
+
+    def _create_dataset(self, path, cellsize, subdomain, time, uuids):
         """ Create output tif dataset. """
         # calculate
         a, b, c, d = cellsize, 0.0, 0.0, -cellsize
@@ -241,69 +422,138 @@ class Target:
 
         # create
         dataset = TIF_DRIVER.Create(
-            path, width, height, 1, self.data_type, options=TIF_OPTIONS,
+            path, width, height, len(uuids), self.data_type,
+            options=TIF_OPTIONS,
         )
         dataset.SetProjection(self.projection)
         dataset.SetGeoTransform(geo_transform)
-        dataset.GetRasterBand(1).SetNoDataValue(self.no_data_value)
+        for number, uuid in enumerate(uuids, 1):
+            band = dataset.GetRasterBand(number)
+            band.SetNoDataValue(self.no_data_value)
+            band.SetMetadata({'uuid': uuid})
 
         # meta
         dataset.SetMetadata(
-            {'subdomain': subdomain, 'time': time, 'uuid': uuid},
+            {'subdomain': subdomain, 'time': time, 'uuid': ','.join(uuids)},
         )
 
         return dataset
 
-    def get_chunks(self, start):
-        return self.index.get_chunks(start)
+    @property
+    def datasets(self):
+        """ Return the distinct datasets. """
+        return list({id(d): d for d, n in self.bands}.values())
+
+    def get_key(self, chunk):
+        """ Return the serial number of a chunk among all bands. """
+        return (chunk.serial - 1) * len(self.bands) + chunk.band + 1
 
-    def save(self, chunk):
+    def get_chunks(self, keys):
         """
+        Return chunk generator for serial numbers as from get_key().
+
+        The chunks for the bands of a block are generated consecutively,
+        so that their fetches are interleaved.
+        """
+        count = len(self.bands)
+        serials, bands = np.divmod(np.asarray(keys) - 1, count)
+        serials += 1
+
+        # keys are sorted, so the bands of a block are adjacent
+        unique, starts, counts = np.unique(
+            serials, return_index=True, return_counts=True,
+        )
+        blocks = self.index.get_chunks(unique)
+        for block, start, pending in zip(blocks,
+                                         starts.tolist(),
+                                         counts.tolist()):
+            if block.geometry is not None:
+                self.masks[block.serial] = {
+                    'inside': None, 'pending': pending,
+                }
+            for band in bands[start:start + pending].tolist():
+                yield Chunk(
+                    bbox=block.bbox,
+                    width=block.width,
+                    height=block.height,
+                    origin=block.origin,
+                    serial=block.serial,
+                    geometry=block.geometry,
+                    band=band,
+                )
+
+    def _get_inside(self, chunk, **kwargs):
+        """
+        Return inside mask for a boundary chunk, rasterizing the clipped
+        geometry only once per block.
+        """
+        mask = self.masks[chunk.serial]
+        mask['pending'] -= 1
+        if not mask['pending']:
+            del self.masks[chunk.serial]
+        if mask['inside'] is None:
+            inside = np.zeros((1, chunk.height, chunk.width), dtype='u1')
+            with datasources.Layer(chunk.geometry) as layer:
+                with datasets.Dataset(inside, **kwargs) as dataset:
+                    gdal.RasterizeLayer(
+                        dataset, [1], layer, burn_values=[255],
+                    )
+            mask['inside'] = inside
+        return mask['inside']
+
+    def save(self, chunk, writer):
+        """
+        Mask the data of chunk and hand it to writer.
+
+        :param writer: writers.Writer object
         """
         # read and convert datatype
         with chunk.as_dataset() as dataset:
             band = dataset.GetRasterBand(1)
             active = band.GetMaskBand().ReadAsArray()[np.newaxis]
             array = band.ReadAsArray().astype(self.dtype)[np.newaxis]
+            kwargs = {
+                'geo_transform': dataset.GetGeoTransform(),
+                'projection': dataset.GetProjection(),
+            }
 
-        # determine inside pixels
-        inside = np.zeros_like(active)
-        kwargs = {
-            'geo_transform': dataset.GetGeoTransform(),
-            'projection': dataset.GetProjection(),
-        }
-        with datasources.Layer(self.geometry) as layer:
-            with datasets.Dataset(inside, **kwargs) as dataset:
-                gdal.RasterizeLayer(dataset, [1], layer, burn_values=[255])
+        if chunk.geometry is None:
+            # entirely inside, mask inactive
+            array[np.logical_not(active)] = self.no_data_value
+        else:
+            # determine inside pixels from the clipped geometry
+            inside = self._get_inside(chunk, **kwargs)
 
-        # mask outide or inactive
-        array[~np.logical_and(active, inside)] = self.no_data_value
+            # mask outide or inactive
+            array[~np.logical_and(active, inside)] = self.no_data_value
 
         # write to target dataset
-        kwargs.update(no_data_value=self.no_data_value)
-        with datasets.Dataset(array, **kwargs) as dataset:
-            data = dataset.ReadRaster(0, 0, chunk.width, chunk.height)
-            args = chunk.origin + (chunk.width, chunk.height, data)
-        self.dataset.WriteRaster(*args)
+        dataset, number = self.bands[chunk.band]
+        writer.write(
+            dataset=dataset, array=array[0], origin=chunk.origin, band=number,
+        )
 
 
 class Chunk(object):
-    def __init__(self, bbox, width, height, origin, serial):
-        # for request
+    def __init__(self, bbox, width, height, origin, serial, geometry=None,
+                 band=0):
+        # for request, band indexes the uuids
         self.bbox = bbox
         self.width = width
         self.height = height
+        self.band = band
 
-        # for result
+        # for result, geometry is None when entirely inside
         self.origin = origin
         self.serial = serial
+        self.geometry = geometry
 
         # the geotiff data
         self.response = None
 
-    def fetch(self, session, subdomain, uuid, time, srs):
+    def fetch(self, session, url, time, srs):
         request = {
-            'url': API_URL % subdomain + uuid + '/data/',
+            'url': url,
             'headers': {'User-Agent': USER_AGENT},
             'params': {
                 'time': time,
@@ -319,20 +569,110 @@ class Chunk(object):
 
     @contextlib.contextmanager
     def as_dataset(self):
-        """ Temporily serve data as geotiff file in virtual memory. """
-        with tempfile.NamedTemporaryFile(dir='/dev/shm', buffering=0) as f:
-            f.write(self.response.content)
-            yield gdal.Open(f.name)
+        """ Temporarily serve data as geotiff file in virtual memory. """
+        path = '/vsimem/rextract/%s.tif' % id(self)
+        gdal.FileFromMemBuffer(path, self.response.content)
+        try:
+            yield gdal.Open(path)
+        finally:
+            gdal.Unlink(path)
+
+
+class Budget:
+    """
+    Limit the requests of a run, shared by all fetchers using it.
+
+    At most window requests are in flight and, if rate is given, requests
+    are started at no more than rate per second on average, using a token
+    bucket that allows bursts of up to one second worth of requests.
+    """
+    def __init__(self, window=REQUESTS, rate=RATE):
+        self.semaphore = threading.BoundedSemaphore(window)
+        self.rate = rate
+        self.tokens = rate
+        self.time = monotonic()
+        self.lock = threading.Lock()
+
+    def _wait(self):
+        """ Take a token, waiting until it is available. """
+        if self.rate is None:
+            return
+        with self.lock:
+            now = monotonic()
+            elapsed, self.time = now - self.time, now
+            self.tokens = min(self.rate, self.tokens + elapsed * self.rate)
+            self.tokens -= 1  # reserve, possibly ahead of time
+            seconds = -self.tokens / self.rate
+        if seconds > 0:
+            sleep(seconds)
+
+    def __enter__(self):
+        self._wait()
+        self.semaphore.acquire()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.semaphore.release()
 
 
-def filler(queue, chunks, **kwargs):
-    """ Fill queue with chunks from batch and terminate with None. """
-    for chunk in chunks:
-        thread = threading.Thread(target=chunk.fetch, kwargs=kwargs)
-        thread.daemon = True
-        thread.start()
-        queue.put((thread, chunk))
-    queue.put(None)
+class Fetcher:
+    """
+    Fetch chunks concurrently, with a bounded number of requests in flight
+    over a pool of keep-alive connections.
+    """
+    def __init__(self, session, urls, time, srs, window=REQUESTS,
+                 budget=None):
+        """
+        :param session: requests.Session object, logged in if necessary
+        :param urls: urls of the data endpoints of the rasters, indexed by
+            the band of the chunks
+        :param window: maximum number of requests in flight
+        :param budget: Budget object shared with other fetchers, by
+            default one for this fetcher only
+        """
+        # keep as many connections alive as there are requests in flight
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=window)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+
+        self.urls = urls
+        self.kwargs = {'session': session, 'time': time, 'srs': srs}
+        self.window = window
+        self.budget = Budget(window=window) if budget is None else budget
+
+    def fetch(self, chunk):
+        """
+        Fetch a chunk, retrying on some statuses and on connection errors.
+        """
+        for attempt in range(RETRY_ATTEMPTS + 1):
+            try:
+                with self.budget:
+                    chunk.fetch(url=self.urls[chunk.band], **self.kwargs)
+            except requests.ConnectionError:
+                if attempt == RETRY_ATTEMPTS:
+                    raise
+                seconds = 0
+            else:
+                status_code = chunk.response.status_code
+                seconds = STATUS_RETRY_SECONDS.get(status_code)
+                if seconds is None or attempt == RETRY_ATTEMPTS:
+                    break
+            sleep(min(RETRY_MAXIMUM, seconds + 2 ** attempt - 1))
+        return chunk
+
+    def imap_unordered(self, chunks):
+        """ Return generator of fetched chunks, in the order of completion. """
+        with futures.ThreadPoolExecutor(max_workers=self.window) as pool:
+            pending = set()
+            for chunk in chunks:
+                if len(pending) == self.window:
+                    done, pending = futures.wait(
+                        pending, return_when=futures.FIRST_COMPLETED,
+                    )
+                    for future in done:
+                        yield future.result()
+                pending.add(pool.submit(self.fetch, chunk))
+            for future in futures.as_completed(pending):
+                yield future.result()
 
 
 class RasterExtraction:
@@ -340,80 +680,109 @@ class RasterExtraction:
     Represent the extraction of a single feature.
     """
     def __init__(self, path, **kwargs):
-        self.indicator = Indicator(path=path.with_suffix('.pro'))
-        self.target = Target(path=path.with_suffix('.tif'), **kwargs)
+        self.name = path.name
+        self.target = Target(path=path, **kwargs)
+        self.indicator = Indicator(path=path,
+                                   size=len(self.target),
+                                   layout=self.target.layout,
+                                   legacy=len(self.target.bands) == 1)
+
+        # existing tifs belonging to a discarded bitmap are overwritten
+        if self.indicator.discarded and self.target.appended:
+            self.target = None  # close them first
+            self.target = Target(path=path, recreate=True, **kwargs)
+        if self.target.recreated:
+            self.indicator.reset(len(self.target))
+        self.remaining = len(self.target) - len(self.indicator)
+        self.received = 0
+
+    def get_chunks(self):
+        """ Return generator of the chunks that are not completed. """
+        completed = len(self.indicator)
+        if completed > 0:
+            print('Resuming with %s of %s chunks completed.' % (
+                completed, len(self.target),
+            ))
+        for chunk in self.target.get_chunks(self.indicator.get_serials()):
+            chunk.extraction = self
+            yield chunk
+
+    def receive(self, chunk, writer):
+        """
+        Save a fetched chunk to the target and return True if it was the
+        last one.
 
-    def process(self, session, srs, subdomain, time, uuid):
+        The chunk is recorded as completed only after writer has written
+        it.
         """
-        Extract for a single feature.
+        # abort on errors
+        if chunk.response.status_code != 200:
+            print('\nFailed to fetch a chunk! The url used was:')
+            print(chunk.response.url)
+            msg = 'The server responded with status code %s (%s).'
+            status_code = chunk.response.status_code
+            print(msg % (status_code, responses[status_code]))
+            exit()
+
+        # save the chunk to the target
+        self.target.save(chunk, writer)
+        writer.call(self.indicator.set, self.target.get_key(chunk))
+        self.remaining -= 1
+        self.received += 1
+        if self.received % SAVE_INTERVAL == 0:
+            writer.call(self.save)
+        return not self.remaining
 
-        :param session: requests.Sesssion object, logged in.
-        :param srs: str defining spatial reference system
-        :param time: ISO-8601 timestamp
-        :param uuid: Lizard raster UUID
+    def save(self):
         """
-        completed = self.indicator.get()
-        total = len(self.target)
-        if completed == total:
-            print('Already complete.')
-            return
-        if completed > 0:
-            print('Resuming from chunk %s.' % completed)
-
-        gdal.TermProgress_nocb(completed / total)
-
-        # run a thread that starts putting chunks with threads in a queue
-        queue = queues.Queue(maxsize=MAX_THREADS - 1)
-        fetch_kwargs = {
-            'subdomain': subdomain,
-            'session': session,
-            'uuid': uuid,
-            'time': time,
-            'srs': srs,
-        }
-        filler_kwargs = {
-            'chunks': self.target.get_chunks(start=completed + 1),
-            'queue': queue,
-            **fetch_kwargs,
-        }
-        filler_thread = threading.Thread(target=filler, kwargs=filler_kwargs)
-        filler_thread.daemon = True
-        filler_thread.start()
+        Flush the target before recording the chunks as completed. Call
+        this from the writer thread.
+        """
+        for dataset in self.target.datasets:
+            dataset.FlushCache()
+        self.indicator.save()
 
-        while True:
-            # fetch loaded chunks
-            try:
-                fetch_thread, chunk = queue.get()
-                fetch_thread.join()  # this makes sure the chunk is loaded
-            except TypeError:
-                self.indicator.set(completed)
-                break
-
-            # if the chunk failed, try again here
-            seconds = STATUS_RETRY_SECONDS.get(chunk.response.status_code)
-            if seconds is not None:
-                sleep(seconds)
-                chunk.fetch(**fetch_kwargs)
-
-            # abort on errors
-            if chunk.response.status_code != 200:
-                # remember last completed chunk
-                self.indicator.set(completed)
-
-                # abort
-                print('\nFailed to fetch a chunk! The url used was:')
-                print(chunk.response.url)
-                msg = 'The server responded with status code %s (%s).'
-                status_code = chunk.response.status_code
-                print(msg % (status_code, responses[status_code]))
-                exit()
 
-            # save the chunk to the target
-            self.target.save(chunk)
-            completed = chunk.serial
-            gdal.TermProgress_nocb(completed / total)
+def process(extractions, fetcher):
+    """
+    Extract the features concurrently.
+
+    :param extractions: iterable of RasterExtraction objects
+    :param fetcher: Fetcher object for the raster to extract from.
 
-        filler_thread.join()
+    The chunks of all extractions are fetched as a single stream, so that
+    the chunks of the next feature are requested as soon as there is room
+    next to the last chunks of the previous one. Extractions are taken
+    from the iterable only when their chunks are needed.
+
+    Writing is done by a writer thread, so that the compression of the
+    targets does not hold up the fetching.
+    """
+    active = set()
+
+    def get_chunks():
+        for extraction in extractions:
+            if not extraction.remaining:
+                print('Already complete.')
+                continue
+            active.add(extraction)
+            yield from extraction.get_chunks()
+
+    with writers.Writer() as writer:
+        try:
+            for chunk in fetcher.imap_unordered(get_chunks()):
+                extraction = chunk.extraction
+                if extraction.receive(chunk, writer):
+                    writer.call(extraction.save)
+                    writer.call(print, 'Completed %s.' % extraction.name)
+                    active.remove(extraction)
+        finally:
+            # remember completed chunks when aborting, unless writing failed
+            if writer.error is None:
+                for extraction in active:
+                    writer.call(extraction.save)
+                writer.flush()
+    print(writer.report())
 
 
 def readpass(username):
@@ -439,22 +808,20 @@ def readpass(username):
                 return value
 
 
-def rextract(shape_path, output_path, username, attribute, srs, **kwargs):
+def rextract(shape_path, output_path, username, attribute, srs, window,
+             rate, **kwargs):
     """
     Prepare and extract for each feature.
     """
     # session
-    if username is None:
-        # no login
-        session = requests
-    else:
+    session = requests.Session()
+    if username is not None:
         # obtain password
         password = readpass(username)
         if password is None:
             password = getpass.getpass('password for %s: ' % username)
 
-        # login, might be needed for every thread...
-        session = requests.Session()
+        # login
         session.post(
             url=LOGIN_URL % kwargs['subdomain'],
             headers={'User-Agent': USER_AGENT},
@@ -465,35 +832,53 @@ def rextract(shape_path, output_path, username, attribute, srs, **kwargs):
             print('Login failed.')
             exit()
 
+    # one fetcher shares the connections among all features
+    budget = Budget(window=window, rate=rate)
+    url = API_URL % kwargs['subdomain'] + '%s/data/'
+    fetcher = Fetcher(
+        session=session,
+        urls=[url % uuid for uuid in kwargs['uuids']],
+        time=kwargs['time'],
+        srs=srs,
+        window=window,
+        budget=budget,
+    )
+
     # extract
     sr = osr.SpatialReference(osr.GetUserInputAsWKT(srs))
     output_path.mkdir(exist_ok=True)
-    for layer in ogr.Open(shape_path):
-        layer_name = layer.GetName()
-        layer_path = output_path / layer_name
-        layer_path.mkdir(exist_ok=True)
-        for feature_no in range(layer.GetFeatureCount()):
-            feature = layer[feature_no]
-            geometry = feature.geometry()
-            geometry.AssignSpatialReference(sr)  # ignore original srs
-            try:
-                feature_name = feature[attribute]
-            except ValueError:
-                msg = 'Attribute "%s" not found in layer "%s"'
-                print(msg % (attribute, layer_name))
-                exit()
-            raster_extraction = RasterExtraction(
-                path=layer_path / feature_name,
-                geometry=geometry,
-                **kwargs,
-            )
-            raster_extraction.process(
-                session=session,
-                srs=srs,
-                subdomain=kwargs['subdomain'],
-                time=kwargs['time'],
-                uuid=kwargs['uuid']
-            )
+
+    def get_extractions():
+        for layer in ogr.Open(shape_path):
+            layer_name = layer.GetName()
+            layer_path = output_path / layer_name
+            layer_path.mkdir(exist_ok=True)
+            for feature_no in range(layer.GetFeatureCount()):
+                feature = layer[feature_no]
+                geometry = feature.geometry()
+                geometry.AssignSpatialReference(sr)  # ignore original srs
+                try:
+                    feature_name = feature[attribute]
+                except ValueError:
+                    msg = 'Attribute "%s" not found in layer "%s"'
+                    print(msg % (attribute, layer_name))
+                    exit()
+                yield RasterExtraction(
+                    path=layer_path / feature_name,
+                    geometry=geometry,
+                    **kwargs,
+                )
+
+    process(extractions=get_extractions(), fetcher=fetcher)
+
+
+def positive_float(text):
+    """ Return float for text, or raise an error for the parser. """
+    value = float(text)
+    if value <= 0:
+        msg = '%s is not a positive number' % text
+        raise argparse.ArgumentTypeError(msg)
+    return value
 
 
 def get_parser():
@@ -521,9 +906,13 @@ def get_parser():
         help='Directory to place output rasters.'
     )
     parser.add_argument(
-        'uuid',
+        'uuids',
         metavar='UUID',
-        help='UUID of the raster to extract.',
+        nargs='+',
+        help=(
+            'UUIDs of the rasters to extract. With more than one, a tif '
+            'is written per UUID, named after the feature and the UUID.'
+        ),
     )
     # options
     parser.add_argument(
@@ -558,6 +947,24 @@ def get_parser():
         dest='time',
         help='Timestamp.',
     )
+    parser.add_argument(
+        '-r', '--requests',
+        default=REQUESTS,
+        dest='window',
+        type=int,
+        help='Maximum number of requests in flight.',
+    )
+    parser.add_argument(
+        '-R', '--rate',
+        default=RATE,
+        type=positive_float,
+        help='Maximum number of requests per second.',
+    )
+    parser.add_argument(
+        '-m', '--multiband',
+        action='store_true',
+        help='Write a single tif with a band per UUID.',
+    )
     parser.add_argument(
         '-d', '--dtype',
         default=DTYPE,
@@ -576,42 +983,4 @@ def get_parser():
 
 def main():
     """ Call command with args from parser. """
-    lockpaths = (
-        "/tmp/rextract1.pid",
-        "/tmp/rextract2.pid",
-    )
-    for lockpath in lockpaths:
-        # check for (obsolete) lockfile
-        try:
-            with open(lockpath) as f:
-                pid = int(f.read())
-        except FileNotFoundError:
-            pass
-        except ValueError:
-            os.remove(lockpath)
-        else:
-            # https://stackoverflow.com/questions/568271
-            try:
-                os.kill(pid, 0)
-            except OSError:
-                os.remove(lockpath)
-            else:
-                # process is alive, on to the next lockpath
-                continue
-        # make a new lockfile, safely
-        try:
-            with open(lockpath, "x") as f:
-                f.write(str(os.getpid()) + '\n')
-        except FileExistsError:
-            # try another
-            continue
-        break
-    else:
-        print("Too many running instances of rextract.")
-        print("Run 'ps aux | grep rextract' to find out.")
-        return
-
-    try:
-        rextract(**vars(get_parser().parse_args()))
-    finally:
-        os.remove(lockpath)
+    rextract(**vars(get_parser().parse_args()))
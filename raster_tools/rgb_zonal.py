@@ -68,34 +68,35 @@ def command(image_path, source_path, target_path, calculation, part):
         attributes=['result'],
     )
 
-    for source_feature in source_features:
-        geometry = source_feature.geometry()
-
-        # skip large areas
-        if geometry.GetArea() > 1000:
-            continue
-
-        # retrieve raster data
-        try:
-            data, mask = image.read(geometry)
-        except RuntimeError:
-            continue
-
-        # skip incomplete data
-        if not mask.any() or not data.any():
-            continue
-
-        # debug image
-        # tmp = np.zeros_like(data)
-        # tmp[mask] = data[mask]
-        # from PIL import Image
-        # Image.fromarray(tmp.transpose(1, 2, 0)).show()
-
-        # apppend feature to output shapefile, with calculation result
-        (r, g, b) = (d[m] for d, m in zip(np.int64(data), mask))
-        attributes = source_feature.items()
-        attributes['result'] = eval(calculation)
-        target.append(geometry=geometry, attributes=attributes)
+    with target:
+        for source_feature in source_features:
+            geometry = source_feature.geometry()
+
+            # skip large areas
+            if geometry.GetArea() > 1000:
+                continue
+
+            # retrieve raster data
+            try:
+                data, mask = image.read(geometry)
+            except RuntimeError:
+                continue
+
+            # skip incomplete data
+            if not mask.any() or not data.any():
+                continue
+
+            # debug image
+            # tmp = np.zeros_like(data)
+            # tmp[mask] = data[mask]
+            # from PIL import Image
+            # Image.fromarray(tmp.transpose(1, 2, 0)).show()
+
+            # apppend feature to output shapefile, with calculation result
+            (r, g, b) = (d[m] for d, m in zip(np.int64(data), mask))
+            attributes = source_feature.items()
+            attributes['result'] = eval(calculation)
+            target.append(geometry=geometry, attributes=attributes)
 
 
 def main():
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+# (c) Nelen & Schuurmans, see LICENSE.rst.
+"""
+Distribute the features of an index over a pool of worker processes.
+
+Each worker process opens its own copy of the index and creates its own
+processing object, so that gdal and ogr handles are never shared between
+processes. Features are handed out one at a time to whichever worker is
+idle, so expensive tiles do not hold up the cheap ones.
+"""
+
+import multiprocessing
+
+from osgeo import gdal
+
+from raster_tools import datasources
+
+# state of a worker process, set by the pool initializer
+worker = {}
+
+
+def initialize(index_path, factory, method, kwargs):
+    """ Open index and create processing object in a worker process. """
+    worker['index'] = datasources.PartialDataSource(index_path)
+    worker['function'] = getattr(factory(**kwargs), method)
+
+
+def get_features(layer, item):
+    """ Return feature for a fid, or list of features for a batch of fids. """
+    if isinstance(item, int):
+        return layer[item]
+    return [layer[fid] for fid in item]
+
+
+def process(item):
+    """ Process a single feature or a batch in a worker process. """
+    features = get_features(worker['index'].layer, item)
+    return item, worker['function'](features)
+
+
+class Scheduler(object):
+    """
+    Usage:
+        >>> scheduler = Scheduler(index_path=index_path,
+        ...                       factory=Calculator,
+        ...                       method='calculate',
+        ...                       workers=8,
+        ...                       **kwargs)
+        >>> for feature, result in scheduler:
+        ...     # do things with the results in the main process.
+
+    The processing object is created as factory(**kwargs) and the method is
+    called with a feature as only argument. Results must be picklable. The
+    feature that is yielded with a result comes from the index in the main
+    process.
+
+    :param part: partial processing source, for example "2/3"
+    :param batches: sequences of fids to process together, instead of the
+        features of part. The method is then called with, and the results
+        are yielded with, a list of features per batch.
+    :param workers: number of worker processes, 0 for one per cpu. A single
+        worker processes the features in the main process.
+    :param ordered: yield the results in the order of the index, otherwise
+        in the order of completion.
+    """
+    def __init__(self, index_path, factory, method,
+                 part=None, workers=1, ordered=True, batches=None,
+                 **kwargs):
+        self.index = datasources.PartialDataSource(index_path)
+        if batches is None:
+            self.fids = self.index.get_fids(part)
+        else:
+            self.fids = batches
+
+        self.factory = factory
+        self.method = method
+        self.kwargs = kwargs
+
+        self.workers = workers or multiprocessing.cpu_count()
+        self.ordered = ordered
+
+    def __len__(self):
+        return len(self.fids)
+
+    def _serial(self):
+        """ Return generator of fid, result tuples. """
+        function = getattr(self.factory(**self.kwargs), self.method)
+        for fid in self.fids:
+            yield fid, function(get_features(self.index.layer, fid))
+
+    def _parallel(self, pool):
+        """ Return generator of fid, result tuples. """
+        imap = pool.imap if self.ordered else pool.imap_unordered
+        return imap(process, self.fids, chunksize=1)
+
+    def __iter__(self):
+        total = len(self)
+        gdal.TermProgress_nocb(0)
+
+        if self.workers == 1:
+            for count, (fid, result) in enumerate(self._serial(), 1):
+                yield get_features(self.index.layer, fid), result
+                gdal.TermProgress_nocb(count / total)
+            return
+
+        initargs = self.index.path, self.factory, self.method, self.kwargs
+        with multiprocessing.Pool(processes=self.workers,
+                                  initializer=initialize,
+                                  initargs=initargs) as pool:
+            for count, (fid, result) in enumerate(self._parallel(pool), 1):
+                yield get_features(self.index.layer, fid), result
+                gdal.TermProgress_nocb(count / total)
+
+    def run(self):
+        """ Process all features, discarding the results. """
+        for feature, result in self:
+            pass
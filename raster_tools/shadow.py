@@ -16,8 +16,8 @@ from scipy import ndimage
 import numpy as np
 
 from raster_tools import datasets
-from raster_tools import datasources
 from raster_tools import groups
+from raster_tools import scheduler
 
 logger = logging.getLogger(__name__)
 
@@ -39,13 +39,12 @@ class Shadower(object):
         azimuth = 216
         elevation = 57
 
-        # put the input raster(s) in a group
+        # put the input raster(s) in a group, only the intersecting ones
+        # are read from a directory
         if os.path.isdir(raster_path):
-            datasets = [gdal.Open(os.path.join(raster_path, path))
-                        for path in sorted(os.listdir(raster_path))]
+            self.group = groups.IndexedGroup.from_path(raster_path)
         else:
-            datasets = [gdal.Open(raster_path)]
-        self.group = groups.Group(*datasets)
+            self.group = groups.Group(gdal.Open(raster_path))
 
         slope = math.tan(math.radians(elevation))
         m_per_px = self.group.geo_transform[1]
@@ -159,18 +158,19 @@ class Shadower(object):
             driver.CreateCopy(path, dataset, options=options)
 
 
-def shadow(index_path, raster_path, output_path, part):
+def shadow(index_path, raster_path, output_path, part, workers):
     """
     """
-    index = datasources.PartialDataSource(index_path)
-    if part is not None:
-        index = index.select(part)
-
-    shadower = Shadower(output_path=output_path,
-                        raster_path=raster_path)
-
-    for feature in index:
-        shadower.shadow(feature)
+    scheduler.Scheduler(
+        index_path=index_path,
+        factory=Shadower,
+        method='shadow',
+        part=part,
+        workers=workers,
+        ordered=False,
+        output_path=output_path,
+        raster_path=raster_path,
+    ).run()
     return 0
 
 
@@ -198,6 +198,12 @@ def get_parser():
         '-p', '--part',
         help='partial processing source, for example "2/3"',
     )
+    parser.add_argument(
+        '-w', '--workers',
+        type=int,
+        default=1,
+        help='number of worker processes, 0 for one per cpu',
+    )
     parser.add_argument('-v', '--verbose', action='store_true')
     return parser
 
@@ -0,0 +1,843 @@
+# (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.rst.
+# -*- coding: utf-8 -*-
+
+from http import server
+from unittest import mock
+import os
+import pathlib
+import tempfile
+import threading
+import time
+import unittest
+
+from osgeo import gdal
+from osgeo import ogr
+from osgeo import osr
+import numpy as np
+import requests
+
+from raster_tools import datasets
+from raster_tools import datasources
+from raster_tools import rasterize
+from raster_tools import rextract
+from raster_tools import scheduler
+from raster_tools import upstream
+from raster_tools import writers
+from raster_tools import zonal
+
+BENCHMARK = os.environ.get('RASTER_TOOLS_BENCHMARK')
+
+
+class Handler(server.BaseHTTPRequestHandler):
+    """ Stand-in for the lizard raster endpoint. """
+    protocol_version = 'HTTP/1.1'  # keep connections alive
+
+    def do_GET(self):
+        with self.server.lock:
+            self.server.requests += 1
+            if self.server.failures:
+                self.server.failures -= 1
+                status, content = 503, b''
+            else:
+                status, content = 200, self.server.content
+        self.send_response(status)
+        self.send_header('Content-Type', 'image/tiff')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args):
+        pass
+
+
+class Identifier(object):
+    """ Stand-in for the processing objects of the scheduled tools. """
+    def __init__(self, offset):
+        self.offset = offset
+
+    def identify(self, feature):
+        return feature.GetFID() + self.offset
+
+    def identify_batch(self, features):
+        return [feature.GetFID() + self.offset for feature in features]
+
+
+class TestFetcher(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        # geotiff content
+        cls.array = np.arange(12, dtype='f4').reshape(1, 3, 4)
+        kwargs = {
+            'projection': 'EPSG:28992',
+            'geo_transform': (0, 1, 0, 3, 0, -1),
+        }
+        path = '/vsimem/tests/content.tif'
+        with datasets.Dataset(cls.array, **kwargs) as dataset:
+            gdal.GetDriverByName('GTiff').CreateCopy(path, dataset)
+        size = gdal.VSIStatL(path).size
+        handle = gdal.VSIFOpenL(path, 'rb')
+        content = gdal.VSIFReadL(1, size, handle)
+        gdal.VSIFCloseL(handle)
+        gdal.Unlink(path)
+
+        # server
+        cls.server = server.ThreadingHTTPServer(('localhost', 0), Handler)
+        cls.server.content = content
+        cls.server.lock = threading.Lock()
+        cls.thread = threading.Thread(target=cls.server.serve_forever)
+        cls.thread.daemon = True
+        cls.thread.start()
+        cls.url = 'http://localhost:%s/uuid/data/' % cls.server.server_port
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.server.requests = 0
+        self.server.failures = 0
+
+    def get_chunks(self, count):
+        kwargs = {'bbox': '0,0,4,3', 'width': 4, 'height': 3, 'origin': (0, 0)}
+        return [rextract.Chunk(serial=serial, **kwargs)
+                for serial in range(1, count + 1)]
+
+    def get_fetcher(self, window):
+        return rextract.Fetcher(session=requests.Session(),
+                                urls=[self.url],
+                                time='1970-01-01T00:00:00Z',
+                                srs='EPSG:28992',
+                                window=window)
+
+    def test_imap_unordered(self):
+        fetcher = self.get_fetcher(window=4)
+        chunks = fetcher.imap_unordered(self.get_chunks(count=9))
+        serials = []
+        for chunk in chunks:
+            serials.append(chunk.serial)
+            self.assertEqual(chunk.response.status_code, 200)
+            with chunk.as_dataset() as dataset:
+                array = dataset.ReadAsArray()
+            self.assertTrue(np.equal(array, self.array[0]).all())
+        self.assertEqual(sorted(serials), list(range(1, 10)))
+        self.assertEqual(self.server.requests, 9)
+
+    def test_retry(self):
+        self.server.failures = 2
+        fetcher = self.get_fetcher(window=1)
+        retry = {503: 0}
+        with mock.patch.object(rextract, 'STATUS_RETRY_SECONDS', retry):
+            chunk, = fetcher.imap_unordered(self.get_chunks(count=1))
+        self.assertEqual(chunk.response.status_code, 200)
+        self.assertEqual(self.server.requests, 3)
+
+    def test_give_up(self):
+        self.server.failures = 100
+        fetcher = self.get_fetcher(window=1)
+        retry = {503: 0}
+        with mock.patch.object(rextract, 'STATUS_RETRY_SECONDS', retry):
+            with mock.patch.object(rextract, 'RETRY_ATTEMPTS', 1):
+                chunk, = fetcher.imap_unordered(self.get_chunks(count=1))
+        self.assertEqual(chunk.response.status_code, 503)
+        self.assertEqual(self.server.requests, 2)
+
+
+class TestBudget(unittest.TestCase):
+    def test_window(self):
+        budget = rextract.Budget(window=3)
+        lock = threading.Lock()
+        counts = {'current': 0, 'maximum': 0}
+
+        def request():
+            with budget:
+                with lock:
+                    counts['current'] += 1
+                    counts['maximum'] = max(counts.values())
+                time.sleep(0.01)
+                with lock:
+                    counts['current'] -= 1
+
+        threads = [threading.Thread(target=request) for i in range(12)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(counts['maximum'], 3)
+
+    def test_rate(self):
+        budget = rextract.Budget(window=4, rate=50)
+        start = time.perf_counter()
+        for i in range(75):
+            with budget:
+                pass
+        # a burst of 50 requests, then 25 more at 50 per second
+        self.assertGreater(time.perf_counter() - start, 0.45)
+
+    def test_parser(self):
+        parser = rextract.get_parser()
+        args = ['shape.shp', 'output', 'uuid']
+        self.assertIsNone(parser.parse_args(args).rate)
+        self.assertEqual(parser.parse_args(args + ['-R', '2.5']).rate, 2.5)
+        for rate in '0', '-1', 'x':
+            with mock.patch('sys.stderr'):
+                with self.assertRaises(SystemExit):
+                    parser.parse_args(args + ['-R', rate])
+
+
+class TestIndicator(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.path = pathlib.Path(self.temp_dir.name) / 'feature'
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_resume(self):
+        indicator = rextract.Indicator(path=self.path, size=11)
+        self.assertEqual(len(indicator), 0)
+        for serial in (9, 2, 11):
+            indicator.set(serial)
+        indicator.save()
+
+        indicator = rextract.Indicator(path=self.path, size=11)
+        self.assertEqual(len(indicator), 3)
+        serials = indicator.get_serials().tolist()
+        self.assertEqual(serials, [1, 3, 4, 5, 6, 7, 8, 10])
+
+    def test_legacy(self):
+        legacy_path = self.path.with_suffix('.pro')
+        legacy_path.write_text('4\n')
+        indicator = rextract.Indicator(path=self.path, size=6)
+        self.assertEqual(indicator.get_serials().tolist(), [5, 6])
+
+        indicator.set(6)
+        indicator.save()
+        self.assertFalse(legacy_path.exists())
+        indicator = rextract.Indicator(path=self.path, size=6)
+        self.assertEqual(indicator.get_serials().tolist(), [5])
+
+    def test_layout(self):
+        indicator = rextract.Indicator(path=self.path, size=4, layout='a')
+        indicator.set(2)
+        indicator.save()
+
+        # same layout
+        indicator = rextract.Indicator(path=self.path, size=4, layout='a')
+        self.assertEqual(indicator.get_serials().tolist(), [1, 3, 4])
+
+        # other layout or size
+        for layout, size in ('a,b', 8), ('a,b', 4), ('a', 5):
+            indicator = rextract.Indicator(
+                path=self.path, size=size, layout=layout,
+            )
+            self.assertEqual(len(indicator), 0)
+
+    def test_headerless(self):
+        completed = np.array([1, 0, 1, 0, 0, 0], dtype='b1')
+        np.packbits(completed).tofile(str(self.path.with_suffix('.bits')))
+        indicator = rextract.Indicator(path=self.path, size=6, legacy=True)
+        self.assertEqual(indicator.get_serials().tolist(), [2, 4, 5, 6])
+        indicator = rextract.Indicator(path=self.path, size=6, legacy=False)
+        self.assertEqual(len(indicator), 0)
+
+
+class TestIndex(unittest.TestCase):
+    def setUp(self):
+        # 4 x 4 blocks of 16 x 16 pixels
+        path = '/vsimem/tests/index.tif'
+        options = ['tiled=yes', 'blockxsize=16', 'blockysize=16']
+        driver = gdal.GetDriverByName('GTiff')
+        self.dataset = driver.Create(path, 64, 64, 1, options=options)
+        self.dataset.SetGeoTransform((0, 1, 0, 64, 0, -1))
+        gdal.Unlink(path)
+
+    def get_index(self, wkt):
+        geometry = ogr.CreateGeometryFromWkt(wkt)
+        return rextract.Index(dataset=self.dataset, geometry=geometry)
+
+    def test_interior(self):
+        index = self.get_index('POLYGON ((8 8, 56 8, 56 56, 8 56, 8 8))')
+        self.assertEqual(len(index), 16)
+        self.assertEqual(index.interior.sum(), 4)
+        for chunk in index.get_chunks(range(1, 17)):
+            x, y = chunk.origin
+            if 16 <= x < 48 and 16 <= y < 48:
+                self.assertIsNone(chunk.geometry)
+            else:
+                # clipped to the chunk with a margin of one pixel
+                x1, x2, y1, y2 = chunk.geometry.GetEnvelope()
+                self.assertGreaterEqual(x1, x - 1)
+                self.assertLessEqual(x2, x + 17)
+
+    def test_hole(self):
+        index = self.get_index(
+            'POLYGON ((0 0, 64 0, 64 64, 0 64, 0 0),'
+            ' (20 20, 44 20, 44 44, 20 44, 20 20))',
+        )
+        self.assertEqual(len(index), 16)
+        self.assertEqual(index.interior.sum(), 12)
+
+
+class TestTarget(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.path = pathlib.Path(self.temp_dir.name) / 'feature'
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def get_geometry(self):
+        sr = osr.SpatialReference(osr.GetUserInputAsWKT('EPSG:28992'))
+        return ogr.CreateGeometryFromWkt(
+            'POLYGON ((0 0, 300 0, 300 300, 0 300, 0 0))', sr,
+        )
+
+    def get_target(self, multiband):
+        return rextract.Target(path=self.path,
+                               geometry=self.get_geometry(),
+                               dtype='f4',
+                               fillvalue=None,
+                               uuids=['dem', 'landuse'],
+                               multiband=multiband,
+                               cellsize=0.5,
+                               subdomain='demo',
+                               time=rextract.TIMESTAMP)
+
+    def test_multiband(self):
+        target = self.get_target(multiband=True)
+        dataset, = target.datasets
+        self.assertEqual(dataset.RasterCount, 2)
+        self.assertEqual(len(target), 2 * len(target.index))
+
+    def test_separate(self):
+        target = self.get_target(multiband=False)
+        self.assertEqual(len(target.datasets), 2)
+        self.assertTrue(self.path.with_name('feature_landuse.tif').exists())
+
+    def test_rerun(self):
+        # complete with one uuid
+        kwargs = {
+            'path': self.path,
+            'geometry': self.get_geometry(),
+            'dtype': 'f4',
+            'fillvalue': None,
+            'cellsize': 0.5,
+            'subdomain': 'demo',
+            'time': rextract.TIMESTAMP,
+        }
+        extraction = rextract.RasterExtraction(uuids=['dem'], **kwargs)
+        for serial in range(1, len(extraction.target) + 1):
+            extraction.indicator.set(serial)
+        extraction.save()
+        extraction = rextract.RasterExtraction(uuids=['dem'], **kwargs)
+        self.assertEqual(extraction.remaining, 0)
+
+        # rerun with more uuids in separate files starts from scratch
+        extraction = rextract.RasterExtraction(
+            uuids=['dem', 'landuse'], multiband=False, **kwargs
+        )
+        self.assertEqual(extraction.remaining, len(extraction.target))
+
+    def test_rerun_multiband(self):
+        # complete with one uuid
+        kwargs = {
+            'path': self.path,
+            'geometry': self.get_geometry(),
+            'dtype': 'f4',
+            'fillvalue': None,
+            'cellsize': 0.5,
+            'subdomain': 'demo',
+            'time': rextract.TIMESTAMP,
+        }
+        extraction = rextract.RasterExtraction(uuids=['dem'], **kwargs)
+        for serial in range(1, len(extraction.target) + 1):
+            extraction.indicator.set(serial)
+        extraction.save()
+        extraction = None
+
+        # rerun into the same multiband tif recreates it
+        extraction = rextract.RasterExtraction(
+            uuids=['dem', 'landuse'], multiband=True, **kwargs
+        )
+        self.assertEqual(extraction.remaining, len(extraction.target))
+        dataset, = extraction.target.datasets
+        self.assertEqual(dataset.RasterCount, 2)
+        for dataset, number in extraction.target.bands:
+            self.assertIsNotNone(dataset.GetRasterBand(number))
+
+    def test_chunks(self):
+        target = self.get_target(multiband=True)
+        keys = np.arange(2, len(target) + 1)
+        chunks = list(target.get_chunks(keys))
+        self.assertEqual([target.get_key(c) for c in chunks], keys.tolist())
+        self.assertEqual([c.band for c in chunks[:3]], [1, 0, 1])
+        self.assertEqual(chunks[1].serial, chunks[2].serial)
+
+
+class TestAggregate(unittest.TestCase):
+    def test_numpy(self):
+        random_state = np.random.RandomState(0)
+        labels = random_state.randint(0, 5, 200)
+        values = random_state.randint(0, 20, 200).astype('f4')
+        values[values == 19] = -9999  # no data
+        labels[labels == 3] = 4  # label 3 without elements
+        actions = zonal.Analyzer.get_actions([
+            'count', 'size', 'sum', 'mean', 'min', 'max', 'ptp', 'var',
+            'std', 'median', 'p10', 'p75', 'average',
+        ])
+        results = zonal.aggregate(labels=labels,
+                                  values=values,
+                                  number=5,
+                                  actions=actions,
+                                  no_data_value=-9999)
+
+        for label, result in enumerate(results):
+            size = np.sum(labels == label)
+            array = values[(labels == label) & (values != -9999)]
+            self.assertEqual(result['size'], size)
+            self.assertEqual(result['count'], array.size)
+            if not array.size:
+                self.assertTrue(np.isnan(result['mean']))
+                self.assertTrue(np.isnan(result['sum']))
+                continue
+            array = array.astype('f8')
+            for column, (action, args) in actions.items():
+                if action in ('count', 'size'):
+                    continue
+                expected = getattr(np, action)(array, *args)
+                self.assertAlmostEqual(result[column], expected, places=5)
+
+
+class TestBatchAnalyzer(unittest.TestCase):
+    def test_analyze_batch(self):
+        # raster with a hole of no data
+        array = np.arange(400, dtype='f4').reshape(1, 20, 20)
+        array[0, 5:8, 5:8] = -9999
+        path = '/vsimem/tests/zonal.tif'
+        kwargs = {'projection': 'EPSG:28992',
+                  'geo_transform': (0, 1, 0, 20, 0, -1),
+                  'no_data_value': -9999}
+        with datasets.Dataset(array, **kwargs) as dataset:
+            gdal.GetDriverByName('GTiff').CreateCopy(path, dataset)
+
+        # two overlapping features and a separate one
+        sr = osr.SpatialReference(osr.GetUserInputAsWKT('EPSG:28992'))
+        data_source = ogr.GetDriverByName('Memory').CreateDataSource('')
+        layer = data_source.CreateLayer('', sr)
+        for wkt in ('POLYGON ((1 1,9 1,9 9,1 9,1 1))',
+                    'POLYGON ((4 4,14 4,14 12,4 12,4 4))',
+                    'POLYGON ((15 15,19 15,17 19,15 15))'):
+            feature = ogr.Feature(layer.GetLayerDefn())
+            feature.SetGeometry(ogr.CreateGeometryFromWkt(wkt, sr))
+            layer.CreateFeature(feature)
+        features = list(datasources.iter_layer(layer))
+
+        kwargs = {'raster_paths': [path],
+                  'statistics': ['count', 'size', 'mean', 'p90', 'max']}
+        analyzer = zonal.Analyzer(**kwargs)
+        expected = [analyzer.analyze(feature) for feature in features]
+        result = zonal.BatchAnalyzer(**kwargs).analyze_batch(features)
+
+        # the large feature in blocks of 4 x 4 pixels
+        with mock.patch.object(zonal, 'STREAM_SIZE', 4):
+            streamed = [analyzer.analyze(feature) for feature in features]
+        gdal.Unlink(path)
+
+        for results in result, streamed:
+            self.assertEqual(len(results), len(expected))
+            for attributes1, attributes2 in zip(results, expected):
+                self.assertEqual(attributes1.keys(), attributes2.keys())
+                for key, value in attributes2.items():
+                    self.assertAlmostEqual(attributes1[key], value, places=4)
+
+
+class TestStreaming(unittest.TestCase):
+    def setUp(self):
+        random_state = np.random.RandomState(0)
+        self.data = (random_state.standard_normal(10000) * 100).astype('f4')
+        self.blocks = np.array_split(self.data, 7)
+        self.moments = zonal.Moments()
+        for block in self.blocks:
+            self.moments.add(block, block.size + 1)
+
+    def stream(self):
+        return iter(self.blocks)
+
+    def get_percentile(self, select, q):
+        lower, upper, fraction = zonal.get_ranks(self.data.size, q)
+        selected = select(stream=self.stream,
+                          ranks={lower, upper},
+                          minimum=self.moments.minimum,
+                          maximum=self.moments.maximum)
+        lo, hi = selected[lower], selected[upper]
+        return lo + (hi - lo) * fraction
+
+    def test_moments(self):
+        data = self.data.astype('f8')
+        self.assertEqual(self.moments.get('size'), data.size + 7)
+        self.assertEqual(self.moments.get('count'), data.size)
+        for action in 'sum', 'mean', 'var', 'std', 'min', 'ptp':
+            self.assertAlmostEqual(self.moments.get(action),
+                                   getattr(np, action)(data))
+
+    def test_exact(self):
+        for q in 0, 10, 50, 99.9, 100:
+            self.assertEqual(self.get_percentile(zonal.select_exact, q),
+                             np.percentile(self.data, q))
+
+    def test_approximate(self):
+        width = (self.data.max() - self.data.min()) / zonal.BINS
+        for q in 0, 10, 50, 99.9, 100:
+            self.assertAlmostEqual(
+                self.get_percentile(zonal.select_approximate, q),
+                np.percentile(self.data, q),
+                delta=width,
+            )
+
+
+class TestTargetDataSource(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.template_path = os.path.join(self.temp_dir.name, 'template.shp')
+        driver = ogr.GetDriverByName('ESRI Shapefile')
+        data_source = driver.CreateDataSource(self.template_path)
+        sr = osr.SpatialReference(osr.GetUserInputAsWKT('EPSG:28992'))
+        layer = data_source.CreateLayer('template', sr)
+        layer.CreateField(ogr.FieldDefn('name', ogr.OFTString))
+        data_source = None
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def write(self, name, count, **kwargs):
+        """ Return path of target with count features. """
+        path = os.path.join(self.temp_dir.name, name)
+        target = datasources.TargetDataSource(path=path,
+                                              template_path=self.template_path,
+                                              attributes=['value'],
+                                              **kwargs)
+        with target:
+            for i in range(count):
+                geometry = ogr.CreateGeometryFromWkt('POINT (%s 0)' % i)
+                attributes = {'name': 'p%s' % i, 'value': i / 2}
+                target.append(geometry=geometry, attributes=attributes)
+        return path
+
+    def test_extensions(self):
+        for name in 'target.shp', 'target.gpkg', 'target.fgb':
+            path = self.write(name=name, count=7, transaction=3)
+            layer = ogr.Open(path)[0]
+            features = list(datasources.iter_layer(layer))
+            self.assertEqual(len(features), 7)
+            self.assertEqual(features[5]['name'], 'p5')
+            self.assertEqual(features[5]['value'], 2.5)
+
+    @unittest.skipUnless(BENCHMARK, 'set RASTER_TOOLS_BENCHMARK to run')
+    def test_benchmark(self):
+        count = 100000
+        for name in 'target.shp', 'target.gpkg', 'target.fgb':
+            start = time.perf_counter()
+            self.write(name=name, count=count)
+            elapsed = time.perf_counter() - start
+            print('%s: %.0f features/s' % (name, count / elapsed))
+
+
+class Cursor(object):
+    """ Stand-in for a psycopg2 cursor, recording the queries. """
+    def __init__(self, connection, name):
+        self.connection = connection
+        self.name = name
+        self.itersize = 2000
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def execute(self, query, parameters):
+        self.connection.executed.append((self.name, query, parameters))
+
+    def fetchall(self):
+        return list(self)
+
+    def __iter__(self):
+        self.connection.itersizes.append(self.itersize)
+        return iter(self.connection.rows)
+
+
+class Connection(object):
+    """ Stand-in for a psycopg2 connection. """
+    def __init__(self, rows):
+        self.rows = rows
+        self.executed = []
+        self.itersizes = []
+
+    def cursor(self, name=None):
+        return Cursor(connection=self, name=name)
+
+
+class TestPGLayer(unittest.TestCase):
+    def setUp(self):
+        wkbs = [ogr.CreateGeometryFromWkt(
+            'POLYGON (({0} 0, {1} 0, {1} 1, {0} 1, {0} 0))'.format(i, i + 1),
+        ).ExportToWkb() for i in range(5)]
+        rows = [(memoryview(wkb), i) for i, wkb in enumerate(wkbs)]
+        self.connection = Connection(rows=rows)
+        self.layer = rasterize.PGLayer(connection=self.connection,
+                                       schema='public',
+                                       table='landuse')
+        geometry = ogr.CreateGeometryFromWkt(
+            'POLYGON ((0 0, 5 0, 5 1, 0 1, 0 0))',
+        )
+        self.layer.SetSpatialFilter(geometry)
+
+    def test_as_ogr_layer(self):
+        data_source, layer = self.layer.as_ogr_layer(name='value', sr=None)
+        self.assertEqual(layer.GetFeatureCount(), 5)
+        self.assertEqual([f['value'] for f in layer], list(range(5)))
+        self.assertEqual(layer[3].geometry().GetEnvelope(), (3, 4, 0, 1))
+
+    def test_server_side_cursor(self):
+        self.layer.as_ogr_layer(name='value', sr=None)
+        # a single query on a named cursor, without counting first
+        (name, query, parameters), = self.connection.executed
+        self.assertEqual(name, 'rasterize')
+        self.assertEqual(parameters, (0, 0, 5, 1))
+        self.assertEqual(self.connection.itersizes, [rasterize.ITERSIZE])
+
+
+class TestUpstream(unittest.TestCase):
+    def get_kwargs(self, array, polygon, linestring, path):
+        """ Return keyword arguments of a case for a raster. """
+        kwargs = {'projection': 'EPSG:28992',
+                  'geo_transform': (0, 1, 0, array.shape[1], 0, -1),
+                  'no_data_value': -9999}
+        options = ['tiled=yes', 'compress=deflate']
+        with datasets.Dataset(array, **kwargs) as dataset:
+            gdal.GetDriverByName('GTiff').CreateCopy(
+                path, dataset, options=options,
+            )
+        group = upstream.MinimumGroup([path])
+        return {'group': group, 'polygon': polygon, 'distance': 3,
+                'multiplier': 0.5, 'separation': 2.5,
+                'linestring': linestring}
+
+    def get_levels(self, case, reverse):
+        """ Return list of coordinates, level tuples. """
+        return [(point.GetPoints()[0], level)
+                for point, level in case.get_levels(reverse)]
+
+    def test_vectorized(self):
+        # random raster, with some no data
+        random_state = np.random.RandomState(0)
+        array = random_state.uniform(0, 10, (1, 20, 40)).astype('f4')
+        array[0, 5:8, 20:23] = -9999
+
+        # a polygon with a notch, for irregular search areas
+        polygon = ogr.CreateGeometryFromWkt(
+            'POLYGON ((2.3 2.2, 37.6 2.2, 37.6 17.7, 20.4 17.7, 20.4 9.3,'
+            ' 18.6 9.3, 18.6 17.7, 2.3 17.7, 2.3 2.2))',
+        )
+        linestring = ogr.CreateGeometryFromWkt('LINESTRING (5 6.1, 35 7.3)')
+        path = '/vsimem/tests/upstream.tif'
+        kwargs = self.get_kwargs(array, polygon, linestring, path)
+        case = upstream.Case(**kwargs)
+        vectorized = upstream.VectorizedCase(
+            data=kwargs['group'].read(bounds=polygon), **kwargs
+        )
+
+        # the same points should get the same levels
+        for reverse in False, True:
+            expected = self.get_levels(case, reverse)
+            self.assertGreater(len(expected), 10)
+            self.assertEqual(self.get_levels(vectorized, reverse), expected)
+        gdal.Unlink(path)
+
+    @unittest.skipUnless(BENCHMARK, 'set RASTER_TOOLS_BENCHMARK to run')
+    def test_benchmark(self):
+        # a waterway of 4 km in a strip of 40 m
+        random_state = np.random.RandomState(0)
+        array = random_state.uniform(0, 10, (1, 60, 4000)).astype('f4')
+        polygon = ogr.CreateGeometryFromWkt(
+            'POLYGON ((10 10, 3990 10, 3990 50, 10 50, 10 10))',
+        )
+        linestring = ogr.CreateGeometryFromWkt(
+            'LINESTRING (20 30, 1000 25, 2000 35, 3000 28, 3980 30)',
+        )
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, 'upstream.tif')
+            kwargs = self.get_kwargs(array, polygon, linestring, path)
+            results = []
+            for vectorized in False, True:
+                start = time.perf_counter()
+                if vectorized:
+                    data = kwargs['group'].read(bounds=polygon)
+                    case = upstream.VectorizedCase(data=data, **kwargs)
+                else:
+                    case = upstream.Case(**kwargs)
+                results.append(self.get_levels(case, False))
+                elapsed = time.perf_counter() - start
+                print('%s: %.0f points/s' % (
+                    case.__class__.__name__, len(results[-1]) / elapsed,
+                ))
+        self.assertEqual(results[0], results[1])
+
+
+class TestWriter(unittest.TestCase):
+    def test_write(self):
+        driver = gdal.GetDriverByName('MEM')
+        dataset = driver.Create('', 4, 3, 2, gdal.GDT_Float32)
+        array = np.ones((2, 2), dtype='f4')
+        with writers.Writer() as writer:
+            writer.write(dataset=dataset, array=array, origin=(1, 1), band=2)
+        expected = np.zeros((3, 4), dtype='f4')
+        expected[1:, 1:3] = 1
+        np.testing.assert_array_equal(
+            dataset.GetRasterBand(2).ReadAsArray(), expected,
+        )
+
+    def test_order(self):
+        calls = []
+        with writers.Writer(size=2) as writer:
+            for i in range(100):
+                writer.call(calls.append, i)
+        self.assertEqual(calls, list(range(100)))
+        self.assertLessEqual(writer.maximum, 2)
+
+    def test_error(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        path = pathlib.Path(temp_dir.name) / 'feature'
+        indicator = rextract.Indicator(path=path, size=4)
+        writer = writers.Writer()
+        with self.assertRaises(ValueError):
+            writer.call(indicator.set, 1)
+            writer.call(int, 'x')  # a failing write
+            writer.call(indicator.set, 2)  # skipped after the error
+            writer.flush()
+
+        # the writer keeps failing and runs nothing anymore
+        for call in (lambda: writer.call(indicator.save),
+                     writer.flush,
+                     writer.close):
+            with self.assertRaises(ValueError):
+                call()
+        self.assertEqual(indicator.get_serials().tolist(), [2, 3, 4])
+        self.assertFalse(indicator.path.exists())
+        temp_dir.cleanup()
+
+    def test_exit(self):
+        calls = []
+        with self.assertRaises(KeyError):
+            with writers.Writer() as writer:
+                writer.call(time.sleep, 0.1)
+                writer.call(calls.append, 1)  # dropped
+                raise KeyError
+        self.assertEqual(calls, [])
+
+    def test_process_error(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        sr = osr.SpatialReference(osr.GetUserInputAsWKT('EPSG:28992'))
+        geometry = ogr.CreateGeometryFromWkt(
+            'POLYGON ((0 0, 300 0, 300 300, 0 300, 0 0))', sr,
+        )
+        extraction = rextract.RasterExtraction(
+            path=pathlib.Path(temp_dir.name) / 'feature',
+            geometry=geometry,
+            dtype='f4',
+            fillvalue=None,
+            uuids=['dem'],
+            cellsize=0.5,
+            subdomain='demo',
+            time=rextract.TIMESTAMP,
+        )
+
+        def save(chunk, writer):
+            # the write of the second chunk fails
+            writer.call(int, 'x' if chunk.serial == 2 else '1')
+
+        def imap_unordered(chunks):
+            for chunk in chunks:
+                chunk.response = mock.Mock(status_code=200)
+                yield chunk
+
+        fetcher = mock.Mock(imap_unordered=imap_unordered)
+        with mock.patch.object(extraction.target, 'save', save):
+            with self.assertRaises(ValueError):
+                rextract.process(extractions=[extraction], fetcher=fetcher)
+
+        # nothing after the failed write is marked or saved
+        self.assertFalse(extraction.indicator.completed[1:].any())
+        self.assertFalse(extraction.indicator.path.exists())
+        temp_dir.cleanup()
+
+
+class TestScheduler(unittest.TestCase):
+    def setUp(self):
+        # index of 9 features
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.index_path = os.path.join(self.temp_dir.name, 'index.shp')
+        driver = ogr.GetDriverByName('ESRI Shapefile')
+        data_source = driver.CreateDataSource(self.index_path)
+        sr = osr.SpatialReference(osr.GetUserInputAsWKT('EPSG:28992'))
+        layer = data_source.CreateLayer('index', sr)
+        for i in range(9):
+            feature = ogr.Feature(layer.GetLayerDefn())
+            feature.SetGeometry(ogr.CreateGeometryFromWkt(
+                'POLYGON (({0} 0, {1} 0, {1} 1, {0} 1, {0} 0))'.format(
+                    i, i + 1,
+                ),
+            ))
+            layer.CreateFeature(feature)
+        data_source = None
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def schedule(self, **kwargs):
+        """ Return list of fid, result tuples. """
+        return [(feature.GetFID(), result)
+                for feature, result in scheduler.Scheduler(
+                    index_path=self.index_path,
+                    factory=Identifier,
+                    offset=100,
+                    **kwargs
+                )]
+
+    def test_serial(self):
+        expected = [(fid, fid + 100) for fid in range(9)]
+        self.assertEqual(self.schedule(method='identify'), expected)
+
+    def test_parallel(self):
+        expected = self.schedule(method='identify', workers=1)
+        self.assertEqual(
+            self.schedule(method='identify', workers=2), expected,
+        )
+        self.assertEqual(
+            sorted(self.schedule(method='identify',
+                                 workers=2,
+                                 ordered=False)),
+            expected,
+        )
+
+    def test_part(self):
+        for workers in 1, 2:
+            self.assertEqual(
+                self.schedule(method='identify', part='2/3', workers=workers),
+                [(3, 103), (4, 104), (5, 105)],
+            )
+
+    def test_batches(self):
+        batches = [[0, 1], [5], [8, 2, 3]]
+        for workers in 1, 2:
+            results = list(scheduler.Scheduler(index_path=self.index_path,
+                                               factory=Identifier,
+                                               method='identify_batch',
+                                               batches=batches,
+                                               workers=workers,
+                                               offset=100))
+            self.assertEqual(len(results), 3)
+            for batch, (features, result) in zip(batches, results):
+                self.assertEqual([f.GetFID() for f in features], batch)
+                self.assertEqual(result, [fid + 100 for fid in batch])
@@ -2,6 +2,10 @@
 """
 Find lowest upstream points along a line within a polygon using
 combined data from raster stores.
+
+The vectorized mode reads the raster once per polygon and takes the window
+of each search area from it, instead of reading the raster per search area.
+The search areas and levels are the same as those of the regular mode.
 """
 
 import argparse
@@ -13,6 +17,7 @@ import numpy as np
 
 from raster_tools import datasources
 from raster_tools import groups
+from raster_tools import scheduler
 
 
 POINT = 'POINT({} {})'
@@ -78,6 +83,19 @@ def get_parser():
         '-p', '--partial',
         help='Partial processing source, for example "2/3"',
     )
+    parser.add_argument(
+        '-w', '--workers',
+        type=int,
+        default=1,
+        metavar='',
+        help='Number of worker processes, 0 for one per cpu (default 1).',
+    )
+    parser.add_argument(
+        '-v', '--vectorized',
+        action='store_true',
+        help=('Read the raster once per polygon instead of once per'
+              ' search area, for identical levels.'),
+    )
     return parser
 
 
@@ -89,6 +107,8 @@ def point2geometry(point, sr):
 class MinimumGroup(object):
     def __init__(self, paths):
         self.groups = [groups.Group(gdal.Open(path)) for path in paths]
+        self.geo_transform = self.groups[0].geo_transform
+        self.projection = self.groups[0].projection
 
     def read(self, bounds):
         """
@@ -117,6 +137,7 @@ class Case(object):
         self.linestring = linestring
         self.separation = separation
         self.sr = linestring.GetSpatialReference()
+        self.boundary = polygon.Boundary()
 
     def get_pairs(self, reverse):
         """ Return generator of point pairs. """
@@ -161,90 +182,137 @@ class Case(object):
         wkt = 'POLYGON ((' + ','.join(points) + '))'
         return ogr.CreateGeometryFromWkt(wkt, sr)
 
+    def get_area(self, point, direction):
+        """ Return area to search for a point inside the polygon. """
+        radius = max(
+            self.distance,
+            self.multiplier * point.Distance(self.boundary),
+        )
+        circle = point.Buffer(radius)
+        rectangle = self.make_rectangle(point=point,
+                                        radius=radius,
+                                        direction=direction)
+        intersection = circle.Intersection(rectangle)
+
+        return self.polygon.Intersection(intersection)
+
     def get_areas(self, reverse):
         """ Return generator of point, area tuples. """
         for point, direction in self.get_sites(reverse):
             if not self.polygon.Contains(point):
                 continue
-            radius = max(
-                self.distance,
-                self.multiplier * point.Distance(self.polygon.Boundary()),
+            yield point, self.get_area(point=point, direction=direction)
+
+    def read(self, polygon):
+        """ Return data for the envelope of polygon. """
+        return self.group.read(bounds=polygon)
+
+    def get_level(self, point, polygon):
+        """ Return level for a point and its area, or None. """
+        if polygon.GetGeometryName() == 'MULTIPOLYGON':
+            # keep reference to original collection or segfault
+            collection = polygon
+            polygon = min(collection, key=point.Distance)
+            polygon.AssignSpatialReference(
+                collection.GetSpatialReference(),
             )
-            circle = point.Buffer(radius)
-            rectangle = self.make_rectangle(point=point,
-                                            radius=radius,
-                                            direction=direction)
-            intersection = circle.Intersection(rectangle)
 
-            yield point, self.polygon.Intersection(intersection)
+        # get data from store
+        data = self.read(polygon)
+        values = data['values']
+        array = values[values != data['no_data_value']]
+        if array.size < 2:
+            return
+        level = array[array.argsort()[1]].item()
+        # print(level)
+        # if level < -4.8:
+        #     from raster_analysis import plots
+        #     plot = plots.Plot()
+        #     ma = np.ma.masked_equal(data['values'],
+        #                             data['no_data_value'])
+        #     plot.add_array(ma[0], extent=polygon.GetEnvelope())
+        #     #plot.add_geometries(point, polygon, self.polygon)
+        #     plot.add_geometries(point, polygon)
+        #     plot.show()
+        return level
 
     def get_levels(self, reverse):
         """ Return generator point, level tuples. """
         for point, polygon in self.get_areas(reverse):
-
-            if polygon.GetGeometryName() == 'MULTIPOLYGON':
-                # keep reference to original collection or segfault
-                collection = polygon
-                polygon = min(collection, key=point.Distance)
-                polygon.AssignSpatialReference(
-                    collection.GetSpatialReference(),
-                )
-
-            # get data from store
-            data = self.group.read(bounds=polygon)
-            values = data['values']
-            array = values[values != data['no_data_value']]
-            if not array.size:
+            level = self.get_level(point=point, polygon=polygon)
+            if level is None:
                 continue
-            level = array[array.argsort()[1]].item()
-            # print(level)
-            # if level < -4.8:
-            #     from raster_analysis import plots
-            #     plot = plots.Plot()
-            #     ma = np.ma.masked_equal(data['values'],
-            #                             data['no_data_value'])
-            #     plot.add_array(ma[0], extent=polygon.GetEnvelope())
-            #     #plot.add_geometries(point, polygon, self.polygon)
-            #     plot.add_geometries(point, polygon)
-            #     plot.show()
             yield point, level
 
 
-def upstream(polygon_path, linestring_path, raster_paths,
-             grow, distance, multiplier, separation, path, partial):
-    # open files
-    linestring_features = datasources.PartialDataSource(linestring_path)
-    group = MinimumGroup(raster_paths)
-    target = datasources.TargetDataSource(
-        path=path,
-        template_path=linestring_path,
-        attributes=[KEY],
-    )
-
-    # select some or all polygons
-    source = datasources.PartialDataSource(polygon_path)
-    if partial is None:
-        polygon_features = source
-    else:
-        polygon_features = source.select(partial)
+class VectorizedCase(Case):
+    """
+    Search in a window of raster data that is read beforehand, instead of
+    reading the raster for every search area.
+
+    :param data: dictionary with values and no_data_value of the window
+        read for the polygon
+    """
+    def __init__(self, data, **kwargs):
+        super().__init__(**kwargs)
+        self.data = data
+        self.origin = self.group.geo_transform.get_indices(self.polygon)[:2]
+
+    def read(self, polygon):
+        """ Return data for the envelope of polygon from the window. """
+        x1, y1, x2, y2 = self.group.geo_transform.get_indices(polygon)
+        u, v = self.origin
+        return {
+            'values': self.data['values'][y1 - v:y2 - v, x1 - u:x2 - u],
+            'no_data_value': self.data['no_data_value'],
+        }
+
+
+class Searcher(object):
+    def __init__(self, linestring_path, raster_paths,
+                 grow, distance, multiplier, separation, vectorized=False):
+        self.linestring_features = datasources.PartialDataSource(
+            linestring_path,
+        )
+        self.group = MinimumGroup(raster_paths)
+        self.grow = grow
+        self.distance = distance
+        self.multiplier = multiplier
+        self.separation = separation
+        self.vectorized = vectorized
 
-    for polygon_feature in polygon_features:
+    def search(self, polygon_feature):
+        """
+        Return list of (fid, points, levels) tuples, where fid refers to
+        a linestring feature and points are coordinate tuples.
+        """
         # grow a little
-        polygon = polygon_feature.geometry().Buffer(grow)
+        polygon = polygon_feature.geometry().Buffer(self.grow)
+        if self.vectorized:
+            data = self.group.read(bounds=polygon)
 
         # query the linestrings
-        for linestring_feature in linestring_features.query(polygon):
+        result = []
+        for linestring_feature in self.linestring_features.query(polygon):
             linestring = linestring_feature.geometry()
 
-            case = Case(group=group,
-                        polygon=polygon,
-                        distance=distance,
-                        multiplier=multiplier,
-                        separation=separation,
-                        linestring=linestring)
+            kwargs = {'group': self.group,
+                      'polygon': polygon,
+                      'distance': self.distance,
+                      'multiplier': self.multiplier,
+                      'separation': self.separation,
+                      'linestring': linestring}
+            if self.vectorized:
+                case = VectorizedCase(data=data, **kwargs)
+            else:
+                case = Case(**kwargs)
 
             # do
-            points, levels = zip(*list(case.get_levels(False)))
+            try:
+                points, levels = zip(*list(case.get_levels(False)))
+            except ValueError:
+                # there are no levels for this case
+                continue
 
             if len(levels) > 1:
                 # check upstream
@@ -259,11 +327,48 @@ def upstream(polygon_path, linestring_path, raster_paths,
                         # there are no levels for this case
                         continue
 
-            # save
-            attributes = dict(linestring_feature.items())
-            for point, level in zip(points, levels):
-                attributes[KEY] = level
-                target.append(geometry=point, attributes=attributes)
+            points = [point.GetPoints()[0] for point in points]
+            result.append((linestring_feature.GetFID(), points, levels))
+        return result
+
+
+def upstream(polygon_path, linestring_path, raster_paths, grow, distance,
+             multiplier, separation, path, partial, workers, vectorized):
+    # open files
+    linestring_features = datasources.PartialDataSource(linestring_path)
+    target = datasources.TargetDataSource(
+        path=path,
+        template_path=linestring_path,
+        attributes=[KEY],
+    )
+
+    # select some or all polygons and search them using workers
+    searched = scheduler.Scheduler(
+        index_path=polygon_path,
+        factory=Searcher,
+        method='search',
+        part=partial,
+        workers=workers,
+        linestring_path=linestring_path,
+        raster_paths=raster_paths,
+        grow=grow,
+        distance=distance,
+        multiplier=multiplier,
+        separation=separation,
+        vectorized=vectorized,
+    )
+
+    with target:
+        for polygon_feature, result in searched:
+            for fid, points, levels in result:
+                # save
+                linestring_feature = linestring_features.layer[fid]
+                sr = linestring_feature.geometry().GetSpatialReference()
+                attributes = dict(linestring_feature.items())
+                for point, level in zip(points, levels):
+                    attributes[KEY] = level
+                    target.append(geometry=point2geometry(point, sr),
+                                  attributes=attributes)
     return 0
 
 
@@ -3,6 +3,7 @@
 
 import logging
 import math
+import time
 
 from osgeo import ogr
 import numpy as np
@@ -78,6 +79,20 @@ def aggregate_uneven(values, no_data_value, func='mean'):
     return {'values': result, 'no_data_value': no_data_value}
 
 
+class Timer(object):
+    """ Add the time spent in with blocks to a dictionary. """
+    def __init__(self, timings, stage):
+        self.timings = timings
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *args):
+        elapsed = time.perf_counter() - self.start
+        self.timings[self.stage] = self.timings.get(self.stage, 0) + elapsed
+
+
 class GeoTransform(tuple):
     def shifted(self, geometry, inflate=False):
         """
@@ -177,6 +177,24 @@ def array2polygon(array):
     return ogr.CreateGeometryFromWkb(data.tostring())
 
 
+def array2linestring(array):
+    """
+    Return a linestring geometry.
+
+    Like array2polygon, this uses numpy to prepare a wkb string.
+    """
+    # 9 bytes for the header, 16 bytes per point
+    nbytes = 9 + 16 * array.shape[0]
+    data = np.empty(nbytes, dtype=np.uint8)
+    # little endian
+    data[0:1] = 1
+    # wkb type, number of points
+    data[1:9].view('u4')[:] = (2, array.shape[0])
+    # set the points
+    data[9:].view('f8')[:] = array.ravel()
+    return ogr.CreateGeometryFromWkb(data.tobytes())
+
+
 def array2multipoint(array):
     """
     Return a 3d multipoint geometry.
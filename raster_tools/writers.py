@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+# (c) Nelen & Schuurmans, see LICENSE.rst.
+"""
+Write arrays into gdal datasets from a background thread.
+
+All work on the target datasets, including flushing and the callbacks that
+should only run after preceding writes, is done in the writer thread, so
+that the datasets are never used from two threads at once. The queue is
+bounded, so that a slow disk holds up the producer rather than filling the
+memory.
+"""
+
+import queue as queues
+import threading
+
+# maximum number of pending writes
+QUEUE_SIZE = 32
+
+# creation and open option to compress blocks using all cpus
+NUM_THREADS = 'NUM_THREADS=ALL_CPUS'
+
+
+class Writer:
+    """
+    Usage:
+        >>> with Writer() as writer:
+        ...     writer.write(dataset=dataset, array=array, origin=(0, 0))
+        ...     writer.call(function, *args)  # runs after the write
+
+    Errors in the writer thread are raised in the calling thread by the
+    next call to the writer or on leaving the with block. After an error the
+    writer skips all pending and later items, so that callbacks never run
+    for writes that did not succeed, and it keeps raising the error.
+    """
+    def __init__(self, size=QUEUE_SIZE):
+        self.size = size
+        self.maximum = 0
+        self.error = None
+        self.dropping = False
+        self.queue = queues.Queue(maxsize=size)
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        """ Run queued functions until receiving None. """
+        for item in iter(self.queue.get, None):
+            function, args = item
+            try:
+                if self.error is None and not self.dropping:
+                    function(*args)
+            except Exception as error:
+                self.error = error
+            finally:
+                self.queue.task_done()
+        self.queue.task_done()
+
+    def _check(self):
+        """ Raise the error of the writer thread, if any. """
+        if self.error is not None:
+            raise self.error
+
+    @property
+    def depth(self):
+        """ Return the number of pending items. """
+        return self.queue.qsize()
+
+    def call(self, function, *args):
+        """ Call function in the writer thread. """
+        self._check()
+        self.queue.put((function, args))
+        self.maximum = max(self.maximum, self.depth)
+
+    def write(self, dataset, array, origin, band=1):
+        """
+        Write two-dimensional array into a band of dataset.
+
+        :param origin: x, y offset in pixels
+        """
+        self.call(_write, dataset, band, array, origin)
+
+    def flush(self):
+        """ Wait until all pending items are done. """
+        self.queue.join()
+        self._check()
+
+    def close(self):
+        """ Finish the pending items and stop the writer thread. """
+        self.queue.put(None)
+        self.thread.join()
+        self._check()
+
+    def report(self):
+        """ Return line describing the queue depth. """
+        return 'Write queue depth: %s of %s at most.' % (
+            self.maximum, self.size,
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+            return
+        # drop the pending items and do not mask the original error
+        self.dropping = True
+        self.queue.put(None)
+        self.thread.join()
+
+
+def _write(dataset, band, array, origin):
+    """ Write array, keeping a reference to the dataset meanwhile. """
+    dataset.GetRasterBand(band).WriteArray(array, *origin)
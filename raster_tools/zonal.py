@@ -12,29 +12,337 @@ calculated with this script:
 If the statistic is unsuitable as field name in the target shape, a
 different field name can be specified like "the_mean:mean" instead of
 simply "mean".
+
+In batch mode, features are grouped by location and the raster is read
+once per group. The count, size, sum, mean, min, max, ptp, var, std,
+median and percentile statistics are computed for all features of a group
+at once, other statistics per feature.
+
+Features with an envelope of more than STREAM_SIZE squared pixels are
+analyzed block by block in bounded memory, for the same statistics. Their
+exact percentiles take extra passes over the raster, unless approximated
+from a histogram.
 """
 
 import argparse
 import re
 
 from osgeo import gdal
+from osgeo import ogr
 import numpy as np
 
 from raster_tools import groups
 from raster_tools import datasets
 from raster_tools import datasources
+from raster_tools import scheduler
+from raster_tools import utils
+
+DRIVER_OGR_MEMORY = ogr.GetDriverByName('Memory')
+
+# size in pixels of the square blocks by which features are batched
+BATCH_SIZE = 1024
+
+# size in pixels of the square blocks by which large features are streamed
+STREAM_SIZE = 4096
+
+# number of bins for the percentile histograms of streamed features
+BINS = 2 ** 16
+
+
+def get_data(array, no_data_value):
+    """ Return boolean array indicating elements that contain data. """
+    if array.dtype.kind == 'f':
+        return ~np.isclose(array, no_data_value)
+    return ~np.equal(array, no_data_value)
+
+
+def get_percentiles(values, first, count, q):
+    """
+    Return the q-percentile of each group of sorted values, interpolated
+    linearly like numpy does by default.
+
+    :param first: index of the first value of each group
+    :param count: number of values in each group, at least one
+    """
+    position = first + q / 100 * (count - 1)
+    lower = np.floor(position).astype('i8')
+    upper = np.minimum(lower + 1, first + count - 1)
+    fraction = position - lower
+    lo, hi = values[lower].astype('f8'), values[upper].astype('f8')
+    return lo + (hi - lo) * fraction
+
+
+def aggregate(labels, values, number, actions, no_data_value):
+    """
+    Return list of attribute dictionaries, one per label.
+
+    :param labels: labels in range(number) of the selected elements
+    :param values: values of the selected elements
+    :param number: number of labels
+    :param actions: as returned by Analyzer.get_actions()
+    """
+    size = np.bincount(labels, minlength=number)
+    data = get_data(values, no_data_value)
+    labels, values = labels[data], values[data]
+    count = np.bincount(labels, minlength=number)
+
+    # sort by label, then by value
+    order = np.lexsort((values, labels))
+    labels, values = labels[order], values[order]
+    first = np.cumsum(count) - count
+    last = first + count - 1
+    some = count > 0
+
+    # cumulative statistics
+    total = np.bincount(labels, values.astype('f8'), minlength=number)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = total / count
+    deviation = values - mean[labels]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        var = np.bincount(labels, deviation ** 2, minlength=number) / count
+
+    columns = {}
+    for column, (action, args) in actions.items():
+        result = np.full(number, np.nan)
+        if action == 'count':
+            result = count
+        elif action == 'size':
+            result = size
+        elif action == 'sum':
+            result = total
+        elif action == 'mean':
+            result = mean
+        elif action in ('var', 'std'):
+            result = var if action == 'var' else np.sqrt(var)
+        elif action in ('min', 'max', 'ptp'):
+            lo = values[first[some]].astype('f8')
+            hi = values[last[some]].astype('f8')
+            result[some] = {'min': lo, 'max': hi, 'ptp': hi - lo}[action]
+        elif action in ('median', 'percentile'):
+            q = 50 if action == 'median' else args[0]
+            result[some] = get_percentiles(
+                values=values, first=first[some], count=count[some], q=q,
+            )
+        else:
+            for label in some.nonzero()[0]:
+                group = values[first[label]:last[label] + 1]
+                try:
+                    result[label] = getattr(np, action)(group, *args)
+                except (ValueError, IndexError) as error:
+                    template = 'Error getting statistic {} on label {}: {}'
+                    print(template.format(action, label, error))
+        if action not in ('count', 'size'):
+            result = np.where(some, result, np.nan)
+        columns[column] = result.tolist()
+
+    return [{column: round(result[label], 16)
+             for column, result in columns.items()}
+            for label in range(number)]
+
+
+def get_keys(values):
+    """ Return unsigned 64 bit integers that sort like values. """
+    kind, itemsize = values.dtype.kind, values.dtype.itemsize
+    if kind == 'f':
+        bits = values.view('u{}'.format(itemsize)).astype('u8')
+        sign = np.uint64(1 << (8 * itemsize - 1))
+        mask = np.uint64((1 << 8 * itemsize) - 1)
+        return np.where(bits & sign, ~bits & mask, bits | sign)
+    if kind == 'i':
+        return values.astype('i8').view('u8') ^ np.uint64(1 << 63)
+    return values.astype('u8')
+
+
+def get_value(key, dtype):
+    """ Return the value of dtype for a key as returned by get_keys(). """
+    kind, itemsize = dtype.kind, dtype.itemsize
+    if kind == 'f':
+        sign = 1 << (8 * itemsize - 1)
+        bits = key ^ sign if key & sign else ~key & ((1 << 8 * itemsize) - 1)
+        return np.array(bits, 'u{}'.format(itemsize)).view(dtype).item()
+    if kind == 'i':
+        return np.array(key ^ (1 << 63), 'u8').view('i8').item()
+    return key
+
+
+def get_ranks(count, q):
+    """ Return lower rank, upper rank and fraction for the q-percentile. """
+    position = q / 100 * (count - 1)
+    lower = int(position)
+    return lower, min(lower + 1, count - 1), position - lower
+
+
+class Moments(object):
+    """
+    Mergeable count, sum, extremes and sum of squared deviations.
+    """
+    def __init__(self):
+        self.size = 0
+        self.count = 0
+        self.total = 0.
+        self.mean = 0.
+        self.m2 = 0.
+        self.minimum = None
+        self.maximum = None
+
+    def add(self, values, size):
+        """ Add the values of a block that selected size elements. """
+        self.size += size
+        if not values.size:
+            return
+        minimum, maximum = values.min(), values.max()
+        if self.count:
+            minimum = min(minimum, self.minimum)
+            maximum = max(maximum, self.maximum)
+        self.minimum, self.maximum = minimum, maximum
+
+        # merge mean and squared deviations, after Chan et al.
+        values = values.astype('f8')
+        count = values.size
+        mean = values.mean()
+        m2 = np.square(values - mean).sum()
+        delta = mean - self.mean
+        total = self.count + count
+        self.mean += delta * count / total
+        self.m2 += m2 + delta ** 2 * self.count * count / total
+        self.count = total
+        self.total += values.sum()
+
+    def get(self, action):
+        """ Return statistic or None if it is not a moment. """
+        if action == 'count':
+            return self.count
+        if action == 'size':
+            return self.size
+        if not self.count:
+            return np.nan
+        if action == 'sum':
+            return self.total
+        if action == 'mean':
+            return self.mean
+        if action == 'var':
+            return self.m2 / self.count
+        if action == 'std':
+            return np.sqrt(self.m2 / self.count)
+        if action == 'min':
+            return self.minimum.item()
+        if action == 'max':
+            return self.maximum.item()
+        if action == 'ptp':
+            return self.maximum.item() - self.minimum.item()
+
+
+def select_exact(stream, ranks, minimum, maximum):
+    """
+    Return dictionary of the values at ranks in the sorted values of
+    stream.
+
+    The range of keys of each rank is narrowed down by a factor BINS per
+    pass over the stream, using a histogram of the keys in the range.
+
+    :param stream: callable that returns an iterable of value arrays
+    :param minimum: value of the lowest rank
+    :param maximum: value of the highest rank
+    """
+    # per rank the remaining rank and the lowest and highest key of a range
+    lo, hi = get_keys(np.array([minimum, maximum])).tolist()
+    targets = {rank: [rank, lo, hi] for rank in ranks}
+    active = [t for t in targets.values() if t[1] < t[2]]
+    while active:
+        shifts = [max(0, (hi - lo).bit_length() - BINS.bit_length() + 1)
+                  for rank, lo, hi in active]
+        histograms = [np.zeros(((hi - lo) >> shift) + 1, 'i8')
+                      for (rank, lo, hi), shift in zip(active, shifts)]
+        for values in stream():
+            keys = get_keys(values)
+            for target, shift, histogram in zip(active, shifts, histograms):
+                lo, hi = np.uint64(target[1]), np.uint64(target[2])
+                inside = keys[(keys >= lo) & (keys <= hi)]
+                bins = (inside - lo) >> np.uint64(shift)
+                histogram += np.bincount(bins.astype('i8'),
+                                         minlength=histogram.size)
+
+        # narrow down to the bin containing the rank
+        for target, shift, histogram in zip(active, shifts, histograms):
+            cumulative = histogram.cumsum()
+            index = np.searchsorted(cumulative, target[0], side='right')
+            if index:
+                target[0] -= cumulative[index - 1].item()
+            target[1] += int(index) << shift
+            target[2] = min(target[2], target[1] + (1 << shift) - 1)
+        active = [t for t in active if t[1] < t[2]]
+
+    dtype = np.array(minimum).dtype
+    return {rank: get_value(target[1], dtype)
+            for rank, target in targets.items()}
+
+
+def select_approximate(stream, ranks, minimum, maximum):
+    """
+    Return dictionary of the values at ranks in the sorted values of
+    stream, interpolated in a histogram of BINS bins, in a single pass.
+    """
+    minimum, maximum = float(minimum), float(maximum)
+    if minimum == maximum:
+        return {rank: minimum for rank in ranks}
+    width = (maximum - minimum) / BINS
+    histogram = np.zeros(BINS, 'i8')
+    for values in stream():
+        bins = ((values.astype('f8') - minimum) / width).astype('i8')
+        histogram += np.bincount(np.minimum(bins, BINS - 1), minlength=BINS)
+
+    cumulative = histogram.cumsum()
+    result = {}
+    for rank in ranks:
+        index = np.searchsorted(cumulative, rank, side='right')
+        before = cumulative[index - 1] if index else 0
+        fraction = (rank - before + 0.5) / histogram[index]
+        result[rank] = min(maximum, minimum + (index + fraction) * width)
+    return result
+
+
+def get_batches(layer, fids, geo_transform, size=BATCH_SIZE):
+    """
+    Return list of batches of fids, in the order of the blocks of size
+    by size pixels that contain the upper left corners of the features.
+    Features larger than a block get a batch of their own.
+    """
+    blocks = {}
+    batches = []
+    for fid in fids:
+        geometry = layer[fid].geometry()
+        x1, y1, x2, y2 = geo_transform.get_indices(geometry, inflate=True)
+        if x2 - x1 > size or y2 - y1 > size:
+            batches.append([fid])
+            continue
+        blocks.setdefault((y1 // size, x1 // size), []).append(fid)
+    return [blocks[key] for key in sorted(blocks)] + batches
 
 
 class Analyzer(object):
     """
     A container that does the computation per feature.
     """
-    def __init__(self, raster_paths, statistics):
+    def __init__(self, raster_paths, statistics, approximate=False):
         # raster group
         self.group = groups.Group(*map(gdal.Open, raster_paths))
 
         # prepare statistics gathering
-        self.actions = {}  # column_name: func_name, args
+        self.actions = self.get_actions(statistics)
+        self.approximate = approximate
+
+        # keep convenient group properties available
+        self.geo_transform = self.group.geo_transform
+        self.no_data_value = self.group.no_data_value.item()
+
+        # these kwargs are constant for the whole group
+        self.kwargs = {'projection': self.group.projection,
+                       'no_data_value': self.no_data_value}
+
+    @staticmethod
+    def get_actions(statistics):
+        """ Return dictionary {column_name: (func_name, args)}. """
+        actions = {}
         percentile = None
         pattern = re.compile('(p)([0-9]+)')
         for statistic in statistics:
@@ -48,17 +356,10 @@ class Analyzer(object):
             match = pattern.match(statistic)
             if pattern.match(statistic):
                 percentile = int(match.groups()[1])
-                self.actions[column] = 'percentile', [percentile]
+                actions[column] = 'percentile', [percentile]
             else:
-                self.actions[column] = statistic, []
-
-        # keep convenient group properties available
-        self.geo_transform = self.group.geo_transform
-        self.no_data_value = self.group.no_data_value.item()
-
-        # these kwargs are constant for the whole group
-        self.kwargs = {'projection': self.group.projection,
-                       'no_data_value': self.no_data_value}
+                actions[column] = statistic, []
+        return actions
 
     def read(self, geometry):
         """
@@ -87,17 +388,94 @@ class Analyzer(object):
         array_1d = array_2d[select_2d.astype('b1')]
 
         # determine data or no data
-        if array_1d.dtype.kind == 'f':
-            select_1d = ~np.isclose(array_1d, self.no_data_value)
-        else:
-            select_1d = ~np.equal(array_1d, self.no_data_value)
+        select_1d = get_data(array_1d, self.no_data_value)
 
         return {'array': array_1d[select_1d], 'size': array_1d.size}
 
+    def _get_window(self, indices):
+        """ Return geo transform of a window of pixels. """
+        x1, y1, x2, y2 = indices
+        p, a, b, q, c, d = self.geo_transform
+        x, y = self.geo_transform.get_coordinates((y1, x1))
+        return utils.GeoTransform((x, a, b, y, c, d))
+
+    def _is_large(self, indices):
+        """ Return if a window of pixels is too large to read at once. """
+        x1, y1, x2, y2 = indices
+        return (x2 - x1) * (y2 - y1) > STREAM_SIZE ** 2
+
+    def _stream(self, geometry):
+        """ Return generator of data and size per block of geometry. """
+        x1, y1, x2, y2 = self.geo_transform.get_indices(geometry,
+                                                        inflate=True)
+        with datasources.Layer(geometry) as layer:
+            for q1 in range(y1, y2, STREAM_SIZE):
+                for p1 in range(x1, x2, STREAM_SIZE):
+                    indices = (p1, q1,
+                               min(x2, p1 + STREAM_SIZE),
+                               min(y2, q1 + STREAM_SIZE))
+                    array_2d = self.group.read(indices)
+
+                    # select elements that are within geometry
+                    kwargs = {'geo_transform': self._get_window(indices)}
+                    kwargs.update(self.kwargs)
+                    select_2d = np.zeros(array_2d.shape, dtype='u1')
+                    with datasets.Dataset(select_2d[np.newaxis],
+                                          **kwargs) as dataset:
+                        gdal.RasterizeLayer(dataset, [1], layer,
+                                            burn_values=[1])
+                    array_1d = array_2d[select_2d.astype('b1')]
+                    select_1d = get_data(array_1d, self.no_data_value)
+                    yield array_1d[select_1d], array_1d.size
+
+    def analyze_stream(self, feature):
+        """ Return attributes, reading the raster block by block. """
+        geometry = feature.geometry()
+        moments = Moments()
+        for values, size in self._stream(geometry):
+            moments.add(values, size)
+
+        # the ranks needed for percentiles
+        percentiles = {}
+        for column, (action, args) in self.actions.items():
+            if moments.count and action in ('median', 'percentile'):
+                q = 50 if action == 'median' else args[0]
+                percentiles[column] = get_ranks(moments.count, q)
+        if percentiles:
+            select = select_approximate if self.approximate else select_exact
+            ranks = set()
+            for lower, upper, fraction in percentiles.values():
+                ranks.update((lower, upper))
+            selected = select(
+                stream=lambda: (v for v, s in self._stream(geometry)),
+                ranks=ranks,
+                minimum=moments.minimum,
+                maximum=moments.maximum,
+            )
+
+        # apppend statistics
+        attributes = feature.items()
+        for column, (action, args) in self.actions.items():
+            value = moments.get(action)
+            if column in percentiles:
+                lower, upper, fraction = percentiles[column]
+                lo, hi = selected[lower], selected[upper]
+                value = lo + (hi - lo) * fraction
+            elif value is None:
+                template = 'Statistic {} unavailable for large feature {}'
+                print(template.format(action, feature.GetFID()))
+                value = np.nan
+            attributes[column] = round(value, 16)
+
+        return attributes
+
     def analyze(self, feature):
         """ Return attributes to write to the result. """
         # retrieve raster data
         geometry = feature.geometry()
+        indices = self.geo_transform.get_indices(geometry, inflate=True)
+        if self._is_large(indices):
+            return self.analyze_stream(feature)
         data = self.read(geometry)
         array = data['array']
         size = data['size']
@@ -120,26 +498,154 @@ class Analyzer(object):
                     print(template.format(action, feature.GetFID(), error))
                     attributes[column] = np.nan
 
-        return {'geometry': geometry, 'attributes': attributes}
+        return attributes
 
 
-def command(source_path, target_path, raster_paths, statistics, part):
-    """ Main """
-    # open source datasource
+class BatchAnalyzer(Analyzer):
+    """
+    Does the computation per batch of features, reading the raster once.
+    """
+    def _rasterize(self, geometries, indices):
+        """
+        Return array of labels and mask of pixels covered more than once,
+        for the window of indices.
+        """
+        x1, y1, x2, y2 = indices
+        data_source = DRIVER_OGR_MEMORY.CreateDataSource('')
+        sr = geometries[0].GetSpatialReference()
+        layer = data_source.CreateLayer('', sr)
+        layer.CreateField(ogr.FieldDefn('label', ogr.OFTInteger))
+        layer_defn = layer.GetLayerDefn()
+        for label, geometry in enumerate(geometries, 1):
+            feature = ogr.Feature(layer_defn)
+            feature['label'] = label
+            feature.SetGeometry(geometry)
+            layer.CreateFeature(feature)
+
+        kwargs = {'geo_transform': self._get_window(indices),
+                  'projection': self.group.projection}
+        labels = np.zeros((1, y2 - y1, x2 - x1), dtype='i4')
+        with datasets.Dataset(labels, **kwargs) as dataset:
+            gdal.RasterizeLayer(dataset, [1], layer,
+                                options=['ATTRIBUTE=label'])
+        overlap = np.zeros((1, y2 - y1, x2 - x1), dtype='u1')
+        with datasets.Dataset(overlap, **kwargs) as dataset:
+            gdal.RasterizeLayer(dataset, [1], layer, burn_values=[1],
+                                options=['MERGE_ALG=ADD'])
+        return labels[0], overlap[0] > 1
+
+    def analyze_batch(self, features):
+        """ Return list of attributes to write to the result. """
+        geometries = [feature.geometry() for feature in features]
+        indices = [self.geo_transform.get_indices(geometry, inflate=True)
+                   for geometry in geometries]
+        if len(features) == 1 and self._is_large(indices[0]):
+            return [self.analyze_stream(features[0])]
+        window = (min(i[0] for i in indices),
+                  min(i[1] for i in indices),
+                  max(i[2] for i in indices),
+                  max(i[3] for i in indices))
+        array = self.group.read(window)
+        labels, overlap = self._rasterize(geometries, window)
+
+        # labels of features that share pixels with other features
+        x1, y1 = window[:2]
+        shared = [label for label, (p1, q1, p2, q2) in enumerate(indices, 1)
+                  if overlap[q1 - y1:q2 - y1, p1 - x1:p2 - x1].any()]
+        labels[np.isin(labels, shared)] = 0
+
+        # all features at once
+        select = labels.astype('b1')
+        results = aggregate(labels=labels[select] - 1,
+                            values=array[select],
+                            number=len(features),
+                            actions=self.actions,
+                            no_data_value=self.no_data_value)
+
+        # features that share pixels one by one
+        for label in shared:
+            p1, q1, p2, q2 = indices[label - 1]
+            single, _ = self._rasterize([geometries[label - 1]],
+                                        indices[label - 1])
+            select = single.astype('b1')
+            values = array[q1 - y1:q2 - y1, p1 - x1:p2 - x1][select]
+            results[label - 1], = aggregate(labels=single[select] - 1,
+                                            values=values,
+                                            number=1,
+                                            actions=self.actions,
+                                            no_data_value=self.no_data_value)
+
+        attributes = []
+        for feature, result in zip(features, results):
+            attributes.append(feature.items())
+            attributes[-1].update(result)
+        return attributes
+
+
+def analyze(source_path, raster_paths, statistics, part, workers, batch,
+            approximate):
+    """ Return generator of geometry, attributes tuples in source order. """
+    if not batch:
+        # analyze some or all source features using workers
+        analyzed = scheduler.Scheduler(
+            index_path=source_path,
+            factory=Analyzer,
+            method='analyze',
+            part=part,
+            workers=workers,
+            statistics=statistics,
+            raster_paths=raster_paths,
+            approximate=approximate,
+        )
+        for feature, attributes in analyzed:
+            yield feature.geometry(), attributes
+        return
+
+    # group the features by location
     source = datasources.PartialDataSource(source_path)
-    if part is not None:
-        source = source.select(part)
+    fids = source.get_fids(part)
+    group = groups.Group(gdal.Open(raster_paths[0]))
+    batches = get_batches(layer=source.layer,
+                          fids=fids,
+                          geo_transform=group.geo_transform)
 
-    analyzer = Analyzer(statistics=statistics,
-                        raster_paths=raster_paths)
+    # analyze the batches using workers
+    analyzed = scheduler.Scheduler(
+        index_path=source_path,
+        factory=BatchAnalyzer,
+        method='analyze_batch',
+        batches=batches,
+        workers=workers,
+        ordered=False,
+        statistics=statistics,
+        raster_paths=raster_paths,
+        approximate=approximate,
+    )
+    results = {}
+    for features, attributes in analyzed:
+        for feature, item in zip(features, attributes):
+            results[feature.GetFID()] = item
 
+    # source order
+    for fid in fids:
+        yield source.layer[fid].geometry(), results.pop(fid)
+
+
+def command(source_path, target_path, statistics, **kwargs):
+    """ Main """
     # create target datasource
-    target = datasources.TargetDataSource(path=target_path,
-                                          template_path=source_path,
-                                          attributes=analyzer.actions)
+    target = datasources.TargetDataSource(
+        path=target_path,
+        template_path=source_path,
+        attributes=Analyzer.get_actions(statistics),
+    )
 
-    for feature in source:
-        target.append(**analyzer.analyze(feature))
+    with target:
+        analyzed = analyze(source_path=source_path,
+                           statistics=statistics,
+                           **kwargs)
+        for geometry, attributes in analyzed:
+            target.append(geometry=geometry, attributes=attributes)
 
 
 def get_parser():
@@ -156,7 +662,8 @@ def get_parser():
     parser.add_argument(
         'target_path',
         metavar='TARGET',
-        help='Path to shapefile with target features.',
+        help=('Path to shapefile with target features, or other vector'
+              ' file by extension, like .gpkg or .fgb.'),
     )
     parser.add_argument(
         '-r', '--rasters',
@@ -177,6 +684,24 @@ def get_parser():
         '-p', '--part',
         help='Partial processing source, for example "2/3"',
     )
+    parser.add_argument(
+        '-w', '--workers',
+        type=int,
+        default=1,
+        help='Number of worker processes, 0 for one per cpu.',
+    )
+    parser.add_argument(
+        '-b', '--batch',
+        action='store_true',
+        help=('Analyze features in batches by location, reading the'
+              ' raster once per batch.'),
+    )
+    parser.add_argument(
+        '-a', '--approximate',
+        action='store_true',
+        help=('Approximate the percentiles of large features from a'
+              ' histogram, instead of taking extra passes over the raster.'),
+    )
     return parser
 
 
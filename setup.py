@@ -76,6 +76,7 @@ setup(
         'flow-acc           = raster_tools.flow.flow_acc:main',
         'flow-vec           = raster_tools.flow.flow_vec:main',
         'flow-rst           = raster_tools.flow.flow_rst:main',
+        'flow               = raster_tools.flow.pipeline:main',
         # modification
         'hillshade          = raster_tools.hillshade:main',
         'shadow             = raster_tools.shadow:main',